@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+"""
+ASGI entry point for the webapp.
+
+    uvicorn asgi:application --workers 4
+
+The same Flask routes and templates are served through asgiref's
+WSGI-to-ASGI adapter: the event loop takes care of the sockets, each
+request runs on a worker thread, and the independent queries inside a
+request are run together by offload.gather(). Needs the optional
+asgiref and uvicorn packages.
+"""
+
+# Set up our vendored packages
+import setup_vendor_path  # noqa
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    raise SystemExit("The async server needs asgiref: pip install asgiref uvicorn")
+
+from routes import app
+
+application = WsgiToAsgi(app)
@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement storage backends.
+The query functions in database.py get their connections, prepared
+statements, server-side cursors and bulk loads from one of these:
+
+    PostgresBackend     pg8000 connections to the remote server, pooled
+    SQLiteBackend       a local SQLite file, one connection per thread
+
+[DATABASE] backend picks one (postgresql or sqlite). Both hand out
+connections with the same cursor()/commit()/rollback()/close() shape and
+take SQL written for pg8000 (%s and $1 placeholders), so the queries in
+database.py run unchanged on either. The few statements that need
+Postgres-only features check `dialect` and use a SQLite form instead.
+"""
+
+import csv
+import datetime
+import decimal
+import functools
+import io
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from metrics import track_statement
+from pool import ConnectionPool, PoolTimeout
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SQLITE_SCHEMA = os.path.join(ROOT, 'sqlite_schema.sql')
+
+
+#####################################################
+#   PostgreSQL (pg8000)
+#####################################################
+
+class _CsvRowReader(io.RawIOBase):
+    """
+    File-like object that renders rows as CSV on demand, so COPY can read
+    millions of rows without them all being built in memory first.
+    """
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._text = io.StringIO()
+        self._writer = csv.writer(self._text, lineterminator='\n')
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self._pending) < len(buffer):
+            batch = 0
+            for row in self._rows:
+                self._writer.writerow(['' if value is None else value for value in row])
+                batch += 1
+                if batch == 1000:
+                    break
+            if batch == 0:
+                break
+            self._pending += self._text.getvalue().encode('utf-8')
+            self._text.seek(0)
+            self._text.truncate()
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+_PLACEHOLDER = re.compile(r'%[s%]')
+
+
+class _PreparedStatement:
+    """
+    A statement prepared once on a pooled pg8000 connection
+    (Connection.prepare()) and run with %s style positional parameters.
+    """
+
+    def __init__(self, raw, sql: str):
+        names = itertools.count(1)
+        # pg8000 prepares with :name parameters
+        named = _PLACEHOLDER.sub(lambda match: '%' if match.group() == '%%' else ':p{}'.format(next(names)), sql)
+        self._statement = raw.prepare(named)
+        columns = getattr(self._statement, 'cols', None) or []
+        self.description = [(column['name'],) for column in columns]
+
+    def run(self, params: tuple) -> list:
+        rows = self._statement.run(**{'p{}'.format(index): value for index, value in enumerate(params, 1)})
+        return list(rows or ())
+
+
+class _PreparedResult:
+    """
+    The rows of a prepared statement run, read like a cursor.
+    """
+
+    def __init__(self, description, rows):
+        self.description = description
+        self._rows = rows
+
+    def fetchall(self) -> list:
+        rows, self._rows = self._rows, []
+        return rows
+
+
+def _prepare(raw, sql: str):
+    # Connection.prepare() is in pg8000's DB-API (legacy) module from 1.16;
+    # with an older one the statement just runs through a cursor.
+    if not hasattr(raw, 'prepare'):
+        return None
+    return _PreparedStatement(raw, sql)
+
+
+class _Replica:
+    """
+    One read replica: its own pool plus what we know about its health.
+    """
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.latency = None             # smoothed SELECT 1 round trip, seconds
+        self.last_probe = 0.0
+        self.down_until = 0.0
+        self.checkouts = 0
+        self.failures = 0
+        self.probe_lock = threading.Lock()
+
+    def stats(self) -> dict:
+        stats = self.pool.stats()
+        stats.update({
+            'replica_checkouts': self.checkouts,
+            'replica_failures': self.failures,
+            'latency': self.latency if self.latency is not None else 0.0,
+            'down': int(self.down_until > time.monotonic()),
+        })
+        return stats
+
+
+def _parse_hosts(hosts: str, default_port: int) -> list:
+    """
+    'db1, db2:5433' -> [('db1', default_port), ('db2', 5433)]
+    """
+    parsed = []
+    for entry in hosts.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(':') if ':' in entry else (entry, '', '')
+        parsed.append((host, int(port) if port else default_port))
+    return parsed
+
+
+class PostgresBackend:
+    """
+    Connections to the Postgres server from [DATABASE], borrowed from a
+    ConnectionPool sized by [POOL].
+
+    Read-only queries may instead go to one of the [REPLICAS] hosts (same
+    credentials, one pool each), picked round robin or by the lowest
+    measured latency. A replica that can't be reached is skipped for
+    retry_after seconds and its reads go to the primary.
+    """
+
+    dialect = 'postgresql'
+
+    def __init__(self, settings):
+        import setup_vendor_path  # noqa
+        import pg8000
+        self._pg8000 = pg8000
+        self._settings = settings
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._replicas = None
+        self._turn = itertools.count()
+        self.connect_errors = (pg8000.Error, PoolTimeout, OSError)
+
+    def _open_connection(self, host=None, port=None):
+        """
+        Opens a brand new connection (to the primary unless host/port are
+        given); only the pools call this.
+        """
+        config = self._settings
+        connection = self._pg8000.connect(database=config.database.database,
+                                          user=config.database.user,
+                                          password=config.database.password,
+                                          host=host or config.database.host,
+                                          port=port or config.database.port,
+                                          timeout=config.timeouts.connect or None)
+        if config.timeouts.statement:
+            cursor = connection.cursor()
+            # SET can't take bind parameters, the value is an int from settings
+            cursor.execute("SET statement_timeout = {:d}".format(config.timeouts.statement))
+            cursor.close()
+            connection.commit()
+        return connection
+
+    def _new_pool(self, connect) -> ConnectionPool:
+        pool_config = self._settings.pool
+        pool = ConnectionPool(
+            connect,
+            min_size=pool_config.min_size,
+            max_size=pool_config.max_size,
+            timeout=pool_config.timeout,
+            max_idle=pool_config.max_idle,
+            health_check_after=pool_config.health_check_after,
+            prepare=_prepare)
+        pool.fill()
+        return pool
+
+    @property
+    def pool(self) -> ConnectionPool:
+        if self._pool is not None:
+            return self._pool
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = self._new_pool(self._open_connection)
+        return self._pool
+
+    @property
+    def replicas(self) -> list:
+        if self._replicas is not None:
+            return self._replicas
+        with self._pool_lock:
+            if self._replicas is None:
+                hosts = _parse_hosts(self._settings.replicas.hosts, self._settings.database.port)
+                self._replicas = [
+                    _Replica('{}:{}'.format(host, port),
+                             self._new_pool(functools.partial(self._open_connection, host, port)))
+                    for host, port in hosts]
+        return self._replicas
+
+    def connect(self, readonly: bool = False):
+        """
+        Borrow a connection: from a replica if `readonly` and one is up,
+        otherwise from the primary.
+        """
+        if readonly:
+            replica = self._choose_replica()
+            if replica is not None:
+                try:
+                    connection = replica.pool.get()
+                except self.connect_errors:
+                    self._mark_down(replica)
+                else:
+                    replica.checkouts += 1
+                    return connection
+        return self.pool.get()
+
+    def _mark_down(self, replica):
+        replica.failures += 1
+        replica.down_until = time.monotonic() + self._settings.replicas.retry_after
+
+    def _choose_replica(self):
+        now = time.monotonic()
+        live = [replica for replica in self.replicas if replica.down_until <= now]
+        if not live:
+            return None
+        if self._settings.replicas.strategy == 'least_latency':
+            for replica in live:
+                self._probe(replica, now)
+            live = [replica for replica in live if replica.down_until <= now]
+            if not live:
+                return None
+            # Unmeasured replicas sort last
+            return min(live, key=lambda replica: (replica.latency is None, replica.latency or 0.0))
+        return live[next(self._turn) % len(live)]
+
+    def _probe(self, replica, now):
+        """
+        Time a SELECT 1 on the replica, at most every probe_interval
+        seconds and by one thread at a time; the result is smoothed.
+        """
+        if now - replica.last_probe < self._settings.replicas.probe_interval:
+            return
+        if not replica.probe_lock.acquire(blocking=False):
+            return
+        try:
+            replica.last_probe = now
+            start = time.perf_counter()
+            connection = replica.pool.get()
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+                cursor.close()
+            finally:
+                connection.close()
+            elapsed = time.perf_counter() - start
+            if replica.latency is None:
+                replica.latency = elapsed
+            else:
+                replica.latency = 0.7 * replica.latency + 0.3 * elapsed
+        except self.connect_errors:
+            self._mark_down(replica)
+        finally:
+            replica.probe_lock.release()
+
+    def stats(self) -> dict:
+        stats = self.pool.stats()
+        if self.replicas:
+            stats['replicas'] = {replica.name: replica.stats() for replica in self.replicas}
+        return stats
+
+    def close(self):
+        with self._pool_lock:
+            old_pool, self._pool = self._pool, None
+            replicas, self._replicas = self._replicas or [], None
+        if old_pool is not None:
+            old_pool.close()
+        for replica in replicas:
+            replica.pool.close()
+
+    def after_fork(self):
+        # The inherited pools share their sockets with the parent, so they
+        # are forgotten (not closed, that would hang up on the parent too).
+        with self._pool_lock:
+            self._pool = None
+            self._replicas = None
+        self.pool
+
+    def execute_prepared(self, connection, cursor, sql: str, params: tuple):
+        """
+        Run `sql` through the statement the pool keeps prepared for it on
+        this connection, so it is parsed and planned once per connection.
+        Returns something to read the rows and description from.
+        """
+        statement = connection.prepared(sql)
+        if statement is None:
+            cursor.execute(sql, params)
+            return cursor
+        rows = track_statement(sql, lambda: statement.run(params))
+        return _PreparedResult(statement.description, rows)
+
+    def open_stream(self, cursor, name: str, sql: str, params: tuple, fetch_size: int) -> list:
+        """
+        Start reading `sql` through the server-side cursor `name`; returns
+        the first batch.
+        """
+        # Cursors only live inside a transaction, which the connection
+        # opens implicitly and the pool rolls back on release.
+        cursor.execute("DECLARE {} NO SCROLL CURSOR FOR {}".format(name, sql), params)
+        return self.fetch_stream(cursor, name, fetch_size)
+
+    def fetch_stream(self, cursor, name: str, fetch_size: int) -> list:
+        cursor.execute("FETCH FORWARD {:d} FROM {}".format(fetch_size, name))
+        return cursor.fetchall()
+
+    def close_stream(self, cursor, name: str):
+        cursor.execute("CLOSE {}".format(name))
+
+    def copy_rows(self, cursor, table: str, columns: list, rows) -> int:
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ', '.join(columns))
+        cursor.execute(sql, stream=io.BufferedReader(_CsvRowReader(rows), 64 * 1024))
+        return cursor.rowcount
+
+
+#####################################################
+#   SQLite
+#####################################################
+
+# MONEY columns hold integer cents; they read back as Decimal dollars,
+# which is what pg8000 gives for Postgres MONEY.
+sqlite3.register_converter('MONEY', lambda value: decimal.Decimal(int(value)).scaleb(-2))
+sqlite3.register_converter('DATE', lambda value: datetime.date.fromisoformat(value.decode('ascii')))
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+
+_PLACEHOLDER = re.compile(r'%s|%%|\$(\d+)')
+
+
+def to_qmark(sql: str) -> str:
+    """
+    Rewrite pg8000 placeholders for sqlite3: %s -> ?, $n -> ?n, %% -> %.
+    """
+    def replace(match):
+        if match.group(1):
+            return '?' + match.group(1)
+        return '?' if match.group(0) == '%s' else '%'
+    return _PLACEHOLDER.sub(replace, sql)
+
+
+def to_cents(amount):
+    """
+    Dollar amount (Decimal, number or '$1,234.50' text) as integer cents,
+    for writing MONEY columns.
+    """
+    if amount is None or amount == '':
+        return None
+    if isinstance(amount, str):
+        amount = amount.replace('$', '').replace(',', '')
+    return int((decimal.Decimal(str(amount)) * 100).to_integral_value(decimal.ROUND_HALF_UP))
+
+
+class _SQLiteCursor:
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self._cursor.execute(to_qmark(sql), tuple(params))
+
+    def executemany(self, sql, seq_of_params):
+        return self._cursor.executemany(to_qmark(sql), seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class SQLiteConnection:
+    """
+    One thread's connection to the SQLite file. close() only ends any open
+    transaction; the connection itself stays open for the thread's next
+    query.
+    """
+
+    wait_time = 0.0
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return _SQLiteCursor(self.raw.cursor())
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        if self.raw.in_transaction:
+            self.raw.rollback()
+
+    def discard(self):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+class SQLiteBackend:
+    """
+    A local SQLite database file ([DATABASE] path), for single-site
+    installs: no network round trip per query. WAL lets readers carry on
+    while a write commits; each thread keeps its own connection. An empty
+    file is given the schema from sqlite_schema.sql.
+    """
+
+    dialect = 'sqlite'
+    connect_errors = (sqlite3.Error,)
+
+    def __init__(self, settings):
+        path = settings.database.path
+        if not os.path.isabs(path):
+            path = os.path.join(ROOT, path)
+        self.path = path
+        self._busy_timeout = settings.timeouts.connect
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._stats = {'connections': 0, 'checkouts': 0}
+        self._create_schema()
+
+    def _open_connection(self):
+        raw = sqlite3.connect(self.path, timeout=self._busy_timeout or 5.0,
+                              detect_types=sqlite3.PARSE_DECLTYPES,
+                              check_same_thread=False)
+        raw.execute("PRAGMA journal_mode=WAL")
+        raw.execute("PRAGMA synchronous=NORMAL")
+        raw.execute("PRAGMA foreign_keys=ON")
+        with self._lock:
+            self._connections.append(raw)
+            self._stats['connections'] += 1
+        return SQLiteConnection(raw)
+
+    def _create_schema(self):
+        connection = self._open_connection()
+        found = connection.raw.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'Device'").fetchone()
+        if found is None:
+            with open(SQLITE_SCHEMA) as schema:
+                connection.raw.executescript(schema.read())
+        self._local.connection = connection
+
+    def connect(self, readonly: bool = False):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._open_connection()
+        with self._lock:
+            self._stats['checkouts'] += 1
+        return connection
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, open=len(self._connections))
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for raw in connections:
+            try:
+                raw.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+    def after_fork(self):
+        # SQLite connections must not cross a fork; open new ones lazily
+        with self._lock:
+            self._connections = []
+        self._local = threading.local()
+
+    def execute_prepared(self, connection, cursor, sql: str, params: tuple):
+        # sqlite3 keeps compiled statements in a per-connection cache
+        cursor.execute(sql, params)
+        return cursor
+
+    def open_stream(self, cursor, name: str, sql: str, params: tuple, fetch_size: int) -> list:
+        # SQLite steps through the result as rows are asked for
+        cursor.execute(sql, params)
+        return cursor.fetchmany(fetch_size)
+
+    def fetch_stream(self, cursor, name: str, fetch_size: int) -> list:
+        return cursor.fetchmany(fetch_size)
+
+    def close_stream(self, cursor, name: str):
+        pass
+
+    def copy_rows(self, cursor, table: str, columns: list, rows) -> int:
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(table, ', '.join(columns),
+                                                       ', '.join(['?'] * len(columns)))
+        cursor.executemany(sql, rows)
+        return cursor.rowcount
+
+
+def create_backend(settings):
+    """
+    The backend named by [DATABASE] backend.
+    """
+    if settings.database.backend == 'sqlite':
+        return SQLiteBackend(settings)
+    if settings.database.backend in ('postgresql', 'postgres'):
+        return PostgresBackend(settings)
+    raise ValueError("Unknown database backend '{}'".format(settings.database.backend))
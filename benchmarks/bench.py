@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+"""
+Benchmark every route in routes.py.
+
+    # 1. seed a local database (see datagen.py for the scale options)
+    python3 benchmarks/bench.py seed --devices 50000
+
+    # 2. drive every route, 8 concurrent clients, 200 requests per route
+    python3 benchmarks/bench.py run --concurrency 8 --requests 200 --output before.json
+
+    # sync vs concurrent queries within a request
+    python3 benchmarks/bench.py run --async-queries off --output sync.json
+    python3 benchmarks/bench.py run --async-queries on --output async.json
+    python3 benchmarks/bench.py compare sync.json async.json
+
+    # 3. after a change, run again and compare
+    python3 benchmarks/bench.py run --output after.json
+    python3 benchmarks/bench.py compare before.json after.json
+
+By default requests go through Flask's test client in this process, which
+also lets us count the queries each request makes. --target
+http://127.0.0.1:5000 drives a running server instead (e.g. main.py).
+
+Besides the routes, each run records the timings of every query function
+in database.py over the run (from the metrics registry, or /metrics on
+a --target server), and compare checks those too. A --prod server has
+one registry per worker process, so its /metrics only covers the worker
+that answered; use a single worker when comparing query functions.
+"""
+
+import argparse
+import contextvars
+import http.cookiejar
+import json
+import os
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import database  # noqa: E402
+import datagen  # noqa: E402
+import metrics  # noqa: E402
+
+LOGIN = {'id': '1', 'password': 'password'}     # employee 1 manages Department 1
+
+
+#####################################################
+#   Query counting (in-process runs only)
+#####################################################
+
+class _QueryCount:
+    """
+    Statements run for one request. The request's offloaded calls run in
+    copies of its context (offload.gather), so they count here as well.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def add(self):
+        with self._lock:
+            self.queries += 1
+
+
+_query_count = contextvars.ContextVar('bench_query_count', default=None)
+
+
+def _count_query():
+    count = _query_count.get()
+    if count is not None:
+        count.add()
+
+
+class _CountingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        _count_query()
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingStatement:
+    def __init__(self, statement):
+        self._statement = statement
+
+    def run(self, *args, **kwargs):
+        _count_query()
+        return self._statement.run(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._statement, name)
+
+
+class _CountingConnection:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self):
+        return _CountingCursor(self._connection.cursor())
+
+    def prepared(self, sql):
+        # The hot lookups run through a prepared handle, not a cursor
+        statement = self._connection.prepared(sql)
+        return None if statement is None else _CountingStatement(statement)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def install_query_counter():
+    """
+    Wrap database.database_connect so every statement is counted against
+    the request that ran it.
+    """
+    connect = database.database_connect
+
+    def counting_connect(*args, **kwargs):
+        connection = connect(*args, **kwargs)
+        return None if connection is None else _CountingConnection(connection)
+
+    database.database_connect = counting_connect
+
+
+def take_query_count() -> int:
+    """
+    Statements counted since the last call on this thread; the next
+    request starts from zero.
+    """
+    count = _query_count.get()
+    _query_count.set(_QueryCount())
+    return 0 if count is None else count.queries
+
+
+#####################################################
+#   Drivers
+#####################################################
+
+class FlaskDriver:
+    """
+    Requests through the Flask test client, one client (cookie jar) per thread.
+    """
+    counts_queries = True
+
+    def __init__(self):
+        from routes import app
+        self.app = app
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+        return self._local.client
+
+    def request(self, method, path, data=None, json_body=None):
+        response = self._client().open(path, method=method, data=data, json=json_body)
+        response.get_data()
+        return response.status_code
+
+    def endpoints(self):
+        return {rule.endpoint for rule in self.app.url_map.iter_rules() if rule.endpoint != 'static'}
+
+    def query_totals(self) -> dict:
+        return {name: {'calls': stats.calls, 'seconds': stats.seconds.total, 'rows': stats.rows,
+                       'statements': stats.statements, 'errors': stats.errors}
+                for name, stats in metrics.registry.snapshot()['queries'].items()}
+
+
+class HttpDriver:
+    """
+    Requests over HTTP against a running server, one cookie jar per thread.
+    """
+    counts_queries = False
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, target):
+        self.target = target.rstrip('/')
+        self._local = threading.local()
+
+    def _opener(self):
+        if not hasattr(self._local, 'opener'):
+            self._local.opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                self._NoRedirect())
+        return self._local.opener
+
+    def request(self, method, path, data=None, json_body=None):
+        return self._open(method, path, data, json_body)[0]
+
+    def _open(self, method, path, data=None, json_body=None):
+        body = None
+        headers = {}
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif isinstance(data, bytes):
+            body = data
+            headers['Content-Type'] = 'text/csv'
+        elif data is not None:
+            body = urllib.parse.urlencode(data).encode('utf-8')
+        request = urllib.request.Request(self.target + path, data=body, method=method, headers=headers)
+        try:
+            with self._opener().open(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+    def endpoints(self):
+        return None
+
+    def query_totals(self) -> dict:
+        # /metrics is for managers, and employee 1 manages Department 1
+        self.request('POST', '/login', data=LOGIN)
+        status, body = self._open('GET', '/metrics')
+        if status != 200:
+            print("Warning: GET /metrics returned {}; query functions not compared".format(status))
+            return None
+        return parse_query_totals(body.decode('utf-8'))
+
+
+#####################################################
+#   Scenarios
+#####################################################
+
+def sample_ids() -> dict:
+    """
+    Pick real ids from the seeded data for the parameterised routes.
+    """
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    cursor = connection.cursor()
+    cursor.execute("""SELECT R.repairID, R.doneTo FROM Repair R ORDER BY R.repairID LIMIT 1""")
+    repair_id, device_id = cursor.fetchall()[0]
+    cursor.execute("""SELECT manufacturer, modelNumber FROM ModelAllocations
+                       WHERE department = 'Department 1'
+                       ORDER BY manufacturer, modelNumber LIMIT 1""")
+    manufacturer, model = cursor.fetchall()[0]
+    cursor.execute("""SELECT empID FROM EmployeeDepartments
+                       WHERE department = 'Department 1' ORDER BY empID LIMIT 1""")
+    empid = cursor.fetchall()[0][0]
+    cursor.execute("""SELECT deviceID FROM Device
+                       WHERE issuedTo IS NULL AND manufacturer = %s AND modelNumber = %s
+                       ORDER BY deviceID LIMIT 4""", (manufacturer, model))
+    free_devices = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT MAX(deviceID) FROM Device")
+    last_device = cursor.fetchall()[0][0] or 0
+    cursor.close()
+    connection.close()
+    return {
+        'repair_id': repair_id, 'device_id': device_id,
+        'manufacturer': manufacturer, 'model': model,
+        'empid': empid, 'free_devices': free_devices, 'last_device': last_device,
+    }
+
+
+IMPORT_ROWS = 200       # devices in the (dry run) import scenario
+
+
+def import_csv(ids: dict) -> bytes:
+    """
+    A device shipment for /import/devices: new ids, the sampled model.
+    """
+    lines = ['deviceID,serialNumber,purchaseDate,purchaseCost,manufacturer,modelNumber']
+    for number in range(1, IMPORT_ROWS + 1):
+        lines.append('{},BN{:08d},2020-01-01,1000.00,{},{}'.format(
+            ids['last_device'] + number, number, ids['manufacturer'], ids['model']))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def build_scenarios(ids: dict, writes: bool) -> list:
+    """
+    (endpoint, method, path, form data or raw body, json body) for every route.
+    """
+    query = urllib.parse.urlencode
+    model, manufacturer = ids['model'], ids['manufacturer']
+    department = 'Department 1'
+    # A misspelt model number, so search falls back to similar spellings
+    misspelt = model[:-2] + model[-1:] + model[-2:-1] if len(model) > 2 else model + 'x'
+    scenarios = [
+        ('index', 'GET', '/', None, None),
+        ('showhistory', 'GET', '/history', None, None),
+        ('models', 'GET', '/models', None, None),
+        ('modeldetail', 'GET', '/modeldetail/{},{}'.format(manufacturer, model), None, None),
+        ('modelcost', 'GET', '/modelcost/{},{}'.format(model, manufacturer), None, None),
+        ('mydevices', 'GET', '/mydevices', None, None),
+        ('device', 'GET', '/device/{}'.format(ids['device_id']), None, None),
+        ('devicemodel', 'GET', '/device/{}/model'.format(ids['device_id']), None, None),
+        ('repair', 'GET', '/repair/{}'.format(ids['repair_id']), None, None),
+        ('departmentmodels', 'GET', '/departmentmodels', None, None),
+        ('departmentmodels', 'GET', '/departmentmodels?' + query(
+            {'model': model, 'manufacturer': manufacturer, 'department': department}), None, None),
+        ('departmentmodels', 'GET', '/departmentmodels?' + query(
+            {'model': model, 'manufacturer': manufacturer, 'department': department,
+             'empid': ids['empid']}), None, None),
+        ('issue_device', 'GET', '/issuedevice', None, None),
+        ('add_model', 'GET', '/addmodel', None, None),
+        ('model_devices', 'GET', '/modeldevices?' + query(
+            {'modelnumber': model, 'manufacturer': manufacturer}), None, None),
+        ('departmentemployees', 'GET', '/departmentemployees?' + query(
+            {'department': department}), None, None),
+        ('poolstats', 'GET', '/poolstats', None, None),
+        ('cachestats', 'GET', '/cachestats', None, None),
+        ('metrics_endpoint', 'GET', '/metrics', None, None),
+        ('search', 'GET', '/search?' + query({'q': manufacturer[:3]}), None, None),
+        ('search', 'GET', '/search?' + query({'q': misspelt, 'format': 'json'}), None, None),
+        # dry_run checks every row and rolls back, so the data stays as seeded
+        ('import_rows', 'POST', '/import/devices?dry_run=1', import_csv(ids), None),
+        ('export_department_devices', 'GET', '/export/devices/' + department, None, None),
+        ('export_device_repairs', 'GET', '/export/repairs/{}'.format(ids['device_id']), None, None),
+        ('export_model_cost', 'GET', '/export/modelcost/{},{}'.format(model, manufacturer), None, None),
+    ]
+    if writes and ids['free_devices']:
+        device_id = ids['free_devices'][0]
+        pairs = [{'empid': ids['empid'], 'deviceid': free} for free in ids['free_devices'][1:]]
+        scenarios += [
+            ('issue_device', 'POST', '/issuedevice',
+             {'empid': ids['empid'], 'deviceid': device_id}, None),
+            ('revoke_device', 'POST', '/revokedevice',
+             {'empid': ids['empid'], 'device_id': device_id, 'model': model,
+              'manufacturer': manufacturer, 'department': department}, None),
+            ('bulk_devices', 'POST', '/bulkdevices', None, {'action': 'issue', 'items': pairs}),
+            ('bulk_devices', 'POST', '/bulkdevices', None, {'action': 'revoke', 'items': pairs}),
+        ]
+    # Logging out would end the session for everything after it
+    scenarios += [('login', 'GET', '/login', None, None)]
+    return scenarios
+
+
+#####################################################
+#   Running
+#####################################################
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_scenario(driver, scenario, requests: int, concurrency: int, warmup: int) -> dict:
+    endpoint, method, path, data, json_body = scenario
+    latencies = []
+    queries = []
+    statuses = {}
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        driver.request('POST', '/login', data=LOGIN)
+        for _ in range(warmup):
+            driver.request(method, path, data=data, json_body=json_body)
+        take_query_count()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.perf_counter()
+            status = driver.request(method, path, data=data, json_body=json_body)
+            elapsed = time.perf_counter() - start
+            count = take_query_count()
+            with lock:
+                latencies.append(elapsed)
+                queries.append(count)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'endpoint': endpoint,
+        'method': method,
+        'path': path,
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'throughput_rps': len(latencies) / wall if wall else 0.0,
+        'queries_per_request': (sum(queries) / len(queries)) if driver.counts_queries and queries else None,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+#####################################################
+#   Query functions
+#####################################################
+
+_QUERY_SERIES = {
+    'dm_db_query_duration_seconds_count': 'calls',
+    'dm_db_query_duration_seconds_sum': 'seconds',
+    'dm_db_query_rows_total': 'rows',
+    'dm_db_query_statements_total': 'statements',
+    'dm_db_query_errors_total': 'errors',
+}
+_QUERY_LINE = re.compile(r'^(\w+)\{query="([^"]*)"\} (\S+)$')
+
+
+def parse_query_totals(text: str) -> dict:
+    """
+    Per query function totals from the Prometheus text of /metrics.
+    """
+    totals = {}
+    for line in text.splitlines():
+        match = _QUERY_LINE.match(line)
+        if match is None or match.group(1) not in _QUERY_SERIES:
+            continue
+        name, value = match.group(2), float(match.group(3))
+        totals.setdefault(name, {})[_QUERY_SERIES[match.group(1)]] = value
+    return totals
+
+
+def query_functions(before: dict, after: dict) -> dict:
+    """
+    What each query function did between two query_totals(): calls, mean
+    time and rows, statements per call.
+    """
+    functions = {}
+    for name, totals in sorted(after.items()):
+        old = before.get(name, {})
+        delta = {key: totals.get(key, 0) - old.get(key, 0) for key in _QUERY_SERIES.values()}
+        calls = int(delta['calls'])
+        if calls <= 0:
+            continue
+        functions[name] = {
+            'calls': calls,
+            'mean_ms': delta['seconds'] / calls * 1000,
+            'rows_per_call': delta['rows'] / calls,
+            'statements_per_call': delta['statements'] / calls,
+            'errors': int(delta['errors']),
+        }
+    return functions
+
+
+def print_functions(functions: dict):
+    header = "{:<40} {:>8} {:>9} {:>9} {:>8} {:>7}".format(
+        'query function', 'calls', 'mean ms', 'rows', 'stmts', 'errors')
+    print(header)
+    print('-' * len(header))
+    for name, function in functions.items():
+        print("{:<40} {:>8} {:>9.3f} {:>9.1f} {:>8.1f} {:>7}".format(
+            name[:40], function['calls'], function['mean_ms'], function['rows_per_call'],
+            function['statements_per_call'], function['errors']))
+
+
+def print_results(results: list):
+    header = "{:<58} {:>9} {:>9} {:>9} {:>9} {:>7}".format(
+        'route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'q/req')
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        qpr = result['queries_per_request']
+        print("{:<58} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f} {:>7}".format(
+            (result['method'] + ' ' + result['path'])[:58],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps'],
+            '-' if qpr is None else '{:.1f}'.format(qpr)))
+
+
+def run(args):
+    if args.async_queries:
+        # Settings are read at import, so this has to happen before routes loads
+        os.environ['DM_ASYNC_ENABLED'] = '1' if args.async_queries == 'on' else '0'
+        import settings
+        settings.reload_settings()
+
+    if args.target:
+        driver = HttpDriver(args.target)
+    else:
+        install_query_counter()
+        driver = FlaskDriver()
+
+    scenarios = build_scenarios(sample_ids(), args.writes)
+    if args.only:
+        scenarios = [scenario for scenario in scenarios if scenario[0] in args.only]
+
+    known = driver.endpoints()
+    if known is not None:
+        missing = known - {scenario[0] for scenario in scenarios} - {'logout'}
+        if missing and not args.only:
+            # Every route is benchmarked: a new one needs a scenario here
+            sys.exit("No benchmark scenario for routes: " + ", ".join(sorted(missing)))
+
+    totals = driver.query_totals()
+    results = [run_scenario(driver, scenario, args.requests, args.concurrency, args.warmup)
+               for scenario in scenarios]
+    print_results(results)
+
+    functions = None
+    if totals is not None:
+        after = driver.query_totals()
+        if after is not None:
+            functions = query_functions(totals, after)
+            print()
+            print_functions(functions)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'target': args.target or 'in-process',
+                'concurrency': args.concurrency,
+                'async_queries': args.async_queries,
+                'requests': args.requests,
+                'results': results,
+                'query_functions': functions,
+            }, output, indent=2)
+        print("Saved to " + args.output)
+
+
+def compare(args):
+    """
+    Compare two saved runs route by route, then query function by query
+    function. Exits 1 when any route got slower than --threshold percent
+    at p50 or p95 or makes more queries, or any query function got slower
+    than --threshold percent on average or runs more statements per call.
+    """
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline = json.load(baseline_file)
+        candidate = json.load(candidate_file)
+
+    key = lambda result: (result['method'], result['path'])
+    before = {key(result): result for result in baseline['results']}
+    regressions = 0
+
+    print("{:<50} {:>16} {:>16} {:>12}".format('route', 'p50 ms', 'p95 ms', 'q/req'))
+    for result in candidate['results']:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        line = []
+        regressed = False
+        for metric in ('p50_ms', 'p95_ms'):
+            change = (result[metric] - old[metric]) / old[metric] * 100 if old[metric] else 0.0
+            regressed |= change > args.threshold
+            line.append("{:>7.2f} {:>+7.1f}%".format(result[metric], change))
+        old_q, new_q = old['queries_per_request'], result['queries_per_request']
+        if old_q is not None and new_q is not None:
+            regressed |= new_q > old_q
+            line.append("{:>5.1f} -> {:<4.1f}".format(old_q, new_q))
+        else:
+            line.append("{:>12}".format('-'))
+        regressions += regressed
+        print("{:<50} {} {}".format(
+            (result['method'] + ' ' + result['path'])[:50], ' '.join(line), ' <-- REGRESSION' if regressed else ''))
+
+    function_regressions = 0
+    old_functions = baseline.get('query_functions') or {}
+    new_functions = candidate.get('query_functions') or {}
+    shared = [name for name in new_functions if name in old_functions]
+    if shared:
+        print()
+        print("{:<40} {:>16} {:>14}".format('query function', 'mean ms', 'stmts/call'))
+    for name in shared:
+        old, new = old_functions[name], new_functions[name]
+        change = (new['mean_ms'] - old['mean_ms']) / old['mean_ms'] * 100 if old['mean_ms'] else 0.0
+        regressed = change > args.threshold
+        regressed |= new['statements_per_call'] > old['statements_per_call'] + 0.01
+        function_regressions += regressed
+        print("{:<40} {:>7.3f} {:>+7.1f}% {:>5.1f} -> {:<5.1f} {}".format(
+            name[:40], new['mean_ms'], change, old['statements_per_call'], new['statements_per_call'],
+            ' <-- REGRESSION' if regressed else ''))
+
+    if regressions:
+        print("{} route(s) regressed".format(regressions))
+    if function_regressions:
+        print("{} query function(s) regressed".format(function_regressions))
+    if regressions or function_regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DeviceManagement route benchmarks')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    seed_parser = commands.add_parser('seed', help='load synthetic data')
+    datagen.add_scale_arguments(seed_parser)
+
+    run_parser = commands.add_parser('run', help='benchmark every route')
+    run_parser.add_argument('--concurrency', type=int, default=4)
+    run_parser.add_argument('--requests', type=int, default=100, help='timed requests per route')
+    run_parser.add_argument('--warmup', type=int, default=2, help='untimed requests per client first')
+    run_parser.add_argument('--target', help='base URL of a running server instead of the test client')
+    run_parser.add_argument('--writes', action='store_true', help='also benchmark issue/revoke routes')
+    run_parser.add_argument('--async-queries', choices=['on', 'off'],
+                            help='run independent queries in a request concurrently (in-process only)')
+    run_parser.add_argument('--only', nargs='*', help='only these endpoints')
+    run_parser.add_argument('--output', help='save results as JSON')
+
+    compare_parser = commands.add_parser('compare', help='compare two saved runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='percent slowdown that counts as a regression')
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        datagen.load(datagen.scale_from(args), args.seed, args.schema)
+    elif args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == '__main__':
+    main()
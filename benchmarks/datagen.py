@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Synthetic data generator for the company schema.
+
+Fills all eleven tables with referentially consistent data at any scale
+and loads it with COPY. The same --seed always gives the same rows, so
+benchmark runs and query plan checks can be repeated.
+
+    python3 benchmarks/datagen.py --schema --devices 1000000 --employees 50000
+
+Distributions, roughly:
+    - model popularity is Zipf-like (a few models make up most devices)
+    - devices are bought more in later years, and cost the model's list
+      price give or take 15%
+    - ~75% of devices are issued, to an employee of a department that the
+      model is allocated to
+    - each issued device has had a few previous users (geometric)
+    - repairs are rare for new devices and more common for old ones
+Employee N has password 'password'. The employee with id 1 manages the
+first department ('Department 1').
+"""
+
+import argparse
+import array
+import bisect
+import datetime
+import itertools
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database  # noqa: E402
+import migrate  # noqa: E402
+import sqlscript  # noqa: E402
+
+SCHEMA_FILE = os.path.join(ROOT, 'isys2120-Asst3_company_database_v4.2.sql')
+
+DEFAULT_SCALE = {
+    'employees': 1000,
+    'departments': 10,
+    'models': 200,
+    'devices': 20000,
+    'services': 20,
+}
+
+FIRST_NAMES = ['Olivia', 'Jack', 'Charlotte', 'William', 'Amelia', 'Noah', 'Isla', 'Oliver',
+               'Mia', 'Thomas', 'Ava', 'James', 'Grace', 'Lucas', 'Chloe', 'Henry', 'Wei',
+               'Priya', 'Mohammed', 'Yuki', 'Sofia', 'Ethan', 'Zoe', 'Liam', 'Ruby']
+LAST_NAMES = ['Smith', 'Jones', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Nguyen', 'Johnson',
+              'Martin', 'White', 'Anderson', 'Walker', 'Thompson', 'Chen', 'Kelly', 'Singh',
+              'Lee', 'Harris', 'Ryan', 'King', 'Wang', 'Patel', 'Campbell', 'Clarke']
+STREETS = ['George St', 'King St', 'Parramatta Rd', 'Oxford St', 'Pitt St', 'Church St',
+           'Victoria Rd', 'Pacific Hwy', 'Elizabeth St', 'Bridge Rd', 'Glebe Point Rd']
+SUBURBS = ['Camperdown', 'Newtown', 'Glebe', 'Ultimo', 'Redfern', 'Chippendale',
+           'Annandale', 'Leichhardt', 'Surry Hills', 'Darlington', 'Erskineville']
+DEPARTMENTS = ['Engineering', 'Finance', 'Marketing', 'Sales', 'Legal', 'Support',
+               'Research', 'Operations', 'HR', 'Procurement', 'Design', 'Security']
+# manufacturer, market share weight, product lines as (prefix, description, weight g, list price)
+MANUFACTURERS = [
+    ('Apple', 30, [('iPhone', 'Smartphone', 180, 1400), ('MBP', 'Laptop', 1600, 2800),
+                   ('iPad', 'Tablet', 480, 900)]),
+    ('Samsung', 20, [('GS', 'Smartphone', 170, 1100), ('Tab', 'Tablet', 500, 700),
+                     ('Mon', 'Monitor', 4200, 450)]),
+    ('Dell', 15, [('XPS', 'Laptop', 1300, 2200), ('Lat', 'Laptop', 1500, 1600),
+                  ('U', 'Monitor', 5200, 600)]),
+    ('Lenovo', 12, [('X1', 'Laptop', 1100, 2400), ('T', 'Laptop', 1500, 1700)]),
+    ('Google', 8, [('Pixel', 'Smartphone', 170, 1000)]),
+    ('HP', 8, [('EB', 'Laptop', 1400, 1500), ('LJ', 'Printer', 9000, 700)]),
+    ('Cisco', 4, [('CP', 'Desk phone', 1100, 400)]),
+    ('Logitech', 3, [('MX', 'Peripheral', 140, 150)]),
+]
+FAULTS = ['Cracked screen', 'Battery not charging', 'Keyboard unresponsive', 'Water damage',
+          'Will not boot', 'Overheating', 'Dead pixels', 'Speaker distorted',
+          'Hinge broken', 'Port damaged', 'Paper jam', 'No network']
+
+START_DATE = datetime.date(2012, 1, 1)
+END_DATE = datetime.date(2018, 10, 1)
+
+
+#####################################################
+#   Generation
+#####################################################
+
+class Dataset:
+    """
+    Generates the rows for every table. Large tables are produced lazily
+    (generators over compact arrays) so millions of devices fit in memory.
+    """
+
+    def __init__(self, scale: dict, seed: int):
+        self.scale = dict(DEFAULT_SCALE)
+        self.scale.update(scale)
+        self.seed = seed
+        self.scale['departments'] = max(1, min(self.scale['departments'], self.scale['employees']))
+        self._plan()
+
+    def _random(self, stream: str) -> random.Random:
+        # One independent generator per table keeps tables stable even when
+        # the scale of another table changes.
+        return random.Random('{}:{}'.format(self.seed, stream))
+
+    def _plan(self):
+        """
+        Decide the small tables and the per-device facts everything else
+        depends on.
+        """
+        scale = self.scale
+        rng = self._random('plan')
+
+        # Departments and who works where
+        self.departments = ['Department 1'] + [
+            '{} {}'.format(DEPARTMENTS[i % len(DEPARTMENTS)], i // len(DEPARTMENTS) + 1)
+            for i in range(1, scale['departments'])]
+        self.department_members = [[] for _ in self.departments]
+        self.memberships = []           # (empid, department index, fraction)
+        for empid in range(1, scale['employees'] + 1):
+            if empid <= len(self.departments):
+                home = empid - 1        # manager of their own department
+            else:
+                home = rng.randrange(len(self.departments))
+            self.department_members[home].append(empid)
+            if rng.random() < 0.15 and len(self.departments) > 1:
+                other = (home + rng.randrange(1, len(self.departments))) % len(self.departments)
+                self.department_members[other].append(empid)
+                self.memberships.append((empid, home, '0.5'))
+                self.memberships.append((empid, other, '0.5'))
+            else:
+                self.memberships.append((empid, home, '1'))
+
+        # Models, with Zipf-like popularity
+        self.models = []                # (manufacturer, modelNumber, description, weight, price)
+        share = [weight for _, weight, _ in MANUFACTURERS]
+        for number in range(1, scale['models'] + 1):
+            manufacturer, _, lines = rng.choices(MANUFACTURERS, weights=share)[0]
+            prefix, kind, weight, price = rng.choice(lines)
+            generation = rng.randint(1, 12)
+            self.models.append((
+                manufacturer,
+                '{}{}'.format(prefix[:3].upper(), number),
+                '{} {} {} (gen {})'.format(manufacturer, prefix, kind, generation)[:80],
+                round(weight * rng.uniform(0.85, 1.15), 1),
+                price * rng.uniform(0.8, 1.3)))
+        popularity = [1.0 / (rank ** 1.1) for rank in range(1, len(self.models) + 1)]
+        rng.shuffle(popularity)
+        self._model_weights = list(itertools.accumulate(popularity))
+
+        # Which departments may hold each model
+        self.allocations = []           # (model index, department index, maxNumber)
+        self.model_departments = []
+        for index in range(len(self.models)):
+            count = min(len(self.departments), rng.choice([1, 1, 2, 2, 3, 4]))
+            chosen = rng.sample(range(len(self.departments)), count)
+            self.model_departments.append(chosen)
+            for department in chosen:
+                self.allocations.append((index, department, rng.choice([10, 25, 50, 100, 250])))
+
+        # Per-device facts, as compact arrays
+        devices = scale['devices']
+        span = (END_DATE - START_DATE).days
+        self.device_model = array.array('i', bytes(4 * devices))
+        self.device_day = array.array('i', bytes(4 * devices))
+        self.device_holder = array.array('i', bytes(4 * devices))      # 0 = not issued
+        total = self._model_weights[-1]
+        for i in range(devices):
+            model = bisect.bisect_left(self._model_weights, rng.random() * total)
+            model = min(model, len(self.models) - 1)
+            self.device_model[i] = model
+            # More purchases in later years: the power skews towards END_DATE
+            self.device_day[i] = int(span * (rng.random() ** 0.6))
+            if rng.random() < 0.75:
+                department = rng.choice(self.model_departments[model])
+                members = self.department_members[department]
+                if members:
+                    self.device_holder[i] = rng.choice(members)
+
+    ########################################
+    #   Table rows
+    ########################################
+
+    def employees(self):
+        rng = self._random('employees')
+        for empid in range(1, self.scale['employees'] + 1):
+            age_days = int(rng.triangular(20, 66, 34) * 365.25)
+            yield (empid,
+                   '{} {}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+                   '{} {}, {}'.format(rng.randint(1, 400), rng.choice(STREETS), rng.choice(SUBURBS))[:50],
+                   END_DATE - datetime.timedelta(days=age_days),
+                   'password')
+
+    def department_rows(self):
+        rng = self._random('departments')
+        for index, name in enumerate(self.departments):
+            budget = round(rng.lognormvariate(12, 0.6), 2)
+            yield (name, budget, index + 1)
+
+    def offices(self):
+        rng = self._random('offices')
+        for name in self.departments:
+            for level in rng.sample(range(1, 40), rng.randint(1, 3)):
+                yield (name, 'Level {}, {}'.format(level, rng.choice(SUBURBS)))
+
+    def phone_numbers(self):
+        rng = self._random('phones')
+        for empid in range(1, self.scale['employees'] + 1):
+            numbers = {'04{:08d}'.format(rng.randrange(10 ** 8)) for _ in range(rng.choice([1, 1, 1, 2]))}
+            for number in sorted(numbers):
+                yield (empid, number)
+
+    def employee_departments(self):
+        for empid, department, fraction in self.memberships:
+            yield (empid, self.departments[department], fraction)
+
+    def model_rows(self):
+        for manufacturer, model_number, description, weight, _ in self.models:
+            yield (manufacturer, model_number, description, weight)
+
+    def model_allocations(self):
+        for model, department, max_number in self.allocations:
+            manufacturer, model_number = self.models[model][:2]
+            yield (manufacturer, model_number, self.departments[department], max_number)
+
+    def devices(self):
+        rng = self._random('devices')
+        for i in range(self.scale['devices']):
+            manufacturer, model_number, _, _, price = self.models[self.device_model[i]]
+            # Prices drift down a little over a model's life
+            cost = price * rng.uniform(0.85, 1.15) * (1 - 0.00005 * self.device_day[i])
+            yield (i + 1,
+                   '{}{:07d}'.format(manufacturer[:2].upper(), rng.randrange(10 ** 7))[:10],
+                   START_DATE + datetime.timedelta(days=self.device_day[i]),
+                   '{:.2f}'.format(cost),
+                   manufacturer, model_number,
+                   self.device_holder[i] or None)
+
+    def device_used_by(self):
+        rng = self._random('usedby')
+        employees = self.scale['employees']
+        for i in range(self.scale['devices']):
+            holder = self.device_holder[i]
+            users = {holder} if holder else set()
+            # Geometric number of previous users
+            while rng.random() < 0.45:
+                users.add(rng.randint(1, employees))
+            for empid in sorted(users):
+                yield (i + 1, empid)
+
+    def service_rows(self):
+        rng = self._random('services')
+        for number in range(1, self.scale['services'] + 1):
+            yield (self.abn(number),
+                   '{} Repairs {}'.format(rng.choice(LAST_NAMES), number)[:20],
+                   'service{}@repairs.example.com'.format(number),
+                   round(rng.uniform(0, 20000), 2))
+
+    def repairs(self):
+        rng = self._random('repairs')
+        services = self.scale['services']
+        span = (END_DATE - START_DATE).days
+        repair_id = 0
+        for i in range(self.scale['devices']):
+            age = span - self.device_day[i]
+            # Expected repairs grow with the age of the device
+            expected = 0.05 + 0.6 * age / span
+            while rng.random() < expected / (1 + expected):
+                repair_id += 1
+                start = self.device_day[i] + rng.randint(0, max(age, 1))
+                length = int(rng.expovariate(1 / 7.0))
+                price = self.models[self.device_model[i]][4]
+                yield (repair_id,
+                       rng.choice(FAULTS),
+                       START_DATE + datetime.timedelta(days=start),
+                       START_DATE + datetime.timedelta(days=start + length),
+                       '{:.2f}'.format(min(price * 0.6, rng.lognormvariate(4.8, 0.7))),
+                       self.abn(rng.randint(1, services)),
+                       i + 1)
+
+    @staticmethod
+    def abn(number: int) -> int:
+        return 51000000000 + number
+
+    def tables(self):
+        """
+        (table, columns, rows) in foreign key order.
+        """
+        return [
+            ('Employee', ['empid', 'name', 'homeAddress', 'dateOfBirth', 'password'], self.employees()),
+            ('Department', ['name', 'budget', 'manager'], self.department_rows()),
+            ('Offices', ['department', 'location'], self.offices()),
+            ('EmployeePhoneNumbers', ['empID', 'phoneNumber'], self.phone_numbers()),
+            ('EmployeeDepartments', ['empID', 'department', 'fraction'], self.employee_departments()),
+            ('Model', ['manufacturer', 'modelNumber', 'description', 'weight'], self.model_rows()),
+            ('ModelAllocations', ['manufacturer', 'modelNumber', 'department', 'maxNumber'],
+             self.model_allocations()),
+            ('Device', ['deviceID', 'serialNumber', 'purchaseDate', 'purchaseCost',
+                        'manufacturer', 'modelNumber', 'issuedTo'], self.devices()),
+            ('DeviceUsedBy', ['deviceID', 'empID'], self.device_used_by()),
+            ('Service', ['abn', 'serviceName', 'email', 'owed'], self.service_rows()),
+            ('Repair', ['repairID', 'faultReport', 'startDate', 'endDate', 'cost', 'doneBy', 'doneTo'],
+             self.repairs()),
+        ]
+
+
+#####################################################
+#   Loading
+#####################################################
+
+TABLES_IN_ORDER = ['Employee', 'Department', 'Offices', 'EmployeePhoneNumbers',
+                   'EmployeeDepartments', 'Model', 'ModelAllocations', 'Device',
+                   'DeviceUsedBy', 'Service', 'Repair']
+
+
+def load(scale: dict = None, seed: int = 42, load_schema: bool = False, verbose: bool = True) -> dict:
+    """
+    Replace the contents of every table with a generated data set, in one
+    transaction, using COPY. Returns the number of rows per table.
+    """
+    dataset = Dataset(scale or {}, seed)
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+
+    counts = {}
+    try:
+        if load_schema:
+            sqlscript.run_file(connection, SCHEMA_FILE)
+            # Dropping the tables took the migrated indexes and trigger
+            # with them, so forget the migrations and apply them again.
+            cursor = connection.cursor()
+            cursor.execute("DROP TABLE IF EXISTS schema_migrations")
+            cursor.close()
+            connection.commit()
+            migrate.migrate(verbose=verbose)
+        cursor = connection.cursor()
+        # With the cost rollup migrated, skip its per-row trigger during the
+        # load and rebuild it once at the end instead.
+        cursor.execute("""SELECT to_regclass('modelmonthlycost') IS NOT NULL,
+                                 EXISTS (SELECT 1 FROM pg_trigger
+                                          WHERE tgname = 'device_model_monthly_cost')""")
+        rollup, trigger = cursor.fetchall()[0]
+        cursor.execute("TRUNCATE {} CASCADE".format(', '.join(reversed(TABLES_IN_ORDER))))
+        if trigger:
+            cursor.execute("ALTER TABLE Device DISABLE TRIGGER device_model_monthly_cost")
+        for table, columns, rows in dataset.tables():
+            start = time.perf_counter()
+            counts[table] = database.copy_rows(cursor, table, columns, rows)
+            if verbose:
+                print("{:<22} {:>10} rows  {:6.1f}s".format(table, counts[table], time.perf_counter() - start))
+        if trigger:
+            cursor.execute("ALTER TABLE Device ENABLE TRIGGER device_model_monthly_cost")
+        if rollup:
+            cursor.execute("SELECT model_monthly_cost_rebuild()")
+        connection.commit()
+
+        # Fresh statistics so the planner sees the new sizes
+        cursor.execute("ANALYZE")
+        connection.commit()
+        cursor.close()
+    finally:
+        connection.close()
+
+    # Anything cached before the reload is stale now
+    database.clear_caches()
+    return counts
+
+
+def add_scale_arguments(parser):
+    for name, default in DEFAULT_SCALE.items():
+        parser.add_argument('--' + name, type=int, default=default,
+                            help='rows to generate (default {})'.format(default))
+    parser.add_argument('--seed', type=int, default=42, help='same seed, same data')
+    parser.add_argument('--schema', action='store_true',
+                        help='drop and recreate the tables from the schema file (and rerun the migrations) first')
+
+
+def scale_from(args) -> dict:
+    return {name: getattr(args, name) for name in DEFAULT_SCALE}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate and load synthetic company data')
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+    load(scale_from(args), args.seed, args.schema)
+
+
+if __name__ == '__main__':
+    main()
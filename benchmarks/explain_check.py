@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Query plan check for database.py.
+
+Calls every query function in database.py with real ids from the seeded
+data, but swaps the connection for one that runs EXPLAIN (FORMAT JSON)
+instead of each statement. Nothing is executed or written. Any
+sequential scan over a table bigger than --min-rows is reported, and the
+script exits 1 if there were any.
+
+    python3 benchmarks/datagen.py --devices 200000
+    python3 migrate.py
+    python3 benchmarks/explain_check.py
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import database  # noqa: E402
+
+# Statements that set up state rather than query it, run for real
+_PASS_THROUGH = re.compile(r'^\s*(SET|CLOSE|FETCH)\b', re.IGNORECASE)
+_DECLARE = re.compile(r'^\s*DECLARE\s+\S+\s+(NO\s+SCROLL\s+)?CURSOR\s+FOR\s+', re.IGNORECASE)
+
+# Functions that list a whole table on purpose
+EXPECTED_SCANS = {
+    'get_all_models': {'model'},
+    'stream_all_models': {'model'},
+}
+
+
+class _ExplainCursor:
+    def __init__(self, cursor, plans):
+        self._cursor = cursor
+        self._plans = plans
+        self.description = None
+        self.rowcount = 0
+
+    def execute(self, sql, params=(), **kwargs):
+        if _PASS_THROUGH.match(sql) or 'stream' in kwargs:
+            if not re.match(r'^\s*(FETCH|CLOSE)\b', sql, re.IGNORECASE):
+                self._cursor.execute(sql, params)
+            return
+        sql = _DECLARE.sub('', sql)
+        self._cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = self._cursor.fetchall()[0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        self._plans.append((sql, plan[0]['Plan']))
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self._cursor.close()
+
+
+class _ExplainConnection:
+    def __init__(self, connection, plans):
+        self._connection = connection
+        self._plans = plans
+
+    def cursor(self):
+        return _ExplainCursor(self._connection.cursor(), self._plans)
+
+    def prepared(self, sql):
+        # No prepared handle, so the hot lookups are EXPLAINed by the cursor too
+        return None
+
+    def commit(self):
+        # Never commit anything during a plan check
+        self._connection.rollback()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+def seq_scans(plan: dict):
+    """
+    Yield every Seq Scan node in a plan tree.
+    """
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan
+    for child in plan.get('Plans', []):
+        yield from seq_scans(child)
+
+
+def sample_arguments() -> dict:
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    cursor = connection.cursor()
+    cursor.execute("""SELECT D.issuedTo, D.deviceID, D.manufacturer, D.modelNumber, MA.department
+                        FROM Device D NATURAL JOIN ModelAllocations MA
+                       WHERE D.issuedTo IS NOT NULL
+                       ORDER BY D.deviceID LIMIT 1""")
+    empid, device_id, manufacturer, model, department = cursor.fetchall()[0]
+    cursor.execute("SELECT repairID FROM Repair ORDER BY repairID LIMIT 1")
+    repair_id = cursor.fetchall()[0][0]
+    cursor.execute("""SELECT relname, reltuples FROM pg_class
+                       WHERE relkind = 'r' AND relnamespace = 'public'::regnamespace""")
+    sizes = {name.lower(): rows for name, rows in cursor.fetchall()}
+    cursor.close()
+    connection.close()
+    return {
+        'empid': empid, 'device_id': device_id, 'repair_id': repair_id,
+        'manufacturer': manufacturer, 'model': model, 'department': department,
+        'sizes': sizes,
+    }
+
+
+def query_calls(ids: dict) -> list:
+    """
+    (label, function, args) for every query function in database.py.
+    Cached functions are called through __wrapped__ so they really query.
+    """
+    empid, device_id = ids['empid'], ids['device_id']
+    manufacturer, model, department = ids['manufacturer'], ids['model'], ids['department']
+    key = (manufacturer, model)
+    calls = [
+        ('check_login', database.check_login, (empid, 'password')),
+        ('is_manager', database.is_manager, (empid,)),
+        ('get_devices_used_by', database.get_devices_used_by, (empid,)),
+        ('employee_works_in', database.employee_works_in, (empid,)),
+        ('get_employee_dashboard', database.get_employee_dashboard, (empid,)),
+        ('get_issued_devices_for_user', database.get_issued_devices_for_user, (empid,)),
+        ('get_all_models', database.get_all_models, ()),
+        ('get_device_repairs', database.get_device_repairs, (device_id,)),
+        ('get_device_information', database.get_device_information, (device_id,)),
+        ('get_device_model', database.get_device_model, (device_id,)),
+        ('get_repair_details', database.get_repair_details, (ids['repair_id'],)),
+        ('get_department_models', database.get_department_models, (department,)),
+        ('get_employee_department_model_device', database.get_employee_department_model_device,
+         (department, manufacturer, model)),
+        ('get_model_device_assigned', database.get_model_device_assigned, (model, manufacturer, empid)),
+        ('get_unassigned_devices_for_model', database.get_unassigned_devices_for_model, (model, manufacturer)),
+        ('get_employees_in_department', database.get_employees_in_department, (department,)),
+        ('issue_device_to_employee', database.issue_device_to_employee, (empid, device_id)),
+        ('revoke_device_from_employee', database.revoke_device_from_employee, (empid, device_id)),
+        ('used_history', database.used_history, (empid,)),
+        ('show_model_detail', database.show_model_detail, (manufacturer, model)),
+        ('get_model_cost', database.get_model_cost, (manufacturer, model)),
+        ('get_models_page', database.get_models_page, (key, None, 50)),
+        ('get_issued_devices_page', database.get_issued_devices_page, (empid, (device_id,), None, 50)),
+        ('used_history_page', database.used_history_page, (empid, (device_id, empid), None, 50)),
+        ('stream_department_devices', database.stream_department_devices, (department,)),
+        ('stream_device_repairs', database.stream_device_repairs, (device_id,)),
+        ('stream_model_costs', database.stream_model_costs, key),
+        ('stream_all_models', database.stream_all_models, ()),
+        ('stream_used_history', database.stream_used_history, (empid,)),
+        ('stream_model_device_assigned', database.stream_model_device_assigned, (model, manufacturer, empid)),
+        ('stream_employee_department_model_device', database.stream_employee_department_model_device,
+         (department, manufacturer, model)),
+        ('search_models', database.search_models, (model,)),
+        ('search_devices', database.search_devices, ('sn1',)),
+    ]
+    return [(label, getattr(function, '__wrapped__', function), args) for label, function, args in calls]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flag sequential scans in database.py queries')
+    parser.add_argument('--min-rows', type=int, default=1000,
+                        help='ignore seq scans of tables smaller than this (default 1000)')
+    parser.add_argument('--verbose', action='store_true', help='print every plan')
+    args = parser.parse_args()
+
+    ids = sample_arguments()
+    connect = database.database_connect
+    problems = 0
+
+    for label, function, call_args in query_calls(ids):
+        plans = []
+
+        def explaining_connect(*connect_args, **connect_kwargs):
+            connection = connect(*connect_args, **connect_kwargs)
+            return None if connection is None else _ExplainConnection(connection, plans)
+
+        database.database_connect = explaining_connect
+        try:
+            # The functions print 'Error executing function' when the fake
+            # empty result doesn't have the row they expect; that's fine here.
+            with contextlib.redirect_stdout(io.StringIO()):
+                function(*call_args)
+        finally:
+            database.database_connect = connect
+
+        flagged = []
+        for sql, plan in plans:
+            for node in seq_scans(plan):
+                relation = node.get('Relation Name', '?')
+                if relation.lower() in EXPECTED_SCANS.get(label, ()):
+                    continue
+                if ids['sizes'].get(relation.lower(), 0) >= args.min_rows:
+                    flagged.append(relation)
+            if args.verbose:
+                print("--- {}\n{}\n{}".format(label, sql.strip(), json.dumps(plan, indent=2)))
+
+        if not plans:
+            print("{:<40} no statements captured".format(label))
+        elif flagged:
+            problems += 1
+            print("{:<40} SEQ SCAN on {}".format(label, ', '.join(sorted(set(flagged)))))
+        else:
+            print("{:<40} ok".format(label))
+
+    if problems:
+        print("{} function(s) scan large tables sequentially".format(problems))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
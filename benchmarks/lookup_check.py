@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Run the hot lookups of database.py against a real server and check they
+find rows that are known to exist.
+
+These queries are the ones the pool keeps prepared on each of its
+connections (Connection.prepare()); a driver or SQL problem there makes
+them quietly return None (the query functions print the error and carry
+on), so this looks for that explicitly. Each lookup runs twice, so the
+second call goes through the handle the first one prepared.
+benchmarks/pool_check.py covers the reuse itself without a server.
+
+    python3 benchmarks/lookup_check.py
+
+Seed a test database first (benchmarks/bench.py seed). Exits with
+status 1 if a lookup fails.
+"""
+
+import contextlib
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def _first_row(cursor, sql):
+    cursor.execute(sql)
+    rows = cursor.fetchall()
+    if not rows:
+        sys.exit("No rows for: {}\nSeed some data first".format(' '.join(sql.split())))
+    return rows[0]
+
+
+def known_rows() -> dict:
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    cursor = connection.cursor()
+    rows = {
+        'login': _first_row(cursor, "SELECT empid, password FROM Employee ORDER BY empid LIMIT 1"),
+        'manager': _first_row(cursor, """SELECT manager, name FROM Department
+                                          WHERE manager IS NOT NULL ORDER BY name LIMIT 1"""),
+        'repair': _first_row(cursor, "SELECT repairID, doneTo FROM Repair ORDER BY repairID LIMIT 1"),
+        'unassigned': _first_row(cursor, """SELECT modelNumber, manufacturer FROM Device
+                                             WHERE issuedTo IS NULL ORDER BY deviceID LIMIT 1"""),
+    }
+    cursor.close()
+    connection.close()
+    return rows
+
+
+def main():
+    rows = known_rows()
+    empid, password = rows['login']
+    manager, department = rows['manager']
+    repair_id, device_id = rows['repair']
+    model_number, manufacturer = rows['unassigned']
+
+    checks = [
+        ('check_login', database.check_login, (empid, password),
+         lambda result: result is not None and result.empid == empid),
+        ('is_manager', database.is_manager, (manager,),
+         lambda result: result == department),
+        ('get_device_information', database.get_device_information, (device_id,),
+         lambda result: result is not None and result.device_id == device_id),
+        ('get_device_repairs', database.get_device_repairs, (device_id,),
+         lambda result: bool(result) and any(repair.repair_id == repair_id for repair in result)),
+        ('get_repair_details', database.get_repair_details, (repair_id,),
+         lambda result: result is not None and result.repair_id == repair_id),
+        ('get_unassigned_devices_for_model', database.get_unassigned_devices_for_model.__wrapped__,
+         (model_number, manufacturer), lambda result: bool(result)),
+    ]
+
+    failed = 0
+    for name, function, args, ok in checks:
+        for attempt in (1, 2):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                result = function(*args)
+            if not ok(result):
+                failed += 1
+                print("FAIL {} (call {}): {!r} {}".format(name, attempt, result, output.getvalue().strip()))
+                break
+        else:
+            print("ok   {}".format(name))
+
+    database.close_pool()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Check the prepared statements the connection pool keeps, without a
+database: the pool is given stand-in connections that count how often
+each statement is prepared.
+
+    - a second call of a lookup reuses the handle prepared on the
+      connection by the first
+    - a connection the pool opens to replace a discarded or unhealthy
+      one prepares its statements again
+    - %s parameters reach pg8000's Connection.prepare() as :p1, :p2, ...
+
+    python3 benchmarks/pool_check.py
+
+Exits with status 1 if a check fails.
+"""
+
+import itertools
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backends  # noqa: E402
+from pool import ConnectionPool  # noqa: E402
+
+SQL = "SELECT name FROM Department WHERE manager = %s AND name LIKE 'a%%'"
+
+
+class _Statement:
+    cols = [{'name': 'name'}]
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.runs = []
+
+    def run(self, **params):
+        self.runs.append(params)
+        return (['Department 1'],)
+
+
+class _Connection:
+    """
+    Stands in for a pg8000 connection.
+    """
+    numbers = itertools.count(1)
+
+    def __init__(self):
+        self.number = next(self.numbers)
+        self.prepared = []
+        self.healthy = True
+
+    def prepare(self, sql):
+        statement = _Statement(sql)
+        self.prepared.append(statement)
+        return statement
+
+    def cursor(self):
+        if not self.healthy:
+            raise OSError("connection lost")
+        return _Cursor()
+
+    def rollback(self):
+        if not self.healthy:
+            raise OSError("connection lost")
+
+    def close(self):
+        pass
+
+
+class _Cursor:
+    def execute(self, sql, params=()):
+        pass
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+def main():
+    problems = []
+
+    def check(ok, problem):
+        print("{} {}".format('ok  ' if ok else 'FAIL', problem))
+        if not ok:
+            problems.append(problem)
+
+    pool = ConnectionPool(_Connection, min_size=0, max_size=1, health_check_after=0.0,
+                          prepare=backends._prepare)
+
+    connection = pool.get()
+    raw = connection.raw
+    first = connection.prepared(SQL)
+    rows = first.run((1,))
+    connection.close()
+    connection = pool.get()
+    second = connection.prepared(SQL)
+    connection.close()
+    check(len(raw.prepared) == 1, "the lookup is prepared once per connection")
+    check(first is second, "a second call reuses the prepared handle")
+    check(raw.prepared[0].sql == "SELECT name FROM Department WHERE manager = :p1 AND name LIKE 'a%'",
+          "%s parameters are passed to prepare() as :p1")
+    check(raw.prepared[0].runs == [{'p1': 1}] and rows == [['Department 1']]
+          and first.description == [('name',)], "the handle runs with its parameters")
+
+    # The connection drops while checked out: the pool opens a new one
+    connection = pool.get()
+    connection.discard()
+    connection = pool.get()
+    replacement = connection.raw
+    third = connection.prepared(SQL)
+    connection.close()
+    check(replacement is not raw and len(replacement.prepared) == 1 and third is not first,
+          "a reconnected connection prepares the lookup again")
+
+    # The connection dies while idle: the health check replaces it
+    replacement.healthy = False
+    connection = pool.get()
+    check(connection.raw is not replacement, "an unhealthy connection is replaced")
+    fourth = connection.prepared(SQL)
+    connection.close()
+    check(fourth is not third and len(pool._statements) == 1,
+          "statements of a dropped connection are forgotten")
+
+    check(pool.stats()['prepared'] == 3, "the pool counts what it prepared")
+    pool.close()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Check that the shared caches keep read-your-writes with a lagging read
+replica, without needing a replica: two SQLite files stand in for the
+primary and a replica that never catches up.
+
+    - a request that reads from the replica soon after a write does not
+      put what it read into the caches
+    - the writer's next request, pinned to the primary, sees its write
+      even if a replica read got into the cache first
+    - once read_your_writes has passed, replica reads are cached again
+
+    python3 benchmarks/replica_cache_check.py
+
+Exits with status 1 if a check fails.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WINDOW = 0.5        # read_your_writes, seconds
+
+directory = tempfile.mkdtemp(prefix='dm-replica-cache-')
+os.environ.update({
+    'DM_DATABASE_BACKEND': 'sqlite',
+    'DM_DATABASE_PATH': os.path.join(directory, 'primary.db'),
+    'DM_REPLICAS_HOSTS': 'lagging-replica',
+    'DM_REPLICAS_READ_YOUR_WRITES': str(WINDOW),
+})
+
+import backends  # noqa: E402
+import database  # noqa: E402
+from settings import get_settings  # noqa: E402
+
+DEPARTMENT = 'Research'
+
+
+def seed():
+    connection = database.database_connect()
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO Employee (empid, name, password) VALUES (1, 'Manager', 'password')")
+    cursor.execute("INSERT INTO Department (name, budget, manager) VALUES (%s, 0, 1)", (DEPARTMENT,))
+    cursor.execute("INSERT INTO Model (manufacturer, modelNumber, description, weight) "
+                   "VALUES ('Acme', 'OLD1', 'old', 1.0)")
+    cursor.execute("INSERT INTO ModelAllocations (manufacturer, modelNumber, department, maxNumber) "
+                   "VALUES ('Acme', 'OLD1', %s, 1)", (DEPARTMENT,))
+    connection.commit()
+    cursor.close()
+    connection.close()
+
+
+def lag_reads():
+    """
+    Send every read_only connection to a snapshot of the primary taken
+    now, which never sees a later write.
+    """
+    primary = database.get_backend()
+    snapshot = os.path.join(directory, 'replica.db')
+    shutil.copyfile(primary.path, snapshot)
+    replica = backends.SQLiteBackend(get_settings()._replace(
+        database=get_settings().database._replace(path=snapshot)))
+    connect = primary.connect
+
+    def routed_connect(readonly=False):
+        return replica.connect() if readonly else connect()
+
+    primary.connect = routed_connect
+
+
+def department_models(pinned: bool) -> set:
+    token = database.start_routing(primary=pinned)
+    try:
+        return {row[1] for row in database.get_department_models(DEPARTMENT)}
+    finally:
+        database.finish_routing(token)
+
+
+def main():
+    problems = []
+
+    def check(ok, problem):
+        print("{} {}".format('ok  ' if ok else 'FAIL', problem))
+        if not ok:
+            problems.append(problem)
+
+    seed()
+    lag_reads()
+    key = database.get_department_models.cache_key(DEPARTMENT)
+
+    # The writer adds a model; its later requests are pinned to the primary
+    token = database.start_routing()
+    created, error = database.add_model(DEPARTMENT, 'Acme', 'NEW1', 'new', '1.0', 2)
+    wrote = database.finish_routing(token)
+    check(created and wrote, "add_model wrote through the primary")
+
+    # Someone else reads from the lagging replica straight away
+    other = department_models(pinned=False)
+    check('NEW1' not in other, "the replica lags (the simulation works)")
+    check(database.reference_cache.get(key) is None,
+          "a replica read inside the write window is not cached")
+
+    # Even with the stale list in the cache, the writer reads the primary
+    database.reference_cache.set(key, [('Acme', 'OLD1', 1)])
+    check('NEW1' in department_models(pinned=True), "the writer's next read sees its write")
+    check('NEW1' in {row[1] for row in database.reference_cache.get(key) or []},
+          "the primary read refreshed the cache")
+
+    database.reference_cache.clear()
+    time.sleep(WINDOW)
+    department_models(pinned=False)
+    check(database.reference_cache.get(key) is not None,
+          "replica reads are cached again after read_your_writes")
+
+    database.close_pool()
+    shutil.rmtree(directory, ignore_errors=True)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
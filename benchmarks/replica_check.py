@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Check that read replica routing sends each query where it should.
+
+Every connection is asked which server it is on (inet_server_port() and
+pg_is_in_recovery()), then:
+    - @read_only calls are spread over the [REPLICAS] hosts
+    - @writes calls, and reads after a write in the same request, use
+      the primary
+    - a request pinned to the primary (read-your-writes) never reads
+      from a replica
+
+    DM_REPLICAS_HOSTS=localhost:5433 python3 benchmarks/replica_check.py --reads 50
+
+See the README for running a primary and a replica locally.
+Exits with status 1 if a query went to the wrong server.
+"""
+
+import argparse
+import collections
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from settings import get_settings  # noqa: E402
+
+
+def _server():
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    cursor = connection.cursor()
+    cursor.execute("SELECT inet_server_port(), pg_is_in_recovery()")
+    port, in_recovery = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    return port, in_recovery
+
+
+@database.read_only
+def read_server():
+    return _server()
+
+
+@database.writes
+def write_server():
+    return _server()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--reads', type=int, default=50, help="read_only calls to spread")
+    args = parser.parse_args()
+
+    if not get_settings().replicas.hosts:
+        sys.exit("No [REPLICAS] hosts configured (set DM_REPLICAS_HOSTS)")
+    problems = []
+
+    primary_port, in_recovery = write_server()
+    if in_recovery:
+        problems.append("a write went to a replica (port {})".format(primary_port))
+
+    reads = collections.Counter(read_server() for _ in range(args.reads))
+    print("reads per server (port, replica?):")
+    for (port, replica), count in sorted(reads.items()):
+        print("    {:>5} {:<5} {}".format(port, str(replica), count))
+    if not any(replica for _, replica in reads):
+        problems.append("no read went to a replica")
+
+    token = database.start_routing()
+    write_server()
+    after_write = read_server()
+    if not database.finish_routing(token):
+        problems.append("the write wasn't recorded on the request")
+    if after_write[1]:
+        problems.append("a read after a write in the same request went to a replica")
+
+    token = database.start_routing(primary=True)
+    pinned = collections.Counter(read_server() for _ in range(10))
+    database.finish_routing(token)
+    if any(replica for _, replica in pinned):
+        problems.append("a request pinned to the primary read from a replica")
+
+    print(database.get_pool_stats().get('replicas'))
+    database.close_pool()
+    for problem in problems:
+        print("FAIL:", problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
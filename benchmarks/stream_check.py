@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Check that the streamed routes hand their connection back to the pool
+even when the response body is never read: a HEAD request, or a client
+that hangs up before the first chunk.
+
+Each export route and streamed page is requested through Flask's test
+client, logged in as a department manager, and the connections still
+checked out are counted afterwards.
+
+    python3 benchmarks/stream_check.py
+
+Seed a test database first (benchmarks/bench.py seed). Exits with
+status 1 if a request left a connection checked out.
+"""
+
+import os
+import sys
+import threading
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+_lock = threading.Lock()
+_checked_out = set()
+
+
+class _CountedConnection:
+    def __init__(self, connection):
+        self._connection = connection
+        with _lock:
+            _checked_out.add(id(self))
+
+    def close(self):
+        with _lock:
+            _checked_out.discard(id(self))
+        self._connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def count_connections():
+    """
+    Wrap database.database_connect so checked out connections are counted.
+    """
+    connect = database.database_connect
+
+    def counting_connect(*args, **kwargs):
+        connection = connect(*args, **kwargs)
+        return None if connection is None else _CountedConnection(connection)
+
+    database.database_connect = counting_connect
+
+
+def checked_out() -> int:
+    with _lock:
+        return len(_checked_out)
+
+
+def sample() -> dict:
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    cursor = connection.cursor()
+    cursor.execute("""SELECT E.empid, E.password, D.name
+                        FROM Department D JOIN Employee E ON (D.manager = E.empid)
+                       ORDER BY D.name LIMIT 1""")
+    manager = cursor.fetchall()
+    cursor.execute("SELECT doneTo FROM Repair ORDER BY repairID LIMIT 1")
+    repair = cursor.fetchall()
+    cursor.execute("""SELECT D.manufacturer, D.modelNumber, D.issuedTo
+                        FROM Device D NATURAL JOIN ModelAllocations MA
+                       WHERE D.issuedTo IS NOT NULL AND MA.department = %s
+                       ORDER BY D.deviceID LIMIT 1""", (manager[0][2] if manager else None,))
+    device = cursor.fetchall()
+    cursor.close()
+    connection.close()
+    if not (manager and repair and device):
+        sys.exit("Seed some data first")
+    return {'manager': manager[0], 'device_id': repair[0][0], 'model': device[0]}
+
+
+def main():
+    ids = sample()
+    count_connections()
+    from routes import app
+
+    empid, password, department = ids['manager']
+    manufacturer, model, holder = ids['model']
+    query = urllib.parse.urlencode({'department': department, 'manufacturer': manufacturer, 'model': model})
+    paths = [
+        '/export/devices/{}'.format(department),
+        '/export/repairs/{}'.format(ids['device_id']),
+        '/export/modelcost/{},{}'.format(model, manufacturer),
+        # streamed pages
+        '/departmentmodels?' + query,
+        '/departmentmodels?{}&empid={}'.format(query, holder),
+    ]
+
+    client = app.test_client()
+    client.post('/login', data={'id': str(empid), 'password': password})
+    problems = []
+    for path in paths:
+        for how in ('HEAD', 'unread GET'):
+            if how == 'HEAD':
+                response = client.head(path)
+            else:
+                response = client.get(path, buffered=False)
+            response.close()
+            left = checked_out()
+            print("{} {:<10} {:<50} {} -> {} connection(s) checked out".format(
+                'ok  ' if left == 0 else 'FAIL', how, path, response.status_code, left))
+            if left:
+                problems.append(path)
+                with _lock:
+                    _checked_out.clear()
+
+    database.close_pool()
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for issue_device_to_employee.
+
+Many worker threads race to issue the same set of free devices, each to
+a different employee. After every round we check that each device was
+won by exactly one worker and that the database agrees with the winner,
+then revoke everything so the next round starts from the same state.
+
+    python3 benchmarks/stress_issue.py --workers 32 --devices 10 --rounds 20
+
+Run it against a test database (see config.ini / DM_DATABASE_* settings):
+the devices used are put back the way they were when it finishes.
+Exits with status 1 if a device was ever issued twice.
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+def pick_targets(devices: int, workers: int):
+    """
+    Free devices to fight over and one employee per worker.
+    """
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    cursor = connection.cursor()
+    cursor.execute("""SELECT deviceID FROM Device
+                       WHERE issuedTo IS NULL
+                       ORDER BY deviceID LIMIT %s""", (devices,))
+    device_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT empid FROM Employee ORDER BY empid LIMIT %s", (workers,))
+    employee_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    connection.close()
+
+    if not device_ids:
+        sys.exit("No unassigned devices to race for - seed some data first")
+    if len(employee_ids) < 2:
+        sys.exit("Need at least two employees to race")
+    return device_ids, employee_ids
+
+
+def current_holders(device_ids):
+    connection = database.database_connect()
+    cursor = connection.cursor()
+    cursor.execute("SELECT deviceID, issuedTo FROM Device WHERE deviceID = ANY(%s)",
+                   (list(device_ids),))
+    holders = dict(cursor.fetchall())
+    cursor.close()
+    connection.close()
+    return holders
+
+
+def run_round(device_ids, employee_ids, workers):
+    """
+    One race. Returns {device_id: [employees that were told they won]}.
+    """
+    winners = collections.defaultdict(list)
+    errors = []
+    lock = threading.Lock()
+    start = threading.Barrier(workers)
+
+    def worker(employee_id):
+        order = list(device_ids)
+        random.shuffle(order)
+        start.wait()
+        for device_id in order:
+            result = database.issue_device_to_employee(employee_id, device_id)
+            with lock:
+                if result is None:
+                    errors.append(device_id)
+                elif result[0]:
+                    winners[device_id].append(employee_id)
+
+    threads = [threading.Thread(target=worker, args=(employee_ids[i % len(employee_ids)],))
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return winners, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    device_ids, employee_ids = pick_targets(args.devices, args.workers)
+    # Distinct employees per worker, so 'who won' is unambiguous
+    workers = min(args.workers, len(employee_ids))
+    print("Racing {} workers for {} devices, {} rounds".format(workers, len(device_ids), args.rounds))
+
+    failures = 0
+    try:
+        for round_number in range(1, args.rounds + 1):
+            winners, errors = run_round(device_ids, employee_ids, workers)
+            holders = current_holders(device_ids)
+            for device_id in device_ids:
+                claimed = winners.get(device_id, [])
+                if len(claimed) != 1 or holders.get(device_id) != claimed[0]:
+                    failures += 1
+                    print("Round {}: device {} claimed by {}, held by {}".format(
+                        round_number, device_id, claimed, holders.get(device_id)))
+            if errors:
+                print("Round {}: {} database errors".format(round_number, len(errors)))
+            database.revoke_devices_from_employees(
+                [(holder, device_id) for device_id, holder in holders.items() if holder is not None])
+    finally:
+        # Whatever happened, leave the devices free again
+        holders = current_holders(device_ids)
+        database.revoke_devices_from_employees(
+            [(holder, device_id) for device_id, holder in holders.items() if holder is not None])
+
+    print(database.get_pool_stats())
+    if failures:
+        print("FAILED: {} double or lost issues".format(failures))
+        sys.exit(1)
+    print("OK: every device was issued exactly once per round")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement in-process cache.
+A small thread-safe LRU cache with a time-to-live, used for reference data
+(models, model allocations) that only changes through the webapp itself.
+"""
+
+import collections
+import functools
+import inspect
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries also expire after `ttl` seconds.
+    Keys are tuples; by convention the first element names the lookup
+    (e.g. ('model_detail', 'Apple', 'A1234')) so a whole lookup can be
+    dropped with invalidate_prefix().
+
+    cached() consults two optional callables: while `bypass()` is true it
+    skips the lookup and stores what the function returns; `may_fill()`
+    decides whether any other result may be stored.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, name: str, ttl: float = 60.0, max_entries: int = 1024,
+                 bypass=None, may_fill=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.may_fill = may_fill
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # key -> (expires, value)
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    def get(self, key, default=None):
+        """
+        Return the cached value, or `default` if it is missing or stale.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is self._MISSING:
+                self._stats['misses'] += 1
+                return default
+            expires, value = entry
+            if expires <= now:
+                del self._entries[key]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, key):
+        """
+        Drop a single entry.
+        """
+        with self._lock:
+            if self._entries.pop(key, self._MISSING) is not self._MISSING:
+                self._stats['invalidations'] += 1
+
+    def invalidate_prefix(self, *prefix):
+        """
+        Drop every entry whose key starts with `prefix`.
+        """
+        size = len(prefix)
+        with self._lock:
+            stale = [key for key in self._entries if key[:size] == prefix]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidations'] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._stats['invalidations'] += len(self._entries)
+            self._entries.clear()
+
+    def configure(self, ttl: float, max_entries: int):
+        """
+        Apply new limits (after a settings reload); drops everything cached.
+        """
+        with self._lock:
+            self.ttl = ttl
+            self.max_entries = max_entries
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+            stats['ttl'] = self.ttl
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def cached(cache: TTLCache, name: str):
+    """
+    Read-through decorator: the result of func(*args) is stored under
+    (name, *args). None means the query failed, so it is never cached.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (name,) + tuple(bound.arguments.values())
+            if cache.bypass is not None and cache.bypass():
+                value = func(*args, **kwargs)
+                if value is not None:
+                    cache.set(key, value)
+                return value
+            value = cache.get(key, TTLCache._MISSING)
+            if value is not TTLCache._MISSING:
+                return value
+            value = func(*args, **kwargs)
+            if value is not None and (cache.may_fill is None or cache.may_fill()):
+                cache.set(key, value)
+            return value
+
+        wrapper.cache_key = lambda *args: (name,) + args
+        return wrapper
+    return decorator
@@ -4,12 +4,24 @@ DeviceManagement Database module.
 Contains all interactions between the webapp and the queries to the database.
 """
 
-import configparser
+import contextvars
 import datetime
+import functools
+import itertools
+import json
+import sys
+import threading
+import time
 from typing import List, Optional
 
 import setup_vendor_path  # noqa
-import pg8000
+
+from backends import create_backend
+from cache import TTLCache, cached
+from metrics import instrumented, query_failed, track_connection
+from rows import Device, Employee, Model, Repair, Service
+from search import PrefixIndex, like_prefix, normalise
+from settings import get_settings, on_reload
 
 ################################################################################
 #   Welcome to the database file, where all the query magic happens.
@@ -35,27 +47,75 @@ import pg8000
 #       (unless the exception is potatoing))
 #####################################################
 
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Returns the process wide storage backend (see backends.py), creating
+    it on first use from [DATABASE] backend. For Postgres it holds the
+    connection pool sized by the [POOL] settings.
+    """
+    global _backend
+    if _backend is not None:
+        return _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend(get_settings())
+    return _backend
+
+
+@on_reload
+def _reset_backend(new_settings):
+    """
+    Drop the backend after a settings reload so the next query reconnects
+    with the new details.
+    """
+    global _backend
+    with _backend_lock:
+        old_backend, _backend = _backend, None
+    if old_backend is not None:
+        old_backend.close()
+
+
+def close_pool():
+    """
+    Close the backend's connections (on server/worker shutdown).
+    """
+    _reset_backend(None)
+
+
+def init_worker():
+    """
+    Give a freshly forked server worker its own connections.
+    """
+    get_backend().after_fork()
+
+
+def get_pool_stats() -> dict:
+    """
+    Current connection statistics (pool size, idle, waits, timeouts...).
+    """
+    return get_backend().stats()
+
+
 def database_connect():
     """
-    Connects to the database using the connection string.
+    Borrows a connection from the connection pool.
     If 'None' was returned it means there was an issue connecting to
     the database. It would be wise to handle this ;)
-    """
-    # Read the config file
-    config = configparser.ConfigParser()
-    config.read('config.ini')
-    if 'database' not in config['DATABASE']:
-        config['DATABASE']['database'] = config['DATABASE']['user']
 
-    # Create a connection to the database
+    Inside a @read_only function the connection may come from a read
+    replica (see Read Replicas below).
+
+    Calling close() on the returned connection hands it back to the pool.
+    """
     connection = None
+    backend = get_backend()
     try:
-        # Parses the config file and connects using the connect string
-        connection = pg8000.connect(database=config['DATABASE']['database'],
-                                    user=config['DATABASE']['user'],
-                                    password=config['DATABASE']['password'],
-                                    host=config['DATABASE']['host'])
-    except pg8000.OperationalError as operation_error:
+        connection = backend.connect(readonly=_use_replica())
+    except backend.connect_errors as operation_error:
         print("""Error, you haven't updated your config.ini or you have a bad
         connection, please try again. (Update your files first, then check
         internet connection)
@@ -63,8 +123,200 @@ def database_connect():
         print(operation_error)
         return None
 
-    # return the connection to use
-    return connection
+    # return the connection to use (timed when a query function asked for it)
+    return track_connection(connection)
+
+
+def _query_failed():
+    """
+    Report the exception being handled in a query function: counted as a
+    failure in the metrics and printed with its message.
+    """
+    query_failed()
+    print("Error executing function: {}".format(sys.exc_info()[1]))
+
+
+#####################################################
+#   Read Replicas
+#   Functions marked @read_only may be served by a
+#   [REPLICAS] host; @writes functions, and everything
+#   after a write in the same request, use the primary.
+#####################################################
+
+_route = contextvars.ContextVar('dm_route', default=None)
+_routing = contextvars.ContextVar('dm_routing', default=None)
+_last_write = 0.0       # time.monotonic() of the last @writes call in this process
+
+
+class Routing:
+    """
+    Per-request routing state. `primary` pins every query to the primary
+    (read-your-writes); `wrote` records that the request wrote something.
+    """
+
+    __slots__ = ('primary', 'wrote')
+
+    def __init__(self, primary: bool = False):
+        self.primary = primary
+        self.wrote = False
+
+
+def start_routing(primary: bool = False):
+    """
+    Start routing a request, on the primary only if `primary`.
+    Returns the token for finish_routing.
+    """
+    return _routing.set(Routing(primary))
+
+
+def routing_wrote() -> bool:
+    """
+    Whether the request being routed has written anything so far.
+    """
+    routing = _routing.get()
+    return routing is not None and routing.wrote
+
+
+def finish_routing(token) -> bool:
+    """
+    Stop routing the request started with `token`; returns whether it wrote.
+    """
+    routing = _routing.get()
+    _routing.reset(token)
+    return routing is not None and routing.wrote
+
+
+def _use_replica() -> bool:
+    if _route.get() != 'replica':
+        return False
+    routing = _routing.get()
+    return routing is None or not routing.primary
+
+
+def _reads_primary() -> bool:
+    """
+    Whether reads made now go to the primary: inside a @writes function,
+    or in a request pinned to the primary after a write.
+    """
+    if _route.get() == 'primary':
+        return True
+    routing = _routing.get()
+    return routing is not None and routing.primary
+
+
+def _skip_cache() -> bool:
+    """
+    Whether cached lookups should read through to the database: with
+    replicas, a read pinned to the primary must not be answered from a
+    cache another request may have filled from a lagging replica.
+    """
+    return bool(get_settings().replicas.hosts) and _reads_primary()
+
+
+def _may_cache_read() -> bool:
+    """
+    Whether a read may fill the shared caches. Within read_your_writes
+    seconds of a write a replica may still return what the write
+    changed, so only primary reads do then.
+    """
+    config = get_settings().replicas
+    if not config.hosts or _reads_primary():
+        return True
+    return time.monotonic() - _last_write >= config.read_your_writes
+
+
+def _wrote():
+    global _last_write
+    _last_write = time.monotonic()
+
+
+def _routed(target: str):
+    # The outermost routed call decides, so reads made by a write function
+    # stay on the primary.
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if target == 'primary':
+                _wrote()
+                routing = _routing.get()
+                if routing is not None:
+                    routing.primary = routing.wrote = True
+            if _route.get() is not None:
+                return function(*args, **kwargs)
+            token = _route.set(target)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _route.reset(token)
+                if target == 'primary':
+                    # the lag window runs from the commit, not the start
+                    _wrote()
+        return wrapper
+    return decorate
+
+
+read_only = _routed('replica')
+writes = _routed('primary')
+
+#####################################################
+#   Prepared Statements
+#   The pool keeps the hot lookups prepared on each of
+#   its connections (pool.py), so Postgres parses and
+#   plans them once per connection rather than on
+#   every call; SQLite caches its compiled statements
+#   by itself.
+#####################################################
+
+def _execute_prepared(connection, cursor, sql: str, params: tuple):
+    """
+    Run `sql` (%s placeholders) as a prepared statement on `connection`.
+    Returns the cursor-like result to fetch the rows and description from.
+    """
+    return get_backend().execute_prepared(connection, cursor, sql, params)
+
+#####################################################
+#   Reference Data Cache
+#   Model and ModelAllocations only change through
+#   add_model, so lookups on them are cached here.
+#   Reads pinned to the primary skip both caches (and
+#   refresh them), so a cached replica read never
+#   hides a user's own write.
+#####################################################
+
+reference_cache = TTLCache('reference',
+                           ttl=get_settings().cache.ttl,
+                           max_entries=get_settings().cache.max_entries,
+                           bypass=_skip_cache, may_fill=_may_cache_read)
+
+# Device and employee lists behind the issue page's dropdowns. These do
+# change (issue/revoke), so they are kept only briefly and dropped by
+# every issue or revoke made through this process.
+lookup_cache = TTLCache('lookup',
+                        ttl=get_settings().cache.lookup_ttl,
+                        max_entries=get_settings().cache.max_entries,
+                        bypass=_skip_cache, may_fill=_may_cache_read)
+
+
+@on_reload
+def _reset_caches(new_settings):
+    reference_cache.configure(new_settings.cache.ttl, new_settings.cache.max_entries)
+    lookup_cache.configure(new_settings.cache.lookup_ttl, new_settings.cache.max_entries)
+
+
+def clear_caches():
+    """
+    Drop everything cached, e.g. after the tables were reloaded or
+    migrated outside the query functions.
+    """
+    reference_cache.clear()
+    lookup_cache.clear()
+
+
+def get_cache_stats() -> dict:
+    """
+    Hit/miss counters for the in-process caches.
+    """
+    return {cache.name: cache.stats() for cache in (reference_cache, lookup_cache)}
 
 #####################################################
 #   Mutiple Lists Into One
@@ -79,7 +331,9 @@ def combine(muti_list):
 #   Login
 #####################################################
 
-def check_login(employee_id, password: str) -> Optional[dict]:
+@instrumented
+@read_only
+def check_login(employee_id, password: str) -> Optional[Employee]:
     """
     Check that the users information exists in the database.
         - True => return the user data
@@ -97,11 +351,14 @@ def check_login(employee_id, password: str) -> Optional[dict]:
         sql = """SELECT *
                  FROM employee
                  WHERE empid=%s AND password=%s"""
-        cursor.execute(sql, (employee_id,password))
-        employee_info = cursor.fetchall()[0] # first row
+        result = _execute_prepared(connection, cursor, sql, (employee_id,password))
+        rows = result.fetchall()
+        # no row means a wrong id/password, which isn't a query failure
+        if rows:
+            employee_info = Employee.from_cursor(result, rows)[0] # first row
     except:
         # If error exists, print error and return NULL
-        print("Error executing function")
+        _query_failed()
 
     cursor.close() # Close the cursor
     connection.close() # Close the db connection
@@ -112,13 +369,7 @@ def check_login(employee_id, password: str) -> Optional[dict]:
         return None
     # When successfully check the password is correct,
     # return the detaied information of this employee
-    user = {
-        'empid': employee_info[0],
-        'name': employee_info[1],
-        'homeAddress': employee_info[2],
-        'dateOfBirth': employee_info[3],
-    }
-    return user
+    return employee_info
 
 
 #####################################################
@@ -126,6 +377,8 @@ def check_login(employee_id, password: str) -> Optional[dict]:
 #   Is Manager?
 #####################################################
 
+@instrumented
+@read_only
 def is_manager(employee_id: int) -> Optional[str]:
     """
     Get the department the employee is a manager of, if any.
@@ -142,10 +395,11 @@ def is_manager(employee_id: int) -> Optional[str]:
         sql = """SELECT name
                  FROM Department
                  WHERE manager=%s"""
-        cursor.execute(sql, (employee_id,))
-        manager_of = cursor.fetchall()[0]
+        rows = _execute_prepared(connection, cursor, sql, (employee_id,)).fetchall()
+        if rows:
+            manager_of = rows[0]
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -161,6 +415,8 @@ def is_manager(employee_id: int) -> Optional[str]:
 #   Get My Used Devices
 #####################################################
 
+@instrumented
+@read_only
 def get_devices_used_by(employee_id: int) -> list:
     """
     Get a list of all the devices used by the employee.
@@ -179,7 +435,7 @@ def get_devices_used_by(employee_id: int) -> list:
         cursor.execute(sql, (employee_id,))
         devices = cursor.fetchall() # fetch all rows
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -194,6 +450,8 @@ def get_devices_used_by(employee_id: int) -> list:
 #   Get departments employee works in
 #####################################################
 
+@instrumented
+@read_only
 def employee_works_in(employee_id: int) -> List[str]:
     """
     Return the departments that the employee works in.
@@ -211,7 +469,7 @@ def employee_works_in(employee_id: int) -> List[str]:
         cursor.execute(sql, (employee_id,))
         departments = cursor.fetchall()
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -227,6 +485,8 @@ def employee_works_in(employee_id: int) -> List[str]:
 #   Get My Issued Devices
 #####################################################
 
+@instrumented
+@read_only
 def get_issued_devices_for_user(employee_id: int) -> list:
 
     """
@@ -246,7 +506,7 @@ def get_issued_devices_for_user(employee_id: int) -> list:
         cursor.execute(sql, (employee_id,))
         devices = cursor.fetchall()
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -258,35 +518,102 @@ def get_issued_devices_for_user(employee_id: int) -> list:
 
 
 #####################################################
-#   Query (b)
-#   Get All Models
+#   Employee Dashboard
+#   (everything the index page needs, one round trip)
 #####################################################
 
-def get_all_models() -> list:
+@instrumented
+@read_only
+def get_employee_dashboard(employee_id: int) -> Optional[dict]:
     """
-    Get all models available.
+    Get the employee record, the department they manage, the departments
+    they work in, the devices they have used and whether they have any
+    devices issued - all in a single statement.
+    Returns None if the employee doesn't exist.
     """
-    models = None
     connection = database_connect()
     if(connection is None):
         return None
     cursor = connection.cursor()
+    dashboard = None
     try:
-        sql = """SELECT manufacturer, description, modelnumber, weight
-                            FROM Model"""
-        cursor.execute(sql)
-        models = cursor.fetchall()
+        sql = """SELECT E.empid, E.name, E.homeAddress, E.dateOfBirth,
+                        (SELECT name
+                           FROM Department
+                          WHERE manager = E.empid) AS manager_of,
+                        ARRAY(SELECT department
+                                FROM EmployeeDepartments
+                               WHERE empID = E.empid) AS works_in,
+                        COALESCE((SELECT json_agg(json_build_array(deviceID, manufacturer, modelNumber))
+                                    FROM DeviceUsedBy NATURAL JOIN Device
+                                   WHERE empID = E.empid), '[]'::json) AS used_by,
+                        EXISTS(SELECT 1
+                                 FROM Device
+                                WHERE issuedTo = E.empid) AS has_devices
+                 FROM Employee E
+                 WHERE E.empid = %s"""
+        if get_backend().dialect == 'sqlite':
+            # No arrays there; the lists come back as JSON text instead
+            sql = _SQLITE_DASHBOARD
+        cursor.execute(sql, (employee_id,))
+        rows = cursor.fetchall()
+        if rows:
+            dashboard = rows[0]
     except:
-        print("Error executing function")
-
+        _query_failed()
 
     cursor.close()
     connection.close()
 
+    if (dashboard is None):
+        return None
+
+    works_in, used_by = dashboard[5], dashboard[6]
+    if isinstance(works_in, str):
+        works_in, used_by = json.loads(works_in), json.loads(used_by)
+    return {
+        'user': Employee(*dashboard[:4]),
+        'manager_of': dashboard[4],
+        'works_in': list(works_in or []),
+        'used_by': used_by or [],
+        'has_devices': bool(dashboard[7]),
+    }
+
+
+_SQLITE_DASHBOARD = """SELECT E.empid, E.name, E.homeAddress, E.dateOfBirth,
+                              (SELECT name
+                                 FROM Department
+                                WHERE manager = E.empid) AS manager_of,
+                              (SELECT json_group_array(department)
+                                 FROM EmployeeDepartments
+                                WHERE empID = E.empid) AS works_in,
+                              (SELECT json_group_array(json_array(deviceID, manufacturer, modelNumber))
+                                 FROM DeviceUsedBy NATURAL JOIN Device
+                                WHERE empID = E.empid) AS used_by,
+                              EXISTS(SELECT 1
+                                       FROM Device
+                                      WHERE issuedTo = E.empid) AS has_devices
+                         FROM Employee E
+                        WHERE E.empid = %s"""
+
+
+#####################################################
+#   Query (b)
+#   Get All Models
+#####################################################
+
+@cached(reference_cache, 'all_models')
+@instrumented
+@read_only
+def get_all_models() -> list:
+    """
+    Get all models available.
+    """
+    models = stream_all_models()
     if (models is None):
-        return []
+        return None
 
-    return models
+    return list(models)
 
 
 #####################################################
@@ -294,6 +621,8 @@ def get_all_models() -> list:
 #   Get Device Repairs
 #####################################################
 
+@instrumented
+@read_only
 def get_device_repairs(device_id: int) -> list:
     """
     Get all repairs made to a device.
@@ -309,10 +638,10 @@ def get_device_repairs(device_id: int) -> list:
         sql = """SELECT repairid, faultreport, startdate, enddate, cost
                             FROM Repair
                             WHERE doneTo = %s"""
-        cursor.execute(sql, [device_id])
-        repairs = cursor.fetchall()
+        result = _execute_prepared(connection, cursor, sql, (device_id,))
+        repairs = Repair.from_cursor(result, result.fetchall())
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -328,7 +657,9 @@ def get_device_repairs(device_id: int) -> list:
 #   Get Device Info
 #####################################################
 
-def get_device_information(device_id: int) -> Optional[dict]:
+@instrumented
+@read_only
+def get_device_information(device_id: int) -> Optional[Device]:
     """
     Get related device information in detail.
     """
@@ -342,10 +673,12 @@ def get_device_information(device_id: int) -> Optional[dict]:
         sql = """SELECT deviceID, serialNumber, purchaseDate, purchaseCost, manufacturer, modelNumber, issuedTo
                             FROM Device
                             WHERE deviceID = %s"""
-        cursor.execute(sql, (device_id,))
-        device_info = cursor.fetchall()[0]
+        result = _execute_prepared(connection, cursor, sql, (device_id,))
+        rows = result.fetchall()
+        if rows:
+            device_info = Device.from_cursor(result, rows)[0]
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -354,17 +687,7 @@ def get_device_information(device_id: int) -> Optional[dict]:
         print("No device information exists.")
         return None
 
-    device = {
-        'device_id': device_info[0],
-        'serial_number': device_info[1],
-        'purchase_date': device_info[2],
-        'purchase_cost': device_info[3],
-        'manufacturer': device_info[4],
-        'model_number': device_info[5],
-        'issued_to': device_info[6],
-    }
-
-    return device
+    return device_info
 
 
 #####################################################
@@ -372,7 +695,10 @@ def get_device_information(device_id: int) -> Optional[dict]:
 #   Get Model Info by Device
 #####################################################
 
-def get_device_model(device_id: int) -> Optional[dict]:
+@cached(reference_cache, 'device_model')
+@instrumented
+@read_only
+def get_device_model(device_id: int) -> Optional[Model]:
     """
     Get model information about a device.
     """
@@ -387,9 +713,11 @@ def get_device_model(device_id: int) -> Optional[dict]:
                             FROM Device NATURAL JOIN Model
                             WHERE deviceID = %s"""
         cursor.execute(sql, (device_id,))
-        model_info = cursor.fetchall()[0]
+        rows = cursor.fetchall()
+        if rows:
+            model_info = Model.from_cursor(cursor, rows)[0]
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -397,14 +725,7 @@ def get_device_model(device_id: int) -> Optional[dict]:
     if (model_info is None):
         return None
 
-    model = {
-        'manufacturer': model_info[0],
-        'model_number': model_info[1],
-        'description': model_info[2],
-        'weight': model_info[3],
-    }
-
-    return model
+    return model_info
 
 
 #####################################################
@@ -412,7 +733,9 @@ def get_device_model(device_id: int) -> Optional[dict]:
 #   Get Repair Details
 #####################################################
 
-def get_repair_details(repair_id: int) -> Optional[dict]:
+@instrumented
+@read_only
+def get_repair_details(repair_id: int) -> Optional[Repair]:
     """
     Get information about a repair in detail, including service information.
     """
@@ -426,10 +749,13 @@ def get_repair_details(repair_id: int) -> Optional[dict]:
         sql = """SELECT repairID, faultReport, startDate, endDate, cost, abn, serviceName, email, doneTo
                             FROM Repair INNER JOIN Service ON (doneBy = abn)
                             WHERE repairID = %s"""
-        cursor.execute(sql, [repair_id])
-        repair_info = cursor.fetchall()[0]
+        result = _execute_prepared(connection, cursor, sql, (repair_id,))
+        rows = result.fetchall()
+        if rows:
+            repair_info = Repair.mapper(result)(rows[0])
+            repair_info.done_by = Service.mapper(result)(rows[0])
     except:
-        print("Error executing function")
+        _query_failed()
 
 
     cursor.close()
@@ -439,26 +765,16 @@ def get_repair_details(repair_id: int) -> Optional[dict]:
         print("No repair information exists.")
         return None
 
-    repair = {
-        'repair_id': repair_info[0],
-        'fault_report': repair_info[1],
-        'start_date': repair_info[2],
-        'end_date': repair_info[3],
-        'cost': repair_info[4],
-        'done_by': {
-            'abn': repair_info[5],
-            'service_name': repair_info[6],
-            'email': repair_info[7],
-        },
-        'done_to': repair_info[8],
-    }
-    return repair
+    return repair_info
 
 #####################################################
 #   Query (f[ii])
 #   Get Models assigned to Department
 #####################################################
 
+@cached(reference_cache, 'department_models')
+@instrumented
+@read_only
 def get_department_models(department_name: str) -> list:
     """
     Return all models assigned to a department.
@@ -476,14 +792,15 @@ def get_department_models(department_name: str) -> list:
         cursor.execute(sql, (department_name,))
         model_allocations = cursor.fetchall()
     except:
-        print("Error executing function")
+        _query_failed()
 
 
     cursor.close()
     connection.close()
 
+    # None (not []) so a failed lookup isn't cached
     if (model_allocations is None):
-        return []
+        return None
 
     return model_allocations
 
@@ -494,30 +811,14 @@ def get_department_models(department_name: str) -> list:
 #   by Employee in Department
 #####################################################
 
+@instrumented
+@read_only
 def get_employee_department_model_device(department_name: str, manufacturer: str, model_number: str) -> list:
-    connection = database_connect()
-    if(connection is None):
-        return None
-    cursor = connection.cursor()
-
-    employee_counts = None
-    try:
-        sql = """SELECT E.empid, E.name, count(deviceID)
-                            FROM Employee E INNER JOIN Device ON (issuedTo = empid) NATURAL JOIN ModelAllocations
-                            WHERE department = %s AND manufacturer = %s AND modelnumber = %s
-                            GROUP BY E.empid"""
-        cursor.execute(sql, (department_name, manufacturer, model_number))
-        employee_counts = cursor.fetchall()
-    except:
-        print("Error executing function")
-
-    cursor.close()
-    connection.close()
-
+    employee_counts = stream_employee_department_model_device(department_name, manufacturer, model_number)
     if (employee_counts is None):
-        return []
+        return None
 
-    return employee_counts
+    return list(employee_counts)
 
 
 #####################################################
@@ -527,6 +828,8 @@ def get_employee_department_model_device(department_name: str, manufacturer: str
 #       it issued.
 #####################################################
 
+@instrumented
+@read_only
 def get_model_device_assigned(model_number: str, manufacturer: str, employee_id: int) -> list:
     """
     Get all devices matching the model and manufacturer and show True/False
@@ -538,31 +841,11 @@ def get_model_device_assigned(model_number: str, manufacturer: str, employee_id:
         - [51413, True]
         - [8765, False]
     """
-
-    connection = database_connect()
-    if(connection is None):
-        return None
-    cursor = connection.cursor()
-    device_assigned = None
-
-    try:
-        sql = """SELECT deviceID, CASE WHEN issuedTo = %s THEN 'True' ELSE 'False' END
-                             FROM Device
-                             WHERE manufacturer =%s
-                              AND modelNumber = %s"""
-        cursor.execute(sql, (employee_id, manufacturer, model_number))
-        device_assigned = cursor.fetchall()
-    except:
-        print("Error executing function")
-
-    cursor.close()
-    connection.close()
-
+    device_assigned = stream_model_device_assigned(model_number, manufacturer, employee_id)
     if (device_assigned is None):
-        return []
-
-    return device_assigned
+        return None
 
+    return list(device_assigned)
 
 
 #####################################################
@@ -570,6 +853,9 @@ def get_model_device_assigned(model_number: str, manufacturer: str, employee_id:
 #       manufacturer that have not been assigned.
 #####################################################
 
+@cached(lookup_cache, 'unassigned_devices')
+@instrumented
+@read_only
 def get_unassigned_devices_for_model(model_number: str, manufacturer: str) -> list:
     """
     Get all unassigned devices for the model.
@@ -586,16 +872,16 @@ def get_unassigned_devices_for_model(model_number: str, manufacturer: str) -> li
                             WHERE manufacturer =%s
                             AND modelNumber = %s
                             AND issuedTo is NULL"""
-        cursor.execute(sql, (manufacturer, model_number))
-        device_unissued = cursor.fetchall()
+        device_unissued = _execute_prepared(connection, cursor, sql, (manufacturer, model_number)).fetchall()
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
 
+    # None (not []) so a failed lookup isn't cached
     if (device_unissued is None):
-        return []
+        return None
 
     return device_unissued
 
@@ -604,6 +890,9 @@ def get_unassigned_devices_for_model(model_number: str, manufacturer: str) -> li
 #   Get Employees in Department
 #####################################################
 
+@cached(lookup_cache, 'department_employees')
+@instrumented
+@read_only
 def get_employees_in_department(department_name: str) -> list:
     """
     Return all the employees' IDs and names in a given department.
@@ -621,15 +910,15 @@ def get_employees_in_department(department_name: str) -> list:
         cursor.execute(sql, [department_name])
         employees = cursor.fetchall()
     except:
-        print("Error executing function")
+        _query_failed()
 
 
     cursor.close()
     connection.close()
 
+    # None (not []) so a failed lookup isn't cached
     if (employees is None):
-        return []
-
+        return None
 
     return employees
 
@@ -639,47 +928,19 @@ def get_employees_in_department(department_name: str) -> list:
 #   Issue Device
 #####################################################
 
+@instrumented
+@writes
 def issue_device_to_employee(employee_id: int, device_id: int):
     """
     Issue the device to the chosen employee.
-    """
 
-    connection = database_connect()
-    if(connection is None):
+    This is a single conditional UPDATE ... WHERE issuedTo IS NULL, so if
+    two managers issue the same device at once exactly one of them wins.
+    """
+    results = issue_devices_to_employees([(employee_id, device_id)])
+    if (results is None):
         return None
-    cursor = connection.cursor()
-    issue_device = None
-
-    try:
-        sql = """SELECT * FROM Device
-              WHERE deviceid = %s AND issuedTo is not NULL"""
-        cursor.execute(sql, [device_id])
-        issue_device = cursor.fetchall()[0]
-    except:
-        print("Error executing function")
-
-    cursor.close()
-    connection.close()
-    if (issue_device is not None):
-        return (False, "Device already issued")
-
-    connection = database_connect()
-    if(connection is None):
-        return None
-    cursor = connection.cursor()
-    try:
-        cursor.execute("""UPDATE Device
-                            SET issuedTo = %s
-                            WHERE deviceid = %s""", (employee_id, device_id))
-        issue_device = cursor.fetchall()
-    except:
-        print("Error executing function")
-
-    connection.commit()
-    cursor.close()
-    connection.close()
-
-    return (True, None)
+    return (results[0]['success'], results[0]['error'])
 
 
 #####################################################
@@ -687,48 +948,185 @@ def issue_device_to_employee(employee_id: int, device_id: int):
 #   Revoke Device Issued to User
 #####################################################
 
+@instrumented
+@writes
 def revoke_device_from_employee(employee_id: int, device_id: int):
     """
     Revoke the device from the employee.
     """
-    connection = database_connect()
-    if(connection is None):
+    results = revoke_devices_from_employees([(employee_id, device_id)])
+    if (results is None):
         return None
-    cursor = connection.cursor()
+    return (results[0]['success'], results[0]['error'])
 
-    issue_device = None
-    try:
-        cursor.execute("""SELECT deviceid,issuedto
-                            FROM Device
-                            WHERE deviceid = %s AND issuedto = %s""",(device_id,employee_id))
-        issue_device = cursor.fetchall()[0]
-    except:
-        print("Error executing function")
-    cursor.close()
-    connection.close()
 
-    if (issue_device is None):
-        return (False, "Employee not assigned to device")
+#####################################################
+#   Bulk Issue / Revoke
+#   (many devices, one transaction)
+#####################################################
+
+def _apply_device_batch(pairs: list, issue: bool) -> Optional[list]:
+    """
+    Issue (or revoke) every (employee_id, device_id) pair with one
+    set-based UPDATE ... FROM (VALUES ...) in a single transaction.
+
+    The UPDATE only touches rows that are still free (or still issued to
+    that employee), and Postgres re-checks that condition after taking the
+    row lock, so two concurrent batches can never both claim a device.
+
+    Returns one result dict per pair, in order:
+        {'empid': ..., 'deviceid': ..., 'success': bool, 'error': str or None}
+    or None if the database couldn't be reached.
+    """
+    results = []
+    requested = []
+    seen = set()
+    for employee_id, device_id in pairs:
+        result = {'empid': employee_id, 'deviceid': device_id, 'success': False, 'error': None}
+        results.append(result)
+        try:
+            employee_id, device_id = int(employee_id), int(device_id)
+        except (TypeError, ValueError):
+            result['error'] = "Invalid employee or device id"
+            continue
+        result['empid'], result['deviceid'] = employee_id, device_id
+        if device_id in seen:
+            result['error'] = "Device appears more than once in the batch"
+            continue
+        seen.add(device_id)
+        requested.append((employee_id, device_id))
+
+    if not requested:
+        return results
 
     connection = database_connect()
     if(connection is None):
         return None
     cursor = connection.cursor()
+    outcome = None
+
+    values = ", ".join(["(%s::int, %s::int)"] * len(requested))
+    params = tuple(value for pair in requested for value in pair)
+    if issue:
+        change = """UPDATE Device D
+                       SET issuedTo = R.empid
+                      FROM requested R
+                     WHERE D.deviceID = R.deviceid
+                       AND D.issuedTo IS NULL
+                       AND EXISTS (SELECT 1 FROM Employee E WHERE E.empid = R.empid)
+                 RETURNING D.deviceID"""
+    else:
+        change = """UPDATE Device D
+                       SET issuedTo = NULL
+                      FROM requested R
+                     WHERE D.deviceID = R.deviceid
+                       AND D.issuedTo = R.empid
+                 RETURNING D.deviceID"""
+    # The final SELECT sees Device as it was before the UPDATE, which is
+    # what we want to explain the rows that weren't changed.
+    sql = """WITH requested(empid, deviceid) AS (VALUES {}),
+                  changed AS ({})
+             SELECT R.deviceid,
+                    C.deviceID IS NOT NULL AS changed,
+                    D.deviceID IS NOT NULL AS device_exists,
+                    D.issuedTo,
+                    EXISTS (SELECT 1 FROM Employee E WHERE E.empid = R.empid) AS employee_exists
+               FROM requested R
+                    LEFT JOIN changed C ON (C.deviceID = R.deviceid)
+                    LEFT JOIN Device D ON (D.deviceID = R.deviceid)""".format(values, change)
     try:
-        cursor.execute(""" UPDATE Device
-                            SET issuedto = NULL
-                            WHERE deviceid = %s AND issuedto = %s;""",(device_id, employee_id))
+        if get_backend().dialect == 'sqlite':
+            outcome = _apply_device_batch_sqlite(cursor, requested, issue)
+        else:
+            cursor.execute(sql, params)
+            outcome = {row[0]: row[1:] for row in cursor.fetchall()}
+        connection.commit()
     except:
-        print("Error executing function")
+        _query_failed()
 
-    connection.commit()
     cursor.close()
     connection.close()
-    return (True, None)
+
+    if (outcome is None):
+        return None
+
+    # Issued devices are no longer unassigned and revoked ones are again
+    if any(changed for changed, *_ in outcome.values()):
+        lookup_cache.invalidate_prefix('unassigned_devices')
+
+    for result in results:
+        if result['error'] is not None:
+            continue
+        changed, device_exists, issued_to, employee_exists = outcome[result['deviceid']]
+        if changed:
+            result['success'] = True
+        elif not device_exists:
+            result['error'] = "Device does not exist"
+        elif issue and not employee_exists:
+            result['error'] = "Employee does not exist"
+        elif issue:
+            result['error'] = "Device already issued"
+        else:
+            result['error'] = "Employee not assigned to device"
+    return results
+
+
+def _apply_device_batch_sqlite(cursor, requested: list, issue: bool) -> dict:
+    """
+    _apply_device_batch for SQLite, which can't UPDATE inside a WITH.
+    BEGIN IMMEDIATE takes the database's write lock up front, so the rows
+    read here can't change before the UPDATEs that follow.
+    """
+    cursor.execute("BEGIN IMMEDIATE")
+    values = ", ".join(["(%s, %s)"] * len(requested))
+    params = tuple(value for pair in requested for value in pair)
+    sql = """WITH requested(empid, deviceid) AS (VALUES {})
+             SELECT R.deviceid, R.empid,
+                    D.deviceID IS NOT NULL AS device_exists,
+                    D.issuedTo,
+                    EXISTS (SELECT 1 FROM Employee E WHERE E.empid = R.empid) AS employee_exists
+               FROM requested R
+                    LEFT JOIN Device D ON (D.deviceID = R.deviceid)""".format(values)
+    cursor.execute(sql, params)
+
+    outcome = {}
+    updates = []
+    for device_id, employee_id, device_exists, issued_to, employee_exists in cursor.fetchall():
+        if issue:
+            changed = bool(device_exists and issued_to is None and employee_exists)
+        else:
+            changed = bool(device_exists and issued_to == employee_id)
+        if changed:
+            updates.append((employee_id if issue else None, device_id))
+        outcome[device_id] = (changed, bool(device_exists), issued_to, bool(employee_exists))
+    cursor.executemany("UPDATE Device SET issuedTo = %s WHERE deviceID = %s", updates)
+    return outcome
+
+
+@instrumented
+@writes
+def issue_devices_to_employees(pairs: list) -> Optional[list]:
+    """
+    Issue many devices at once. pairs is a list of (employee_id, device_id).
+    """
+    return _apply_device_batch(pairs, issue=True)
+
+
+@instrumented
+@writes
+def revoke_devices_from_employees(pairs: list) -> Optional[list]:
+    """
+    Revoke many devices at once. pairs is a list of (employee_id, device_id).
+    """
+    return _apply_device_batch(pairs, issue=False)
+
+
 #####################################################
 #   Extension 1
 #   Used History
 #####################################################
+@instrumented
+@read_only
 def used_history(employee_id: int) -> list:
     """
     Input:
@@ -739,37 +1137,20 @@ def used_history(employee_id: int) -> list:
     -----------------------------------------------------------
     Return a list of users of each device, which is issued to this employee.
     """
-    history = None
-    connection = database_connect()
-    if(connection is None):
-        return None
-    cursor = connection.cursor()
-
-    try:
-        sql = """SELECT deviceID, empid, name
-                    FROM Device NATURAL JOIN DeviceUsedBy NATURAL JOIN Employee
-                    WHERE deviceID IN ( SELECT deviceID
-                                            FROM Device JOIN Deviceusedby using (deviceID)
-                                            WHERE issuedTo = %s);"""
-        cursor.execute(sql, [employee_id])
-        history = cursor.fetchall()
-    except:
-        print("Error executing function")
-
-    cursor.close()
-    connection.close()
-
+    history = stream_used_history(employee_id)
     if (history is None):
         return None
 
-    return history
+    return list(history)
 
 #####################################################
 #   Extension 2
 #   Add model
+#   (one model or a whole catalogue, one transaction)
 #####################################################
-def add_model(department: str, manufacturer: str, modelNumber: str, description: str, weight: str, maxNumber: int) -> list:
-
+@instrumented
+@writes
+def add_model(department: str, manufacturer: str, modelNumber: str, description: str, weight: str, maxNumber: int):
     """
     Add model for this department
 
@@ -784,57 +1165,170 @@ def add_model(department: str, manufacturer: str, modelNumber: str, description:
 
     Output:
     -----------------------------------------------------------
-    A list of history:
-        detalied information for the given model
+    (created, error) as for add_models, or None if the database
+    couldn't be reached.
     """
+    results = add_models(department, [(manufacturer, modelNumber, description, weight, maxNumber)])
+    if (results is None):
+        return None
+    return (results[0]['created'], results[0]['error'])
+
+
+_MODEL_BATCH = 1000     # rows per INSERT, keeps the bind parameters under pg8000's limit
+
+
+@instrumented
+@writes
+def add_models(department: str, models: list) -> Optional[list]:
+    """
+    Add many models to the department at once. models is a list of
+    (manufacturer, modelNumber, description, weight, maxNumber).
+
+    Everything is written in one transaction with INSERT ... ON CONFLICT,
+    so concurrent uploads of the same model can't collide:
+        - a model that is already in the catalogue is kept as it is
+        - the department's allocation is added, or its maxNumber updated
+
+    Returns one result dict per model, in order:
+        {'manufacturer': ..., 'modelNumber': ..., 'success': bool,
+         'created': bool, 'error': str or None}
+    or None if the database couldn't be reached.
+    """
+    results = []
+    requested = []
+    seen = set()
+    for manufacturer, modelNumber, description, weight, maxNumber in models:
+        result = {'manufacturer': manufacturer, 'modelNumber': modelNumber,
+                  'success': False, 'created': False, 'error': None}
+        results.append(result)
+        manufacturer = (manufacturer or '').strip()
+        modelNumber = (modelNumber or '').strip()
+        description = (description or '').strip() or None
+        if not manufacturer or not modelNumber:
+            result['error'] = "Manufacturer and model number are required"
+            continue
+        if len(manufacturer) > 20 or len(modelNumber) > 10 or (description and len(description) > 80):
+            result['error'] = "Manufacturer, model number or description too long"
+            continue
+        try:
+            weight = float(weight)
+            maxNumber = int(maxNumber)
+        except (TypeError, ValueError):
+            result['error'] = "Invalid weight or max number"
+            continue
+        if maxNumber < 0:
+            result['error'] = "Invalid weight or max number"
+            continue
+        result['manufacturer'], result['modelNumber'] = manufacturer, modelNumber
+        if (manufacturer, modelNumber) in seen:
+            result['error'] = "Model appears more than once in the batch"
+            continue
+        seen.add((manufacturer, modelNumber))
+        requested.append((manufacturer, modelNumber, description, weight, maxNumber))
+
+    if not requested:
+        return results
 
-    model_info = None
     connection = database_connect()
     if(connection is None):
         return None
     cursor = connection.cursor()
+    created = None
 
     try:
-        # find the detailed unformation for the given model
-        # record detaled information to 'history'
-        sql = """SELECT *
-                    FROM model
-                    WHERE modelNumber = %s AND manufacturer = %s;"""
-        cursor.execute(sql, (modelNumber,manufacturer))
-        history = cursor.fetchall()
-    except:
-        print("Error executing function")
-
-    # If the given model is new, has not been recorded in db
-    if (history is None or len(history) == 0):
-        # As PK and weight cannot be null, so only description can be null.
-        # if the new model has no description given
-        if description is None:
-            sql = """INSERT INTO Model(manufacturer,modelNumber,description,weight)
-                            VALUES (%s,%s,NULL,%s);"""
-            cursor.execute(sql, (manufacturer,modelNumber,weight))
+        if get_backend().dialect == 'sqlite':
+            created = _add_models_sqlite(cursor, department, requested)
         else:
-            # All model infortion given
-            sql = """INSERT INTO Model(manufacturer,modelNumber,description,weight)
-                            VALUES (%s,%s,%s,%s);"""
-            cursor.execute(sql, (manufacturer,modelNumber,description,weight))
-        # Update the information of ModelAllocations table
-        sql = """INSERT INTO ModelAllocations(manufacturer,modelNumber,department,maxNumber)
-                            VALUES (%s,%s,%s,%s);"""
-        cursor.execute(sql, (manufacturer,modelNumber,department,maxNumber))
+            created = set()
+            for start in range(0, len(requested), _MODEL_BATCH):
+                created.update(_add_models_batch(cursor, department, requested[start:start + _MODEL_BATCH]))
         connection.commit()
-        return None
+    except:
+        # closing the connection rolls the transaction back
+        _query_failed()
 
     cursor.close()
     connection.close()
 
-    return history
+    if (created is None):
+        return None
+
+    # Only these cached lookups can see the new models and allocations
+    reference_cache.invalidate(get_all_models.cache_key())
+    reference_cache.invalidate_prefix('models_page')
+    reference_cache.invalidate(get_department_models.cache_key(department))
+    for manufacturer, modelNumber, *_ in requested:
+        reference_cache.invalidate(show_model_detail.cache_key(manufacturer, modelNumber))
+
+    for result in results:
+        if result['error'] is None:
+            result['success'] = True
+            result['created'] = (result['manufacturer'], result['modelNumber']) in created
+    return results
+
+
+def _add_models_batch(cursor, department: str, requested: list) -> set:
+    """
+    Upsert one batch of models and their allocations in a single
+    statement. Returns the (manufacturer, modelNumber) of the models
+    that weren't in the catalogue before.
+    """
+    values = ", ".join(["(%s, %s, %s, %s::real, %s::int)"] * len(requested))
+    params = tuple(value for model in requested for value in model)
+    # The allocations' foreign key is checked at the end of the statement,
+    # after new_models has inserted the models it refers to.
+    sql = """WITH input(manufacturer, modelNumber, description, weight, maxNumber) AS (VALUES {}),
+                  new_models AS (
+                      INSERT INTO Model(manufacturer, modelNumber, description, weight)
+                      SELECT manufacturer, modelNumber, description, weight FROM input
+                      ON CONFLICT (manufacturer, modelNumber) DO NOTHING
+                      RETURNING manufacturer, modelNumber),
+                  allocations AS (
+                      INSERT INTO ModelAllocations(manufacturer, modelNumber, department, maxNumber)
+                      SELECT manufacturer, modelNumber, %s, maxNumber FROM input
+                      ON CONFLICT (manufacturer, modelNumber, department)
+                      DO UPDATE SET maxNumber = EXCLUDED.maxNumber)
+             SELECT manufacturer, modelNumber FROM new_models""".format(values)
+    cursor.execute(sql, params + (department,))
+    return {tuple(row) for row in cursor.fetchall()}
+
+
+def _add_models_sqlite(cursor, department: str, requested: list) -> set:
+    """
+    add_models for SQLite, which can't INSERT inside a WITH. BEGIN
+    IMMEDIATE takes the write lock first, so the models found here are
+    still the only ones when the INSERTs run.
+    """
+    cursor.execute("BEGIN IMMEDIATE")
+    existing = set()
+    for start in range(0, len(requested), _MODEL_BATCH):
+        batch = requested[start:start + _MODEL_BATCH]
+        values = ", ".join(["(%s, %s)"] * len(batch))
+        params = tuple(value for model in batch for value in model[:2])
+        cursor.execute("""WITH input(manufacturer, modelNumber) AS (VALUES {})
+                          SELECT M.manufacturer, M.modelNumber
+                            FROM input I JOIN Model M USING (manufacturer, modelNumber)""".format(values), params)
+        existing.update(tuple(row) for row in cursor.fetchall())
+    cursor.executemany("""INSERT INTO Model(manufacturer, modelNumber, description, weight)
+                          VALUES (%s, %s, %s, %s)
+                          ON CONFLICT (manufacturer, modelNumber) DO NOTHING""",
+                       [model[:4] for model in requested])
+    cursor.executemany("""INSERT INTO ModelAllocations(manufacturer, modelNumber, department, maxNumber)
+                          VALUES (%s, %s, %s, %s)
+                          ON CONFLICT (manufacturer, modelNumber, department)
+                          DO UPDATE SET maxNumber = excluded.maxNumber""",
+                       [(model[0], model[1], department, model[4]) for model in requested])
+    return {model[:2] for model in requested} - existing
+
 
 #####################################################
 #   Extension 3
 #   Model Cost Each Month
 #####################################################
-def show_model_detail(manufacturer: str, model_number: str)-> list:
+@cached(reference_cache, 'model_detail')
+@instrumented
+@read_only
+def show_model_detail(manufacturer: str, model_number: str)-> Optional[Model]:
     """
     Add model for this department
 
@@ -845,7 +1339,7 @@ def show_model_detail(manufacturer: str, model_number: str)-> list:
 
     Output:
     -----------------------------------------------------------
-    A list:
+    A Model record:
         detalied information for the given model
     """
 
@@ -860,9 +1354,11 @@ def show_model_detail(manufacturer: str, model_number: str)-> list:
                             FROM Model
                             WHERE manufacturer = %s AND modelNumber = %s"""
         cursor.execute(sql, (manufacturer,model_number))
-        model_info = cursor.fetchall()[0]
+        rows = cursor.fetchall()
+        if rows:
+            model_info = Model.from_cursor(cursor, rows)[0]
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -870,15 +1366,10 @@ def show_model_detail(manufacturer: str, model_number: str)-> list:
     if (model_info is None):
         return None
 
-    model = {
-        'manufacturer': model_info[0],
-        'model_number': model_info[1],
-        'description': model_info[2],
-        'weight': model_info[3],
-    }
-
-    return model
+    return model_info
 
+@instrumented
+@read_only
 def get_model_cost(manufacturer: str, model_number: str) -> list:
     """
     Return the average cost spent on the model each month each year.
@@ -900,18 +1391,20 @@ def get_model_cost(manufacturer: str, model_number: str) -> list:
     cursor = connection.cursor()
 
     try:
-        sql = """SELECT  CAST(EXTRACT(year FROM purchaseDate) AS int) AS year,
-                        CAST(EXTRACT(month FROM purchaseDate) AS int) AS month,
-                        CAST(round(AVG(purchaseCost::numeric),2) AS money)
+        # Read from the monthly rollup kept by the Device trigger
+        # (migrations/0002_model_monthly_cost.sql) rather than averaging
+        # every device of the model on each page view.
+        sql = """SELECT year, month,
+                        CAST(round(total_cost / NULLIF(cost_count, 0), 2) AS money)
                     AS average_cost
-                    FROM Device
-                    WHERE  manufacturer = %s AND modelNumber = %s
-                    GROUP BY year, month
-                    Order by year desc, month desc;"""
+                    FROM ModelMonthlyCost
+                    WHERE manufacturer = %s AND modelNumber = %s
+                      AND device_count > 0
+                    ORDER BY year desc, month desc;"""
         cursor.execute(sql, (manufacturer, model_number))
         costs = cursor.fetchall()
     except:
-        print("Error executing function")
+        _query_failed()
 
     cursor.close()
     connection.close()
@@ -920,3 +1413,462 @@ def get_model_cost(manufacturer: str, model_number: str) -> list:
         return []
 
     return costs
+
+
+#####################################################
+#   Keyset Pagination
+#   (pages addressed by the sort key of their first
+#       or last row, so deep pages cost the same
+#       as the first one)
+#####################################################
+
+def _fetch_keyset_page(select: str, where: str, params: tuple, key_columns: tuple,
+                       key_positions: tuple, after: tuple = None,
+                       before: tuple = None, limit: int = 50) -> Optional[dict]:
+    """
+    Fetch one page of `select` ordered by key_columns.
+
+    key_positions are the indexes of the key columns in each returned row.
+    after/before are sort keys taken from the previous page (at most one).
+
+    Returns {'rows': [...], 'next': key or None, 'prev': key or None}
+    or None if the query failed.
+    """
+    if after is not None and len(after) != len(key_columns):
+        after = None
+    if before is not None and len(before) != len(key_columns):
+        before = None
+
+    columns = ', '.join(key_columns)
+    placeholders = ', '.join(['%s'] * len(key_columns))
+    conditions = [where] if where else []
+    if before is not None:
+        conditions.append("({}) < ({})".format(columns, placeholders))
+        order = ', '.join(column + ' DESC' for column in key_columns)
+        params = tuple(params) + tuple(before)
+    else:
+        if after is not None:
+            conditions.append("({}) > ({})".format(columns, placeholders))
+            params = tuple(params) + tuple(after)
+        order = columns
+
+    sql = select
+    if conditions:
+        sql += "\n WHERE " + " AND ".join(conditions)
+    sql += "\n ORDER BY {}\n LIMIT %s".format(order)
+
+    connection = database_connect()
+    if(connection is None):
+        return None
+    cursor = connection.cursor()
+    rows = None
+    try:
+        # One extra row tells us whether there is another page
+        cursor.execute(sql, params + (limit + 1,))
+        rows = cursor.fetchall()
+    except:
+        _query_failed()
+
+    cursor.close()
+    connection.close()
+
+    if (rows is None):
+        return None
+
+    more = len(rows) > limit
+    rows = list(rows[:limit])
+    key = lambda row: tuple(row[i] for i in key_positions)
+
+    if before is not None:
+        rows.reverse()
+        prev_key = key(rows[0]) if more and rows else None
+        next_key = key(rows[-1]) if rows else None
+    else:
+        next_key = key(rows[-1]) if more and rows else None
+        prev_key = key(rows[0]) if after is not None and rows else None
+
+    return {'rows': rows, 'next': next_key, 'prev': prev_key}
+
+
+@cached(reference_cache, 'models_page')
+@instrumented
+@read_only
+def get_models_page(after: tuple = None, before: tuple = None, limit: int = 50) -> Optional[dict]:
+    """
+    One page of get_all_models(), ordered by (manufacturer, modelNumber).
+    """
+    return _fetch_keyset_page(
+        """SELECT manufacturer, description, modelnumber, weight
+             FROM Model""",
+        '', (),
+        ('manufacturer', 'modelNumber'), (0, 2),
+        after, before, limit)
+
+
+@instrumented
+@read_only
+def get_issued_devices_page(employee_id: int, after: tuple = None, before: tuple = None,
+                            limit: int = 50) -> Optional[dict]:
+    """
+    One page of get_issued_devices_for_user(), ordered by deviceID.
+    """
+    return _fetch_keyset_page(
+        """SELECT deviceID, purchaseDate, manufacturer, modelNumber
+             FROM Device""",
+        "issuedTo = %s", (employee_id,),
+        ('deviceID',), (0,),
+        after, before, limit)
+
+
+@instrumented
+@read_only
+def used_history_page(employee_id: int, after: tuple = None, before: tuple = None,
+                      limit: int = 50) -> Optional[dict]:
+    """
+    One page of used_history(), ordered by (deviceID, empid).
+    """
+    return _fetch_keyset_page(
+        """SELECT DU.deviceID, DU.empid, E.name
+             FROM Device D
+                  JOIN DeviceUsedBy DU ON (DU.deviceID = D.deviceID)
+                  JOIN Employee E ON (E.empid = DU.empid)""",
+        "D.issuedTo = %s", (employee_id,),
+        ('DU.deviceID', 'DU.empid'), (0, 1),
+        after, before, limit)
+
+
+#####################################################
+#   Streaming Queries
+#   (server-side cursors, so big result sets never
+#       sit in memory all at once)
+#####################################################
+
+_cursor_names = itertools.count(1)
+
+
+class RowStream:
+    """
+    Rows of a query read through a server-side cursor, fetch_size rows at
+    a time. The connection is held until the stream is exhausted or
+    close() is called, then handed back to the pool.
+
+    columns holds the lower-case column names of the result. With
+    to_record set, each row is yielded as to_record(row).
+    """
+
+    def __init__(self, backend, connection, cursor, name, columns, first_batch, fetch_size,
+                 to_record=None):
+        self.connection = connection
+        self._backend = backend
+        self.columns = columns
+        self._cursor = cursor
+        self._name = name
+        self._batch = first_batch
+        self._fetch_size = fetch_size
+        self._to_record = to_record
+
+    def __iter__(self):
+        try:
+            while self._batch:
+                if self._to_record is None:
+                    yield from self._batch
+                else:
+                    for row in self._batch:
+                        yield self._to_record(row)
+                if len(self._batch) < self._fetch_size:
+                    break
+                self._batch = self._backend.fetch_stream(self._cursor, self._name, self._fetch_size)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self._backend.close_stream(self._cursor, self._name)
+            self._cursor.close()
+        except:
+            pass
+        self._batch = None
+        connection, self.connection = self.connection, None
+        connection.close()
+
+
+def stream_query(sql: str, params: tuple = (), fetch_size: int = None, record=None) -> Optional[RowStream]:
+    """
+    Run `sql` through a named server-side cursor and return a RowStream
+    (on SQLite a plain cursor, which steps through the result lazily).
+    The first batch is fetched straight away so errors show up here,
+    before a response has started. Returns None if the query failed.
+    record is an optional rows.Record type to yield instead of raw rows.
+    """
+    fetch_size = fetch_size or get_settings().streaming.fetch_size
+    connection = database_connect()
+    if(connection is None):
+        return None
+    cursor = connection.cursor()
+    backend = get_backend()
+    name = "dm_stream_{}".format(next(_cursor_names))
+    try:
+        first_batch = backend.open_stream(cursor, name, sql, params, fetch_size)
+        columns = [column[0] for column in cursor.description]
+        to_record = None if record is None else record.mapper(cursor)
+    except:
+        _query_failed()
+        cursor.close()
+        connection.close()
+        return None
+
+    return RowStream(backend, connection, cursor, name, columns, first_batch, fetch_size, to_record)
+
+
+#####################################################
+#   Streamed Lists
+#   The list pages iterate these while the template
+#   renders, so rows are fetched fetch_size at a time
+#   instead of all being held at once.
+#####################################################
+
+@instrumented
+@read_only
+def stream_all_models() -> Optional[RowStream]:
+    """
+    Every model, as Model records.
+    """
+    sql = """SELECT manufacturer, description, modelnumber, weight
+               FROM Model"""
+    return stream_query(sql, record=Model)
+
+
+@instrumented
+@read_only
+def stream_used_history(employee_id: int) -> Optional[RowStream]:
+    """
+    (deviceID, empid, name) for every user of each device issued to the employee.
+    """
+    sql = """SELECT deviceID, empid, name
+                FROM Device NATURAL JOIN DeviceUsedBy NATURAL JOIN Employee
+                WHERE deviceID IN ( SELECT deviceID
+                                        FROM Device JOIN Deviceusedby using (deviceID)
+                                        WHERE issuedTo = %s)"""
+    return stream_query(sql, (employee_id,))
+
+
+@instrumented
+@read_only
+def stream_model_device_assigned(model_number: str, manufacturer: str, employee_id: int) -> Optional[RowStream]:
+    """
+    (deviceID, 'True'/'False') for every device of the model, saying
+    whether it is issued to the employee (see get_model_device_assigned).
+    """
+    sql = """SELECT deviceID, CASE WHEN issuedTo = %s THEN 'True' ELSE 'False' END
+               FROM Device
+              WHERE manufacturer = %s
+                AND modelNumber = %s"""
+    return stream_query(sql, (employee_id, manufacturer, model_number))
+
+
+@instrumented
+@read_only
+def stream_employee_department_model_device(department_name: str, manufacturer: str,
+                                            model_number: str) -> Optional[RowStream]:
+    """
+    (empid, name, device count) of the department's employees issued
+    devices of the model.
+    """
+    sql = """SELECT E.empid, E.name, count(deviceID)
+               FROM Employee E INNER JOIN Device ON (issuedTo = empid) NATURAL JOIN ModelAllocations
+              WHERE department = %s AND manufacturer = %s AND modelnumber = %s
+              GROUP BY E.empid"""
+    return stream_query(sql, (department_name, manufacturer, model_number))
+
+
+#####################################################
+#   Exports
+#####################################################
+
+@instrumented
+@read_only
+def stream_department_devices(department_name: str) -> Optional[RowStream]:
+    """
+    Every device of a model allocated to the department.
+    """
+    sql = """SELECT deviceID, serialNumber, purchaseDate, purchaseCost,
+                    manufacturer, modelNumber, issuedTo
+               FROM Device NATURAL JOIN ModelAllocations
+              WHERE department = %s
+              ORDER BY deviceID"""
+    return stream_query(sql, (department_name,))
+
+
+@instrumented
+@read_only
+def stream_device_repairs(device_id: int) -> Optional[RowStream]:
+    """
+    The full repair history of a device, with the service that did it.
+    """
+    sql = """SELECT repairID, faultReport, startDate, endDate, cost,
+                    abn, serviceName, doneTo
+               FROM Repair INNER JOIN Service ON (doneBy = abn)
+              WHERE doneTo = %s
+              ORDER BY startDate, repairID"""
+    return stream_query(sql, (device_id,))
+
+
+@instrumented
+@read_only
+def stream_model_costs(manufacturer: str, model_number: str) -> Optional[RowStream]:
+    """
+    The per-month average cost series of a model (see get_model_cost).
+    """
+    sql = """SELECT year, month,
+                    CAST(round(total_cost / NULLIF(cost_count, 0), 2) AS money) AS average_cost,
+                    total_cost, cost_count, device_count
+               FROM ModelMonthlyCost
+              WHERE manufacturer = %s AND modelNumber = %s
+                AND device_count > 0
+              ORDER BY year desc, month desc"""
+    return stream_query(sql, (manufacturer, model_number))
+
+
+#####################################################
+#   Search
+#   Models are matched in memory against the cached
+#   catalogue first; the trigram indexes of
+#   migrations/0003 handle fuzzy matches and devices.
+#####################################################
+
+SEARCH_LIMIT = 20
+_FUZZY_MIN_LENGTH = 3       # trigrams need a few characters to go on
+_MODEL_SEARCH_TEXT = "lower(manufacturer || ' ' || modelNumber || ' ' || coalesce(description, ''))"
+
+# (the get_all_models list it was built from, its PrefixIndex)
+_model_index = (None, None)
+
+
+def _model_prefix_index() -> Optional[PrefixIndex]:
+    """
+    Prefix index of the cached model catalogue, rebuilt whenever the
+    reference cache hands back a new get_all_models() list.
+    """
+    global _model_index
+    models = get_all_models()
+    if (models is None):
+        return None
+    indexed_models, index = _model_index
+    if indexed_models is not models:
+        index = PrefixIndex(models, ('manufacturer', 'model_number', 'description'))
+        _model_index = (models, index)
+    return index
+
+
+@instrumented
+@read_only
+def search_models(query: str, limit: int = SEARCH_LIMIT) -> Optional[list]:
+    """
+    Models whose manufacturer, model number or description start with the
+    query (or each word of it), then close misspellings, as Model records.
+    Only asks the database when the prefix matches don't fill `limit`.
+    """
+    index = _model_prefix_index()
+    if (index is None):
+        return None
+    found = index.search(query, limit)
+    text = normalise(query)
+    if len(found) >= limit or len(text) < _FUZZY_MIN_LENGTH or get_backend().dialect == 'sqlite':
+        return found
+
+    connection = database_connect()
+    if(connection is None):
+        return None
+    cursor = connection.cursor()
+    fuzzy = None
+    try:
+        # <% is pg_trgm's word similarity: the query against any run of
+        # words in the text, so 'thinkpda' still finds 'Lenovo ThinkPad'
+        sql = """SELECT manufacturer, modelNumber, description, weight
+                   FROM Model
+                  WHERE %s <%% {0}
+                  ORDER BY word_similarity(%s, {0}) DESC, manufacturer, modelNumber
+                  LIMIT %s""".format(_MODEL_SEARCH_TEXT)
+        cursor.execute(sql, (text, text, limit))
+        fuzzy = Model.from_cursor(cursor, cursor.fetchall())
+    except:
+        _query_failed()
+
+    cursor.close()
+    connection.close()
+
+    if (fuzzy is None):
+        return None
+
+    seen = {(model.manufacturer, model.model_number) for model in found}
+    found.extend(model for model in fuzzy if (model.manufacturer, model.model_number) not in seen)
+    return found[:limit]
+
+
+@instrumented
+@read_only
+def search_devices(query: str, limit: int = SEARCH_LIMIT) -> Optional[list]:
+    """
+    Devices whose serial number starts with the query, then (for three or
+    more characters) those with a similar serial number, as Device records.
+    """
+    text = normalise(query)
+    if not text:
+        return []
+
+    connection = database_connect()
+    if(connection is None):
+        return None
+    cursor = connection.cursor()
+    devices = None
+    columns = "deviceID, serialNumber, purchaseDate, purchaseCost, manufacturer, modelNumber, issuedTo"
+    sqlite = get_backend().dialect == 'sqlite'
+    try:
+        if sqlite:
+            # SQLite's LIKE ignores case and has no default escape character
+            sql = """SELECT {} FROM Device
+                      WHERE serialNumber LIKE %s ESCAPE '\\'
+                      ORDER BY serialNumber, deviceID
+                      LIMIT %s""".format(columns)
+        else:
+            # device_serial_prefix_idx: a range scan of lower(serialNumber)
+            sql = """SELECT {} FROM Device
+                      WHERE lower(serialNumber) LIKE %s
+                      ORDER BY lower(serialNumber), deviceID
+                      LIMIT %s""".format(columns)
+        cursor.execute(sql, (like_prefix(text), limit))
+        devices = Device.from_cursor(cursor, cursor.fetchall())
+
+        if len(devices) < limit and len(text) >= _FUZZY_MIN_LENGTH and not sqlite:
+            # device_serial_trgm_idx: trigram similarity above pg_trgm's threshold
+            sql = """SELECT {} FROM Device
+                      WHERE lower(serialNumber) %% %s
+                        AND lower(serialNumber) NOT LIKE %s
+                      ORDER BY similarity(lower(serialNumber), %s) DESC, deviceID
+                      LIMIT %s""".format(columns)
+            cursor.execute(sql, (text, like_prefix(text), text, limit - len(devices)))
+            devices.extend(Device.from_cursor(cursor, cursor.fetchall()))
+    except:
+        _query_failed()
+        devices = None
+
+    cursor.close()
+    connection.close()
+
+    return devices
+
+
+#####################################################
+#   Bulk Loading (COPY)
+#####################################################
+
+def copy_rows(cursor, table: str, columns: list, rows) -> int:
+    """
+    Load an iterable of row tuples into `table`: COPY ... FROM STDIN on
+    Postgres, a batched INSERT on SQLite (where MONEY values are cents).
+    None becomes NULL. Runs in the cursor's current transaction; the
+    caller commits. Returns the number of rows copied.
+    """
+    return get_backend().copy_rows(cursor, table, columns, rows)
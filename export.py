@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement exports.
+Turns a database.RowStream into CSV or NDJSON text chunks that can be
+handed straight to a streaming Flask response, so memory use stays the
+same whatever the size of the table.
+"""
+
+import csv
+import datetime
+import io
+import json
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+CHUNK_SIZE = 64 * 1024      # characters buffered before a chunk is sent
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
+
+
+def csv_chunks(stream):
+    """
+    Yield the stream as CSV text, header row first.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(stream.columns)
+    for row in stream:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def ndjson_chunks(stream):
+    """
+    Yield the stream as one JSON object per line.
+    """
+    columns = stream.columns
+    lines = []
+    size = 0
+    for row in stream:
+        line = json.dumps(dict(zip(columns, row)), default=_json_value)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= CHUNK_SIZE:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+            size = 0
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+def chunks(stream, export_format: str):
+    """
+    Pick the writer for export_format ('csv' or 'ndjson').
+    """
+    if export_format == 'ndjson':
+        return ndjson_chunks(stream)
+    return csv_chunks(stream)
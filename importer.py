@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement bulk imports.
+
+Loads a CSV of Device or Repair rows (a procurement shipment, a service
+vendor's repair batch) in one transaction. Every row is checked first:
+types and lengths, duplicate ids, and that the models, employees,
+services and devices it refers to exist. The good rows are then streamed
+into the table with COPY FROM STDIN (a batched INSERT on SQLite) a chunk
+at a time, so the file is never held in memory all at once.
+
+    python3 importer.py devices shipment.csv
+    python3 importer.py repairs repairs.csv --strict --dry-run
+
+The CSV needs a header row naming the columns (any order and case);
+see DEVICE_COLUMNS and REPAIR_COLUMNS for which are required. Dates are
+YYYY-MM-DD and money is dollars ($ and thousands separators allowed).
+"""
+
+import argparse
+import csv
+import datetime
+import decimal
+import io
+import itertools
+import sys
+
+import database
+from backends import to_cents
+from metrics import instrumented, query_failed
+
+CHUNK_SIZE = 1000           # rows validated and copied at a time
+MAX_REPORTED = 100          # rejected rows listed in the report
+
+
+#####################################################
+#   Column Types
+#####################################################
+
+def _integer(value: str) -> int:
+    return int(value)
+
+
+def _abn(value: str) -> int:
+    if not value.isdigit() or len(value) > 11:
+        raise ValueError("not an ABN")
+    return int(value)
+
+
+def _date(value: str) -> datetime.date:
+    return datetime.date.fromisoformat(value)
+
+
+def _money(value: str) -> decimal.Decimal:
+    try:
+        amount = decimal.Decimal(value.replace('$', '').replace(',', ''))
+    except decimal.InvalidOperation:
+        raise ValueError("not an amount")
+    if not amount.is_finite() or amount < 0:
+        raise ValueError("not an amount")
+    return amount.quantize(decimal.Decimal('0.01'))
+
+
+def _text(max_length: int):
+    def parse(value: str) -> str:
+        if len(value) > max_length:
+            raise ValueError("longer than {} characters".format(max_length))
+        return value
+    return parse
+
+
+# (column, parser, required), in table column order
+DEVICE_COLUMNS = [
+    ('deviceID', _integer, True),
+    ('serialNumber', _text(10), False),
+    ('purchaseDate', _date, False),
+    ('purchaseCost', _money, False),
+    ('manufacturer', _text(20), True),
+    ('modelNumber', _text(10), True),
+    ('issuedTo', _integer, False),
+]
+
+REPAIR_COLUMNS = [
+    ('repairID', _integer, True),
+    ('faultReport', _text(60), False),
+    ('startDate', _date, False),
+    ('endDate', _date, False),
+    ('cost', _money, False),
+    ('doneBy', _abn, True),
+    ('doneTo', _integer, True),
+]
+
+MONEY_COLUMNS = {'purchaseCost', 'cost'}
+
+
+#####################################################
+#   Reference Checks
+#####################################################
+
+def _existing(cursor, sql: str, keys: set) -> set:
+    """
+    The keys (values or tuples) that `sql` finds; sql has one {} for the
+    comma separated list of key placeholders.
+    """
+    if not keys:
+        return set()
+    keys = list(keys)
+    width = len(keys[0]) if isinstance(keys[0], tuple) else 1
+    placeholder = '({})'.format(', '.join(['%s'] * width)) if width > 1 else '%s'
+    found = set()
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start:start + CHUNK_SIZE]
+        params = tuple(value for key in chunk for value in (key if width > 1 else (key,)))
+        cursor.execute(sql.format(', '.join([placeholder] * len(chunk))), params)
+        found.update(tuple(row) if width > 1 else row[0] for row in cursor.fetchall())
+    return found
+
+
+def _check_devices(cursor, rows: list) -> list:
+    """
+    (row, error) for each parsed Device row; error is None if it can go in.
+    """
+    ids = _existing(cursor, "SELECT deviceID FROM Device WHERE deviceID IN ({})",
+                    {row['deviceID'] for row in rows})
+    models = _existing(cursor, """SELECT manufacturer, modelNumber FROM Model
+                                   WHERE (manufacturer, modelNumber) IN (VALUES {})""",
+                       {(row['manufacturer'], row['modelNumber']) for row in rows})
+    employees = _existing(cursor, "SELECT empid FROM Employee WHERE empid IN ({})",
+                          {row['issuedTo'] for row in rows if row['issuedTo'] is not None})
+    checked = []
+    for row in rows:
+        error = None
+        if row['deviceID'] in ids:
+            error = "Device {} already exists".format(row['deviceID'])
+        elif (row['manufacturer'], row['modelNumber']) not in models:
+            error = "Model {} {} does not exist".format(row['manufacturer'], row['modelNumber'])
+        elif row['issuedTo'] is not None and row['issuedTo'] not in employees:
+            error = "Employee {} does not exist".format(row['issuedTo'])
+        checked.append((row, error))
+    return checked
+
+
+def _check_repairs(cursor, rows: list) -> list:
+    """
+    (row, error) for each parsed Repair row; error is None if it can go in.
+    """
+    ids = _existing(cursor, "SELECT repairID FROM Repair WHERE repairID IN ({})",
+                    {row['repairID'] for row in rows})
+    services = _existing(cursor, "SELECT abn FROM Service WHERE abn IN ({})",
+                         {row['doneBy'] for row in rows})
+    devices = _existing(cursor, "SELECT deviceID FROM Device WHERE deviceID IN ({})",
+                        {row['doneTo'] for row in rows})
+    checked = []
+    for row in rows:
+        error = None
+        if row['repairID'] in ids:
+            error = "Repair {} already exists".format(row['repairID'])
+        elif row['doneBy'] not in services:
+            error = "Service {} does not exist".format(row['doneBy'])
+        elif row['doneTo'] not in devices:
+            error = "Device {} does not exist".format(row['doneTo'])
+        elif row['startDate'] and row['endDate'] and row['endDate'] < row['startDate']:
+            error = "endDate is before startDate"
+        checked.append((row, error))
+    return checked
+
+
+# kind -> (table, columns, id column, reference check)
+TABLES = {
+    'devices': ('Device', DEVICE_COLUMNS, 'deviceID', _check_devices),
+    'repairs': ('Repair', REPAIR_COLUMNS, 'repairID', _check_repairs),
+}
+
+
+#####################################################
+#   Import
+#####################################################
+
+def _parse_rows(reader, columns: list, id_column: str, report: dict):
+    """
+    Yield (line, row dict) for each CSV row that parses; rows that don't
+    are added to the report. Raises ValueError if required columns are
+    missing from the header.
+    """
+    header = [name.strip().lower() for name in next(reader, [])]
+    missing = [name for name, _, required in columns if required and name.lower() not in header]
+    if missing:
+        raise ValueError("CSV is missing the column(s) {}".format(', '.join(missing)))
+    positions = [(name, parse, required, header.index(name.lower()) if name.lower() in header else None)
+                 for name, parse, required in columns]
+    seen = set()
+
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        report['rows'] += 1
+        row = {}
+        error = None
+        for name, parse, required, index in positions:
+            value = values[index].strip() if index is not None and index < len(values) else ''
+            if not value:
+                if required:
+                    error = "{} is required".format(name)
+                    break
+                row[name] = None
+                continue
+            try:
+                row[name] = parse(value)
+            except ValueError:
+                error = "Invalid {} '{}'".format(name, value)
+                break
+        if error is None and row[id_column] in seen:
+            error = "{} {} appears more than once in the file".format(id_column, row[id_column])
+        if error is not None:
+            _reject(report, reader.line_num, error)
+            continue
+        seen.add(row[id_column])
+        yield reader.line_num, row
+
+
+def _reject(report: dict, line: int, error: str):
+    report['rejected'] += 1
+    if len(report['errors']) < MAX_REPORTED:
+        report['errors'].append({'line': line, 'error': error})
+
+
+def _chunks(rows):
+    chunk = []
+    for item in rows:
+        chunk.append(item)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@instrumented
+@database.writes
+def import_csv(kind: str, text, strict: bool = False, dry_run: bool = False) -> dict:
+    """
+    Import a CSV of `kind` ('devices' or 'repairs') read from the text
+    file object `text`.
+
+    Rows that fail a check are skipped and listed in the report; with
+    `strict` any rejected row means nothing is imported. `dry_run` checks
+    everything and rolls back. Either the whole import commits or none
+    of it does.
+
+    Returns
+        {'table': ..., 'rows': n, 'imported': n, 'rejected': n,
+         'errors': [{'line': n, 'error': ...}, ...], 'committed': bool}
+    or None if the database couldn't be reached. Raises ValueError for a
+    CSV without the required columns.
+    """
+    table, columns, id_column, check = TABLES[kind]
+    names = [name for name, _, _ in columns]
+    report = {'table': table, 'rows': 0, 'imported': 0, 'rejected': 0, 'errors': [], 'committed': False}
+    reader = csv.reader(text)
+    parsed = _parse_rows(reader, columns, id_column, report)
+    # Read the header (and any ValueError) before taking a connection
+    first = next(parsed, None)
+
+    connection = database.database_connect()
+    if(connection is None):
+        return None
+    cursor = connection.cursor()
+    sqlite = database.get_backend().dialect == 'sqlite'
+    failed = False
+    unreadable = None
+
+    try:
+        if sqlite:
+            cursor.execute("BEGIN IMMEDIATE")
+        rows = parsed if first is None else itertools.chain([first], parsed)
+        for chunk in _chunks(rows):
+            good = []
+            for (line, row), (_, error) in zip(chunk, check(cursor, [row for _, row in chunk])):
+                if error is None:
+                    good.append(row)
+                else:
+                    _reject(report, line, error)
+            if strict and report['rejected']:
+                continue
+            report['imported'] += database.copy_rows(
+                cursor, table, names,
+                ([to_cents(row[name]) if sqlite and name in MONEY_COLUMNS and row[name] is not None
+                  else row[name] for name in names] for row in good))
+        if strict and report['rejected']:
+            report['imported'] = 0
+        elif not dry_run:
+            connection.commit()
+            report['committed'] = True
+    except (UnicodeDecodeError, csv.Error) as error:
+        unreadable = error
+    except:
+        # closing the connection rolls the transaction back
+        query_failed()
+        print("Error importing {}: {}".format(kind, sys.exc_info()[1]))
+        failed = True
+
+    cursor.close()
+    connection.close()
+
+    if unreadable is not None:
+        raise ValueError("line {}: {}".format(reader.line_num, unreadable))
+    if failed:
+        return None
+
+    report['errors'].sort(key=lambda error: error['line'])
+    if report['committed'] and table == 'Device':
+        # New unissued devices show up in the issue page lookups; the
+        # monthly cost rollup was kept up to date by its trigger.
+        database.lookup_cache.invalidate_prefix('unassigned_devices')
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a CSV of devices or repairs')
+    parser.add_argument('kind', choices=sorted(TABLES))
+    parser.add_argument('file', help='CSV file with a header row (- for stdin)')
+    parser.add_argument('--strict', action='store_true', help='import nothing if any row is rejected')
+    parser.add_argument('--dry-run', action='store_true', help='check every row, then roll back')
+    args = parser.parse_args()
+
+    if args.file == '-':
+        text = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig', newline='')
+    else:
+        text = open(args.file, encoding='utf-8-sig', newline='')
+    try:
+        report = import_csv(args.kind, text, strict=args.strict, dry_run=args.dry_run)
+    except ValueError as error:
+        sys.exit(str(error))
+    finally:
+        text.close()
+        database.close_pool()
+
+    if report is None:
+        sys.exit("Import failed, nothing was written")
+    for error in report['errors']:
+        print("line {:>6}: {}".format(error['line'], error['error']))
+    if report['rejected'] > len(report['errors']):
+        print("... and {} more".format(report['rejected'] - len(report['errors'])))
+    print("{}: {} rows, {} imported, {} rejected{}".format(
+        report['table'], report['rows'], report['imported'], report['rejected'],
+        '' if report['committed'] else ' (nothing committed)'))
+    sys.exit(1 if report['rejected'] or not report['committed'] else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,43 @@
 #!/usr/bin/env python3
 
+import argparse
+
 # Set up our vendored packages
 import setup_vendor_path  # noqa
 
 # Import our webapp
 from routes import app
+from settings import get_settings
 
 # Starting the python applicaiton
 if __name__ == '__main__':
-    # Step 1: Change this port number if needed
-    PORT_NUMBER = 5000
+    parser = argparse.ArgumentParser(description='Device Management Backend')
+    parser.add_argument('--prod', action='store_true',
+                        help='run the multi-worker production server instead of the debug server')
+    parser.add_argument('--port', type=int, default=None,
+                        help='port to listen on (default from [SERVER] in config.ini)')
+    parser.add_argument('--host', default=None,
+                        help='address to listen on (default from [SERVER] in config.ini)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes for --prod (default from [SERVER] in config.ini)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='threads per worker for --prod (default from [SERVER] in config.ini)')
+    args = parser.parse_args()
+
+    # Change the port number in config.ini ([SERVER] port) if needed
+    config = get_settings().server
+    args.host = args.host or config.host
+    args.port = args.port or config.port
 
     print("-"*70)
     print("""Welcome to Device Management Backend.\n
              Please open your browser to:
-             http://127.0.0.1:{}""".format(PORT_NUMBER))
+             http://127.0.0.1:{}""".format(args.port))
     print("-"*70)
-    # Note, you're going to have to change the PORT number
-    app.run(debug=True, host='0.0.0.0', port=PORT_NUMBER)
+
+    if args.prod:
+        import server
+        server.serve(app, host=args.host, port=args.port,
+                     workers=args.workers, threads=args.threads)
+    else:
+        app.run(debug=True, host=args.host, port=args.port)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement metrics.
+Times every query function in database.py and keeps, per function: the
+number of calls and failures, the time spent, the rows fetched and the
+time spent waiting for a pooled connection. Each Flask request also gets
+its query count and total database time, sent back in a Server-Timing
+header and aggregated into histograms.
+
+    /metrics                    everything in Prometheus text format
+    [METRICS] slow_query_ms     log statements slower than this (0 = off)
+"""
+
+import bisect
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from settings import get_settings, on_reload
+
+# Upper bounds (seconds) of the latency histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the queries-per-request histogram buckets
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+slow_query_log = logging.getLogger('devicemanagement.slow_queries')
+
+_current_call = contextvars.ContextVar('dm_query_call', default=None)
+_current_request = contextvars.ContextVar('dm_request_stats', default=None)
+
+
+#####################################################
+#   Aggregates
+#####################################################
+
+class Histogram:
+    """
+    Cumulative histogram in the Prometheus style (counts per upper bound).
+    Not locked itself; Registry holds its lock while observing.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # last one is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class QueryStats:
+    """
+    Everything recorded about one query function.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.statements = 0
+        self.seconds = Histogram(SECONDS_BUCKETS)
+        self.wait_seconds = 0.0
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.queries = {}
+            self.pool_wait = Histogram(SECONDS_BUCKETS)
+            self.request_queries = Histogram(COUNT_BUCKETS)
+            self.request_db_seconds = Histogram(SECONDS_BUCKETS)
+            self.requests = 0
+            self.slow_statements = 0
+
+    def record_call(self, call):
+        with self._lock:
+            stats = self.queries.get(call.name)
+            if stats is None:
+                stats = self.queries[call.name] = QueryStats()
+            call.recorded = True
+            stats.calls += 1
+            stats.errors += call.failed
+            stats.rows += call.rows
+            stats.statements += call.statements
+            stats.seconds.observe(call.duration)
+            stats.wait_seconds += call.wait_time
+            if call.connections:
+                self.pool_wait.observe(call.wait_time)
+
+    def record_reads(self, call, rows: int = 0, statements: int = 0):
+        """
+        Add rows and statements to `call`, or to its totals if the call
+        has already been recorded (a RowStream read after it returned).
+        """
+        with self._lock:
+            if not call.recorded:
+                call.rows += rows
+                call.statements += statements
+                return
+            stats = self.queries.get(call.name)
+            if stats is not None:
+                stats.rows += rows
+                stats.statements += statements
+
+    def record_request(self, request_stats):
+        with self._lock:
+            self.requests += 1
+            self.request_queries.observe(request_stats.queries)
+            self.request_db_seconds.observe(request_stats.db_time)
+
+    def record_slow_statement(self):
+        with self._lock:
+            self.slow_statements += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'queries': {name: _copy_stats(stats) for name, stats in self.queries.items()},
+                'pool_wait': _copy_histogram(self.pool_wait),
+                'request_queries': _copy_histogram(self.request_queries),
+                'request_db_seconds': _copy_histogram(self.request_db_seconds),
+                'requests': self.requests,
+                'slow_statements': self.slow_statements,
+            }
+
+
+def _copy_histogram(histogram):
+    copy = Histogram(histogram.buckets)
+    copy.counts = list(histogram.counts)
+    copy.total = histogram.total
+    copy.count = histogram.count
+    return copy
+
+
+def _copy_stats(stats):
+    copy = QueryStats()
+    copy.__dict__.update(stats.__dict__)
+    copy.seconds = _copy_histogram(stats.seconds)
+    return copy
+
+
+registry = Registry()
+
+
+def enabled() -> bool:
+    return get_settings().metrics.enabled
+
+
+#####################################################
+#   Query Functions
+#####################################################
+
+class QueryCall:
+    """
+    One call of a query function, filled in while it runs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.duration = 0.0
+        self.wait_time = 0.0
+        self.connections = 0
+        self.statements = 0
+        self.rows = 0
+        self.failed = 0
+        self.recorded = False
+
+
+def instrumented(function):
+    """
+    Record calls of a database.py query function under its name.
+    Nested query functions count as part of the outermost one.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _current_call.get() is not None or not enabled():
+            return function(*args, **kwargs)
+
+        call = QueryCall(function.__name__)
+        token = _current_call.set(call)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            call.failed = 1
+            raise
+        finally:
+            call.duration = time.perf_counter() - start
+            _current_call.reset(token)
+            registry.record_call(call)
+            request_stats = _current_request.get()
+            if request_stats is not None:
+                request_stats.add(call)
+    return wrapper
+
+
+def query_failed():
+    """
+    Mark the running query function as failed (its exception was handled).
+    """
+    call = _current_call.get()
+    if call is not None:
+        call.failed = 1
+
+
+def track_connection(connection):
+    """
+    Note a connection checked out for the running query function and
+    wrap it so its statements are timed and its rows counted.
+    """
+    call = _current_call.get()
+    if call is None:
+        return connection
+    call.connections += 1
+    call.wait_time += getattr(connection, 'wait_time', 0.0)
+    return _TrackedConnection(connection, call)
+
+
+class _TrackedConnection:
+
+    def __init__(self, connection, call):
+        self._connection = connection
+        self._call = call
+
+    def cursor(self):
+        return _TrackedCursor(self._connection.cursor(), self._call)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def _timed(call, sql: str, run):
+    """
+    run() one statement for `call`: counted, and logged if slow.
+    """
+    start = time.perf_counter()
+    try:
+        return run()
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.record_reads(call, statements=1)
+        threshold = get_settings().metrics.slow_query_ms
+        if threshold and elapsed * 1000 >= threshold:
+            registry.record_slow_statement()
+            slow_query_log.warning("%s took %.1f ms: %s", call.name, elapsed * 1000, ' '.join(sql.split()))
+
+
+def track_statement(sql: str, run) -> list:
+    """
+    Run a statement that doesn't go through a cursor (a prepared
+    statement handle): run() returns its rows, which are counted for the
+    running query function along with the statement.
+    """
+    call = _current_call.get()
+    if call is None:
+        return run()
+    rows = _timed(call, sql, run)
+    registry.record_reads(call, rows=len(rows))
+    return rows
+
+
+class _TrackedCursor:
+
+    def __init__(self, cursor, call):
+        self._cursor = cursor
+        self._call = call
+
+    def execute(self, sql, *args, **kwargs):
+        return _timed(self._call, sql, lambda: self._cursor.execute(sql, *args, **kwargs))
+
+    def executemany(self, sql, *args, **kwargs):
+        # One statement, however many parameter rows it runs for
+        return _timed(self._call, sql, lambda: self._cursor.executemany(sql, *args, **kwargs))
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        registry.record_reads(self._call, rows=len(rows))
+        return rows
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        registry.record_reads(self._call, rows=len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            registry.record_reads(self._call, rows=1)
+        return row
+
+    def __iter__(self):
+        for row in self._cursor:
+            registry.record_reads(self._call, rows=1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+#####################################################
+#   Requests
+#####################################################
+
+class RequestStats:
+    """
+    Queries made while serving one request. Shared with the offload
+    threads the request's queries may run on, hence the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.db_time = 0.0
+        self.wait_time = 0.0
+
+    def add(self, call):
+        with self._lock:
+            self.queries += 1
+            self.db_time += call.duration
+            self.wait_time += call.wait_time
+
+
+def init_app(app):
+    """
+    Collect per-request query counts for `app` and add a Server-Timing
+    header with them to every response.
+    """
+    from flask import g
+
+    @app.before_request
+    def _start_request_metrics():
+        if enabled():
+            request_stats = RequestStats()
+            g.dm_metrics_token = _current_request.set(request_stats)
+            g.dm_metrics = request_stats
+
+    @app.after_request
+    def _finish_request_metrics(response):
+        request_stats = g.pop('dm_metrics', None)
+        if request_stats is None:
+            return response
+        _current_request.reset(g.pop('dm_metrics_token'))
+        registry.record_request(request_stats)
+        response.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries"'.format(
+            request_stats.db_time * 1000, request_stats.queries))
+        response.headers.add('Server-Timing', 'dbwait;dur={:.1f}'.format(request_stats.wait_time * 1000))
+        return response
+
+
+#####################################################
+#   Prometheus Text Format
+#####################################################
+
+def _label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_number(value) -> str:
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _histogram_lines(name, histogram, labels=''):
+    lines = []
+    cumulative = 0
+    separator = ',' if labels else ''
+    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+        cumulative += count
+        lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, separator, bound, cumulative))
+    braces = '{{{}}}'.format(labels) if labels else ''
+    lines.append('{}_sum{} {}'.format(name, braces, _format_number(histogram.total)))
+    lines.append('{}_count{} {}'.format(name, braces, histogram.count))
+    return lines
+
+
+def render_prometheus(pool_stats: dict = None, cache_stats: dict = None) -> str:
+    """
+    All metrics in the Prometheus text exposition format (version 0.0.4).
+    """
+    snapshot = registry.snapshot()
+    queries = sorted(snapshot['queries'].items())
+    out = []
+
+    def family(name, kind, help_text):
+        out.append('# HELP {} {}'.format(name, help_text))
+        out.append('# TYPE {} {}'.format(name, kind))
+
+    family('dm_db_query_duration_seconds', 'histogram', 'Time spent in each database.py query function.')
+    for name, stats in queries:
+        out.extend(_histogram_lines('dm_db_query_duration_seconds', stats.seconds,
+                                    'query="{}"'.format(_label(name))))
+
+    for metric, attribute, help_text in (
+            ('dm_db_query_errors_total', 'errors', 'Calls of each query function that failed.'),
+            ('dm_db_query_rows_total', 'rows', 'Rows fetched by each query function.'),
+            ('dm_db_query_statements_total', 'statements', 'SQL statements run by each query function.'),
+            ('dm_db_query_pool_wait_seconds_total', 'wait_seconds',
+             'Time each query function waited for a pooled connection.')):
+        family(metric, 'counter', help_text)
+        for name, stats in queries:
+            out.append('{}{{query="{}"}} {}'.format(metric, _label(name),
+                                                    _format_number(getattr(stats, attribute))))
+
+    family('dm_db_pool_wait_seconds', 'histogram', 'Time waited for a pooled connection per query function call.')
+    out.extend(_histogram_lines('dm_db_pool_wait_seconds', snapshot['pool_wait']))
+    family('dm_db_slow_statements_total', 'counter', 'Statements slower than [METRICS] slow_query_ms.')
+    out.append('dm_db_slow_statements_total {}'.format(snapshot['slow_statements']))
+
+    family('dm_http_requests_total', 'counter', 'Requests served.')
+    out.append('dm_http_requests_total {}'.format(snapshot['requests']))
+    family('dm_http_request_queries', 'histogram', 'Query function calls per request.')
+    out.extend(_histogram_lines('dm_http_request_queries', snapshot['request_queries']))
+    family('dm_http_request_db_seconds', 'histogram', 'Database time per request.')
+    out.extend(_histogram_lines('dm_http_request_db_seconds', snapshot['request_db_seconds']))
+
+    if pool_stats:
+        replicas = pool_stats.get('replicas', {})
+        family('dm_db_pool', 'gauge', 'Connection pool counters and sizes.')
+        for key, value in sorted(pool_stats.items()):
+            if key != 'replicas':
+                out.append('dm_db_pool{{stat="{}"}} {}'.format(_label(key), _format_number(value)))
+        if replicas:
+            family('dm_db_replica', 'gauge', 'Read replica pool counters, latency (seconds) and state.')
+            for replica, stats in sorted(replicas.items()):
+                for key, value in sorted(stats.items()):
+                    out.append('dm_db_replica{{replica="{}",stat="{}"}} {}'.format(
+                        _label(replica), _label(key), _format_number(value)))
+
+    if cache_stats:
+        family('dm_cache', 'gauge', 'Reference cache counters and sizes.')
+        for cache_name, stats in sorted(cache_stats.items()):
+            for key, value in sorted(stats.items()):
+                out.append('dm_cache{{cache="{}",stat="{}"}} {}'.format(
+                    _label(cache_name), _label(key), _format_number(value)))
+
+    return '\n'.join(out) + '\n'
+
+
+#####################################################
+#   Slow Query Log
+#####################################################
+
+def _configure_slow_query_log(config):
+    for handler in list(slow_query_log.handlers):
+        slow_query_log.removeHandler(handler)
+        handler.close()
+    if config.slow_query_log:
+        handler = logging.FileHandler(config.slow_query_log)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s slow query: %(message)s'))
+    slow_query_log.addHandler(handler)
+    slow_query_log.setLevel(logging.WARNING)
+    slow_query_log.propagate = False
+
+
+@on_reload
+def _reset_slow_query_log(new_settings):
+    _configure_slow_query_log(new_settings.metrics)
+
+
+_configure_slow_query_log(get_settings().metrics)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement schema migrations.
+
+Migrations are the numbered .sql files in migrations/, applied in order,
+each in its own transaction, and recorded in the schema_migrations table
+so each runs once per database.
+
+    python3 migrate.py            # apply anything not applied yet
+    python3 migrate.py status     # list migrations and whether they ran
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import database
+import sqlscript
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+_MIGRATION_FILE = re.compile(r'^(\d+)_([A-Za-z0-9_]+)\.sql$')
+
+
+def available_migrations() -> list:
+    """
+    (version, name, path) for every migration file, oldest first.
+    """
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = _MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2),
+                               os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+
+def _checksum(path: str) -> str:
+    with open(path, 'rb') as migration:
+        return hashlib.sha1(migration.read()).hexdigest()
+
+
+def _ensure_table(connection):
+    cursor = connection.cursor()
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+                          version INTEGER PRIMARY KEY,
+                          name VARCHAR(100) NOT NULL,
+                          checksum CHAR(40) NOT NULL,
+                          applied_at TIMESTAMP NOT NULL DEFAULT now()
+                      )""")
+    connection.commit()
+    cursor.close()
+
+
+def applied_migrations(connection) -> dict:
+    """
+    {version: checksum} of the migrations already applied.
+    """
+    _ensure_table(connection)
+    cursor = connection.cursor()
+    cursor.execute("SELECT version, checksum FROM schema_migrations")
+    applied = dict(cursor.fetchall())
+    cursor.close()
+    connection.rollback()
+    return applied
+
+
+def migrate(target: int = None, verbose: bool = True) -> list:
+    """
+    Apply every pending migration up to `target` (default: all).
+    Returns the versions applied.
+    """
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+
+    done = []
+    try:
+        applied = applied_migrations(connection)
+        for version, name, path in available_migrations():
+            if target is not None and version > target:
+                break
+            checksum = _checksum(path)
+            if version in applied:
+                if applied[version].strip() != checksum and verbose:
+                    print("Warning: migration {:04d}_{} changed after it was applied".format(version, name))
+                continue
+            if verbose:
+                print("Applying {:04d}_{}".format(version, name))
+            # The script and its bookkeeping row commit together
+            sqlscript.run_file(connection, path, commit=False)
+            cursor = connection.cursor()
+            cursor.execute("INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)",
+                           (version, name, checksum))
+            cursor.close()
+            connection.commit()
+            done.append(version)
+    finally:
+        connection.close()
+
+    # New tables/indexes can change what the cached lookups should return
+    database.clear_caches()
+    return done
+
+
+def status():
+    connection = database.database_connect()
+    if connection is None:
+        sys.exit("Could not connect to the database")
+    try:
+        applied = applied_migrations(connection)
+    finally:
+        connection.close()
+    for version, name, _ in available_migrations():
+        print("{:04d}_{:<40} {}".format(version, name, 'applied' if version in applied else 'pending'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply DeviceManagement schema migrations')
+    parser.add_argument('command', nargs='?', default='up', choices=['up', 'status'])
+    parser.add_argument('--to', type=int, default=None, help='stop after this version')
+    args = parser.parse_args()
+    if args.command == 'status':
+        status()
+    else:
+        applied = migrate(args.to)
+        print("Applied {} migration(s)".format(len(applied)))
+
+
+if __name__ == '__main__':
+    main()
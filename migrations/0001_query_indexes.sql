@@ -0,0 +1,41 @@
+-- Indexes for the join and filter columns the queries in database.py use.
+-- The schema only has primary keys (and the UNIQUE on Department.manager,
+-- which already gives is_manager() an index).
+
+-- get_issued_devices_for_user, used_history, the dashboard, and the
+-- keyset pages ordered by deviceID
+CREATE INDEX IF NOT EXISTS device_issued_to_idx
+    ON Device (issuedTo, deviceID)
+    WHERE issuedTo IS NOT NULL;
+
+-- get_model_device_assigned, get_model_cost, model/department joins
+CREATE INDEX IF NOT EXISTS device_model_idx
+    ON Device (manufacturer, modelNumber);
+
+-- get_unassigned_devices_for_model: only the free devices
+CREATE INDEX IF NOT EXISTS device_unassigned_idx
+    ON Device (manufacturer, modelNumber, deviceID)
+    WHERE issuedTo IS NULL;
+
+-- get_device_repairs, repair exports
+CREATE INDEX IF NOT EXISTS repair_done_to_idx
+    ON Repair (doneTo);
+
+-- get_devices_used_by (the primary key leads with deviceID)
+CREATE INDEX IF NOT EXISTS device_used_by_emp_idx
+    ON DeviceUsedBy (empID, deviceID);
+
+-- get_employees_in_department (the primary key leads with empID)
+CREATE INDEX IF NOT EXISTS employee_departments_department_idx
+    ON EmployeeDepartments (department, empID);
+
+-- get_department_models, department exports (the primary key leads
+-- with manufacturer)
+CREATE INDEX IF NOT EXISTS model_allocations_department_idx
+    ON ModelAllocations (department, manufacturer, modelNumber);
+
+ANALYZE Device;
+ANALYZE Repair;
+ANALYZE DeviceUsedBy;
+ANALYZE EmployeeDepartments;
+ANALYZE ModelAllocations;
@@ -0,0 +1,83 @@
+-- Precomputed per-model, per-month purchase cost rollup for get_model_cost.
+-- Kept up to date by a row trigger on Device, so the cost history page
+-- reads a handful of rows no matter how many devices there are.
+
+CREATE TABLE IF NOT EXISTS ModelMonthlyCost (
+    manufacturer VARCHAR(20) NOT NULL,
+    modelNumber VARCHAR(10) NOT NULL,
+    year INTEGER,                               -- NULL when purchaseDate is unknown
+    month INTEGER,
+    total_cost NUMERIC NOT NULL DEFAULT 0,      -- sum of purchaseCost
+    cost_count INTEGER NOT NULL DEFAULT 0,      -- devices with a purchaseCost
+    device_count INTEGER NOT NULL DEFAULT 0,    -- all devices
+    FOREIGN KEY (manufacturer, modelNumber) REFERENCES Model
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS model_monthly_cost_key
+    ON ModelMonthlyCost (manufacturer, modelNumber, (COALESCE(year, 0)), (COALESCE(month, 0)));
+
+-- Add (p_sign = 1) or remove (p_sign = -1) one device from the rollup
+CREATE OR REPLACE FUNCTION model_monthly_cost_apply(p_manufacturer VARCHAR, p_model VARCHAR,
+                                                    p_date DATE, p_cost MONEY, p_sign INTEGER)
+RETURNS void AS $$
+BEGIN
+    INSERT INTO ModelMonthlyCost AS M
+           (manufacturer, modelNumber, year, month, total_cost, cost_count, device_count)
+    VALUES (p_manufacturer, p_model,
+            CAST(EXTRACT(year FROM p_date) AS int),
+            CAST(EXTRACT(month FROM p_date) AS int),
+            p_sign * COALESCE(p_cost::numeric, 0),
+            p_sign * CASE WHEN p_cost IS NULL THEN 0 ELSE 1 END,
+            p_sign)
+    ON CONFLICT (manufacturer, modelNumber, (COALESCE(year, 0)), (COALESCE(month, 0)))
+    DO UPDATE SET total_cost = M.total_cost + EXCLUDED.total_cost,
+                  cost_count = M.cost_count + EXCLUDED.cost_count,
+                  device_count = M.device_count + EXCLUDED.device_count;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION model_monthly_cost_trigger()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM model_monthly_cost_apply(OLD.manufacturer, OLD.modelNumber,
+                                         OLD.purchaseDate, OLD.purchaseCost, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM model_monthly_cost_apply(NEW.manufacturer, NEW.modelNumber,
+                                         NEW.purchaseDate, NEW.purchaseCost, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Issuing and revoking only touch issuedTo, so they don't fire this
+DROP TRIGGER IF EXISTS device_model_monthly_cost ON Device;
+CREATE TRIGGER device_model_monthly_cost
+    AFTER INSERT OR DELETE OR UPDATE OF purchaseDate, purchaseCost, manufacturer, modelNumber
+    ON Device
+    FOR EACH ROW EXECUTE PROCEDURE model_monthly_cost_trigger();
+
+-- Recompute the whole rollup from Device (after bulk loads that bypass
+-- the trigger, or to repair drift)
+CREATE OR REPLACE FUNCTION model_monthly_cost_rebuild()
+RETURNS void AS $$
+BEGIN
+    LOCK TABLE Device IN SHARE MODE;
+    DELETE FROM ModelMonthlyCost;
+    INSERT INTO ModelMonthlyCost
+           (manufacturer, modelNumber, year, month, total_cost, cost_count, device_count)
+    SELECT manufacturer, modelNumber,
+           CAST(EXTRACT(year FROM purchaseDate) AS int),
+           CAST(EXTRACT(month FROM purchaseDate) AS int),
+           COALESCE(SUM(purchaseCost::numeric), 0),
+           COUNT(purchaseCost),
+           COUNT(*)
+      FROM Device
+     GROUP BY 1, 2, 3, 4;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT model_monthly_cost_rebuild();
+
+ANALYZE ModelMonthlyCost;
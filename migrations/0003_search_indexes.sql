@@ -0,0 +1,18 @@
+-- Indexes for search_models and search_devices.
+-- pg_trgm's GIN indexes answer the fuzzy (similarity) matches; the
+-- text_pattern_ops index gives short serial number prefixes a range scan.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- search_models: manufacturer, model number and description as one text,
+-- exactly as the query writes it
+CREATE INDEX IF NOT EXISTS model_search_trgm_idx
+    ON Model USING gin ((lower(manufacturer || ' ' || modelNumber || ' ' || coalesce(description, ''))) gin_trgm_ops);
+
+-- search_devices: serial number prefixes
+CREATE INDEX IF NOT EXISTS device_serial_prefix_idx
+    ON Device (lower(serialNumber) text_pattern_ops);
+
+-- search_devices: similar serial numbers
+CREATE INDEX IF NOT EXISTS device_serial_trgm_idx
+    ON Device USING gin (lower(serialNumber) gin_trgm_ops);
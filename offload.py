@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement query offloading.
+Runs independent database calls of one request at the same time on a
+shared thread pool, so a page that needs two lookups waits for the
+slower one rather than for both in turn. pg8000 is a blocking driver,
+so the waiting happens on worker threads, each holding its own pooled
+connection.
+
+    device_info, repairs = offload.gather(
+        (database.get_device_information, deviceid),
+        (database.get_device_repairs, deviceid))
+
+With [ASYNC] enabled = false the calls simply run one after another.
+"""
+
+import concurrent.futures
+import contextvars
+import threading
+
+from settings import get_settings, on_reload
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=get_settings().concurrency.workers,
+                    thread_name_prefix='dm-offload')
+    return _executor
+
+
+@on_reload
+def _reset_executor(new_settings):
+    global _executor
+    with _executor_lock:
+        old_executor, _executor = _executor, None
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+
+def enabled() -> bool:
+    return get_settings().concurrency.enabled
+
+
+def gather(*calls) -> list:
+    """
+    Run every (function, *args) call and return their results in order.
+    The last call runs on the current thread while the others run on the
+    pool. An exception in any call is raised here.
+    """
+    if not enabled() or len(calls) < 2:
+        return [call[0](*call[1:]) for call in calls]
+
+    executor = _get_executor()
+    # Each call runs in a copy of this context, so the query metrics of
+    # the request keep counting the calls made on the pool's threads.
+    futures = [executor.submit(contextvars.copy_context().run, *call) for call in calls[:-1]]
+    last = calls[-1]
+    last_result = last[0](*last[1:])
+    return [future.result() for future in futures] + [last_result]
+
+
+def shutdown():
+    """
+    Stop the worker threads (used when a server worker exits).
+    """
+    _reset_executor(None)
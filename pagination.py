@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement pagination helpers.
+Keyset ("seek") pagination: a page is addressed by the sort key of the row
+just before (or after) it, carried in the URL as an opaque cursor string.
+"""
+
+import base64
+import datetime
+import json
+from typing import Optional
+
+from settings import get_settings
+
+
+def encode_cursor(key) -> Optional[str]:
+    """
+    Turn a sort key tuple into a URL safe cursor string.
+    """
+    if key is None:
+        return None
+    data = json.dumps(list(key), separators=(',', ':'), default=_json_default)
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str], size: int) -> Optional[tuple]:
+    """
+    Turn a cursor string back into a sort key tuple of `size` strings or
+    integers. Anything malformed (or of another shape) is treated as
+    'no cursor' (i.e. the first page).
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        key = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(key, list) or len(key) != size:
+        return None
+    # Only plain values: the key ends up in cache keys, which must hash
+    if not all(isinstance(value, (str, int)) and not isinstance(value, bool) for value in key):
+        return None
+    return tuple(key)
+
+
+def page_size(requested) -> int:
+    """
+    Clamp a requested page size to [1, max_page_size], using the default
+    page size when nothing (or garbage) was asked for.
+    """
+    config = get_settings().pages
+    try:
+        size = int(requested)
+    except (TypeError, ValueError):
+        return config.page_size
+    return max(1, min(size, config.max_page_size))
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return str(value)
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement connection pool.
+Keeps a bounded set of long-lived database connections that the query
+functions in database.py borrow and hand back, instead of paying for a
+fresh connect (TCP + auth handshake) on every single query.
+"""
+
+import collections
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became free before the checkout timeout.
+    """
+
+
+#####################################################
+#   Pooled Connection
+#   (looks like a pg8000 connection, but close()
+#       hands it back to the pool)
+#####################################################
+
+class PooledConnection:
+    """
+    Wrapper around a raw connection checked out of a ConnectionPool.
+    Calling close() returns the connection to the pool rather than
+    closing the socket, so the existing
+        cursor.close()
+        connection.close()
+    pattern in database.py keeps working unchanged.
+    """
+
+    def __init__(self, pool, raw, wait_time):
+        self._pool = pool
+        self._raw = raw
+        self.wait_time = wait_time      # seconds spent waiting on checkout
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            raise RuntimeError("Connection has already been returned to the pool")
+        return self._raw
+
+    def cursor(self):
+        return self.raw.cursor()
+
+    def prepared(self, sql: str):
+        """
+        The statement handle the pool keeps prepared for `sql` on this
+        connection, preparing it on first use.
+        """
+        return self._pool.prepared(self.raw, sql)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        """
+        Give the connection back to the pool. Safe to call twice.
+        """
+        if self._raw is None:
+            return
+        raw, self._raw = self._raw, None
+        self._pool.release(raw)
+
+    def discard(self):
+        """
+        Throw the connection away (e.g. after a network error).
+        """
+        if self._raw is None:
+            return
+        raw, self._raw = self._raw, None
+        self._pool.release(raw, discard=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+#####################################################
+#   Connection Pool
+#####################################################
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections.
+
+    connect:            callable returning a new raw DB-API connection
+    prepare:            callable(raw, sql) returning a reusable statement
+                        handle; handles are cached per connection and
+                        dropped with it
+    min_size:           connections kept open even when idle
+    max_size:           hard cap on open connections
+    timeout:            seconds to wait for a free connection on checkout
+    max_idle:           idle connections older than this are closed
+                        (never going below min_size)
+    health_check_after: connections idle longer than this are pinged
+                        with SELECT 1 before being handed out
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, timeout=5.0,
+                 max_idle=300.0, health_check_after=30.0, prepare=None):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        if min_size < 0 or min_size > max_size:
+            raise ValueError("min_size must be between 0 and max_size")
+
+        self._connect = connect
+        self._prepare = prepare or (lambda raw, sql: raw.prepare(sql))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_after = health_check_after
+
+        self._lock = threading.Condition()
+        self._idle = collections.deque()    # (raw connection, last used)
+        self._size = 0                      # open connections, idle + in use
+        self._closed = False
+        self._statements = {}               # id(raw) -> {sql: prepared handle}
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'evicted': 0,
+            'failed_health_checks': 0,
+            'prepared': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def fill(self):
+        """
+        Open connections until min_size are available.
+        """
+        while True:
+            with self._lock:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                raw = self._create()
+            except Exception:
+                return
+            self.release(raw)
+
+    def get(self, timeout=None):
+        """
+        Check a connection out of the pool.
+        Raises PoolTimeout if none became free in time.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+
+        while True:
+            raw = None
+            last_used = None
+            create = False
+            with self._lock:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                self._evict_idle()
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            "No database connection free after {:.1f}s "
+                            "(max_size={})".format(timeout, self.max_size))
+                    waited = True
+                    self._lock.wait(remaining)
+                if self._idle:
+                    # most recently used first, so the tail goes idle and is evicted
+                    raw, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+
+            if create:
+                raw = self._create()
+            elif time.monotonic() - last_used > self.health_check_after:
+                if not self._healthy(raw):
+                    with self._lock:
+                        self._stats['failed_health_checks'] += 1
+                    self._drop(raw)
+                    continue
+
+            wait_time = time.monotonic() - start
+            with self._lock:
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+            return PooledConnection(self, raw, wait_time)
+
+    def release(self, raw, discard=False):
+        """
+        Return a raw connection to the pool. Any open transaction is rolled
+        back so the next borrower starts clean.
+        """
+        if not discard:
+            try:
+                raw.rollback()
+            except Exception:
+                discard = True
+
+        if discard or self._closed:
+            self._drop(raw)
+            return
+
+        with self._lock:
+            self._idle.append((raw, time.monotonic()))
+            self._lock.notify()
+
+    def close(self):
+        """
+        Close every idle connection and refuse further checkouts.
+        Connections still checked out are closed when they are returned.
+        """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._lock.notify_all()
+        for raw, _ in idle:
+            self._drop(raw)
+
+    def prepared(self, raw, sql: str):
+        """
+        The handle prepared for `sql` on the checked out connection `raw`.
+        A connection the pool opens to replace a dropped one starts with
+        none, so its statements are prepared again on their first use.
+        """
+        with self._lock:
+            statements = self._statements.setdefault(id(raw), {})
+            if sql in statements:
+                return statements[sql]
+        # Only the borrower uses `raw`, so nobody else can prepare it meanwhile
+        handle = self._prepare(raw, sql)
+        with self._lock:
+            statements[sql] = handle
+            self._stats['prepared'] += 1
+        return handle
+
+    def stats(self) -> dict:
+        """
+        Snapshot of pool usage, used to size min_size/max_size.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+            })
+        if stats['checkouts']:
+            stats['wait_time_avg'] = stats['wait_time_total'] / stats['checkouts']
+        else:
+            stats['wait_time_avg'] = 0.0
+        return stats
+
+    ########################################
+    #   Internals
+    ########################################
+
+    def _create(self):
+        # Called with a slot already reserved in self._size
+        try:
+            raw = self._connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        with self._lock:
+            self._stats['created'] += 1
+        return raw
+
+    def _drop(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._statements.pop(id(raw), None)
+            self._size -= 1
+            self._stats['discarded'] += 1
+            self._lock.notify()
+
+    def _healthy(self, raw) -> bool:
+        try:
+            cursor = raw.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            cursor.close()
+            raw.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _evict_idle(self):
+        # Called with the lock held. The oldest idle connections sit at the
+        # left of the deque, so only look there.
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size:
+            raw, last_used = self._idle[0]
+            if now - last_used <= self.max_idle:
+                break
+            self._idle.popleft()
+            self._statements.pop(id(raw), None)
+            self._size -= 1
+            self._stats['evicted'] += 1
+            try:
+                raw.close()
+            except Exception:
+                pass
@@ -8,19 +8,132 @@ to be displayed.
 """
 
 # Importing the required packages
-from flask import Flask, redirect, url_for, render_template, request, flash, jsonify
+import csv
+import hmac
+import io
+import time
 
-import database
+from flask import (Flask, Response, redirect, url_for, render_template, request, flash, jsonify, session,
+                   get_flashed_messages, stream_with_context, g)
+from werkzeug.utils import secure_filename
 
-user_details = {}                   # User details kept for us
-session = {}                        # Session information (logged in state)
-page = {}                           # Determines the page information
+import database
+import export
+import importer
+import metrics
+import offload
+import sessions
+from pagination import decode_cursor, encode_cursor, page_size
+from settings import get_settings
+
+# Session information (logged in state, user details, manager flag) lives
+# in flask.session, one per user; see sessions.py for the backends.
+page = sessions.PageState()         # Determines the page information (per user)
 
 # Initialise the application
 app = Flask(__name__)
-app.secret_key = """U29tZWJvZHkgb25jZSB0b2xkIG1lIFRoZSB3b3JsZCBpcyBnb25uYSBy
-b2xsIG1lIEkgYWluJ3QgdGhlIHNoYXJwZXN0IHRvb2wgaW4gdGhlIHNoZWQgU2hlIHdhcyBsb29r
-aW5nIGtpbmRhIGR1bWIgV2l0aCBoZXIgZmluZ2VyIGFuZCBoZXIgdGh1bWIK"""
+sessions.init_app(app)          # also sets app.secret_key
+metrics.init_app(app)
+
+
+#####################################################
+#   Read Replica Routing
+#   A user who just wrote something reads from the
+#   primary for [REPLICAS] read_your_writes seconds,
+#   so they never see a replica that hasn't caught up.
+#####################################################
+
+@app.before_request
+def start_replica_routing():
+    recent_write = time.time() - session.get('wrote_at', 0) < get_settings().replicas.read_your_writes
+    g.routing_token = database.start_routing(primary=recent_write)
+
+
+@app.after_request
+def remember_write(response):
+    # Before the session is saved, so the next requests read the write
+    if database.routing_wrote():
+        session['wrote_at'] = time.time()
+    return response
+
+
+@app.teardown_request
+def finish_replica_routing(error=None):
+    # Teardown runs even when the request raised, so the routing state
+    # never outlives its request
+    token = g.pop('routing_token', None)
+    if token is not None:
+        database.finish_routing(token)
+
+
+#####################################################
+#   Pagination Helpers
+#####################################################
+
+def page_arguments(key_size: int):
+    """
+    Read the ?after= / ?before= cursors (sort keys of key_size values)
+    and ?limit= from the URL.
+    """
+    return (decode_cursor(request.args.get('after'), key_size),
+            decode_cursor(request.args.get('before'), key_size),
+            page_size(request.args.get('limit')))
+
+
+def pager_for(result, limit):
+    """
+    Build the next/prev cursor strings the pager.html links need.
+    """
+    return {
+        'next': encode_cursor(result['next']),
+        'prev': encode_cursor(result['prev']),
+        'limit': limit,
+    }
+
+
+#####################################################
+#   Streaming Helper
+#####################################################
+
+def stream_page(template_name, stream, **context):
+    """
+    Render a template while its rows are still being fetched: the page is
+    sent in pieces as the template loops over `stream` (a RowStream), so
+    the first bytes go out before the query has finished.
+    """
+    # Pop the flashed messages now, while the session can still be saved
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        try:
+            yield from template.generate(context)
+        finally:
+            stream.close()
+
+    response = Response(stream_with_context(generate()))
+    # generate() never starts for a HEAD request or a client that hangs
+    # up first, so its finally can't be the only close
+    response.call_on_close(stream.close)
+    return response
+
+
+#####################################################
+#   Conditional JSON
+#####################################################
+
+def revalidated_json(payload):
+    """
+    jsonify() with an ETag of the body. The browser keeps the response but
+    asks again each time (Cache-Control: no-cache); if nothing changed the
+    answer is an empty 304 Not Modified.
+    """
+    response = jsonify(payload)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 #####################################################
@@ -41,31 +154,31 @@ def index():
 
     page['title'] = 'Device Management'
 
-    # Get the list of devices "Used By" the current employee
-    used_by = database.get_devices_used_by(user_details['empid'])
-
-    if used_by is None:
-        used_by = []
+    # Everything on the landing page comes back in one round trip:
+    # the user, the department they manage, the departments they work
+    # in, their used devices and whether they have devices issued.
+    dashboard = database.get_employee_dashboard(session['user']['empid'])
 
+    if dashboard is None:
+        page['bar'] = False
+        flash('Error communicating with database')
+        dashboard = {
+            'user': session['user'],
+            'manager_of': session.get('manager'),
+            'works_in': [],
+            'used_by': [],
+            'has_devices': False,
+        }
 
-    device_list  = database.get_issued_devices_for_user(user_details['empid'])
-    if device_list is None or len(device_list) == 0:
-        device_list = None
-
-    # Get the departments that the user works in
-    works_in = database.employee_works_in(user_details['empid'])
-
-    if works_in is None:
-        works_in = []
+    # Keep the manager flag in step with the database
+    session['manager'] = dashboard['manager_of']
 
     return render_template('index.html',
                            session=session,
                            page=page,
-                           device_list=device_list,
-                           user=user_details,
-                           used_by=used_by,
-                           works_in=works_in,
-                           manager_of=session['manager'])
+                           dashboard=dashboard,
+                           user=dashboard['user'],
+                           manager_of=dashboard['manager_of'])
 
 
 #####################################################
@@ -94,17 +207,21 @@ def login():
             flash("Incorrect id/password, please try again")
             return redirect(url_for('login'))
 
-        # If there was no error, log them in
+        # If there was no error, log them in (in a brand new session)
+        sessions.rotate()
         page['bar'] = True
         flash('You have been logged in successfully')
         session['logged_in'] = True
 
-        # Store the user details for us to use throughout
-        global user_details
-        user_details = login_return_data
+        # Store the user details for us to use throughout (dates as text,
+        # so every session backend can serialise them)
+        user = login_return_data._asdict()
+        user['dateOfBirth'] = str(user['dateOfBirth'])
+        session['user'] = user
 
-        # Is the user a manager or a normal user?
-        session['manager'] = database.is_manager(request.form['id'])
+        # Is the user a manager or a normal user? The index page fills
+        # this in from the dashboard query it makes anyway.
+        session['manager'] = None
         return redirect(url_for('index'))
 
     elif(request.method == 'GET'):
@@ -121,6 +238,7 @@ def logout():
     Logs out of the current session
         - Removes any stored user data.
     """
+    session.clear()
     session['logged_in'] = False
     session['manager'] = None
     page['bar'] = True
@@ -142,7 +260,8 @@ def showhistory():
     if('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
 
-    history = database.used_history(user_details['empid'])
+    after, before, limit = page_arguments(2)       # (deviceID, empid)
+    history = database.used_history_page(session['user']['empid'], after, before, limit)
 
     if history is None:
         page['bar'] = False
@@ -150,7 +269,8 @@ def showhistory():
         return redirect(url_for('index'))
 
     return(render_template('used_history.html',
-                           history=history,
+                           history=history['rows'],
+                           pager=pager_for(history, limit),
                            session=session,
                            page=page))
 
@@ -166,15 +286,56 @@ def models():
     # Check if the user is logged in, if not: back to login.
     if('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
-    models = database.get_all_models()
+    after, before, limit = page_arguments(2)       # (manufacturer, modelNumber)
+    models = database.get_models_page(after, before, limit)
     if models is None:
         page['bar'] = False
         flash('Error communicating with database')
-        models = []
+        models = {'rows': [], 'next': None, 'prev': None}
     return(render_template('models.html',
                            page=page,
                            session=session,
-                           models=models))
+                           models=models['rows'],
+                           pager=pager_for(models, limit)))
+
+#####################################################
+#   Search
+#####################################################
+@app.route('/search')
+def search():
+    """
+    Search models (manufacturer, model number, description) and devices
+    (serial number) by prefix, falling back to similar spellings.
+    ?format=json returns the matches for the search box instead.
+    """
+    # Check if the user is logged in, if not: back to login.
+    if('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+    query = request.args.get('q', '').strip()
+    limit = min(page_size(request.args.get('limit')), database.SEARCH_LIMIT)
+
+    models, devices = [], []
+    if query:
+        models, devices = offload.gather(
+            (database.search_models, query, limit),
+            (database.search_devices, query, limit))
+    if models is None or devices is None:
+        if request.args.get('format') == 'json':
+            return jsonify({'error': True, 'message': 'Database Request Failed'}), 500
+        page['bar'] = False
+        flash('Error communicating with database')
+        models, devices = models or [], devices or []
+
+    if request.args.get('format') == 'json':
+        return revalidated_json({'error': False,
+                                 'models': [model._asdict() for model in models],
+                                 'devices': [device._asdict() for device in devices]})
+    return render_template('search.html',
+                           page=page,
+                           session=session,
+                           query=query,
+                           models=models,
+                           devices=devices)
 
 #####################################################
 #   Show Model Details
@@ -234,15 +395,17 @@ def mydevices():
     if('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
 
-    device_list = database.get_issued_devices_for_user(user_details['empid'])
+    after, before, limit = page_arguments(1)       # (deviceID,)
+    device_list = database.get_issued_devices_page(session['user']['empid'], after, before, limit)
 
     if device_list is None:
         page['bar'] = False
         flash('Error communicating with database')
-        device_list = []
+        device_list = {'rows': [], 'next': None, 'prev': None}
 
     return(render_template('mydevices.html',
-                           device_list=device_list,
+                           device_list=device_list['rows'],
+                           pager=pager_for(device_list, limit),
                            session=session,
                            page=page))
 
@@ -262,15 +425,16 @@ def device(deviceid):
     if('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
 
-    device_info = database.get_device_information(deviceid)
+    # The two lookups don't depend on each other, so run them together
+    device_info, repairs = offload.gather(
+        (database.get_device_information, deviceid),
+        (database.get_device_repairs, deviceid))
 
     if device_info is None:
         page['bar'] = False
         flash('Error communicating with database')
         return redirect(url_for('index'))
 
-    repairs = database.get_device_repairs(deviceid)
-
     if repairs is None:
         page['bar'] = False
         flash('Error communicating with database')
@@ -377,25 +541,25 @@ def departmentmodels():
     # See what we are actually rendering?
     if empid != '' and manufacturer != '' and model != '' and department != '':
         # We have all three - show the device list of issued true/false.
-        device_assigned = database.get_model_device_assigned(model, manufacturer, empid)
+        device_assigned = database.stream_model_device_assigned(model, manufacturer, empid)
 
         if device_assigned is None:
             flash('No model/manufacturer/employee matching')
             page['bar'] = True
             return redirect(url_for('departmentmodels'))
 
-        return render_template('model_device_assigned.html',
-                               device_assigned=device_assigned,
-                               department=session['manager'],
-                               empid=empid,
-                               model=model,
-                               manufacturer=manufacturer,
-                               session=session,
-                               page=page)
+        return stream_page('model_device_assigned.html', device_assigned,
+                           device_assigned=device_assigned,
+                           department=session['manager'],
+                           empid=empid,
+                           model=model,
+                           manufacturer=manufacturer,
+                           session=session,
+                           page=page)
 
     elif empid == '' and manufacturer != '' and model != '' and department != '':
         # Manager has selected a model - show employee counts
-        model_counts = database.get_employee_department_model_device(
+        model_counts = database.stream_employee_department_model_device(
             department,
             manufacturer, model)
 
@@ -404,16 +568,20 @@ def departmentmodels():
             flash('No model/manufacturer matching department')
             return redirect(url_for('departmentmodels'))
 
-        return render_template('model_counts.html',
-                                model_counts=model_counts,
-                                model=model,
-                                session=session,
-                                manufacturer=manufacturer,
-                                department=session['manager'],
-                                page=page)
+        return stream_page('model_counts.html', model_counts,
+                           model_counts=model_counts,
+                           model=model,
+                           session=session,
+                           manufacturer=manufacturer,
+                           department=session['manager'],
+                           page=page)
     else:
         # Show all models from the department
         department_models = database.get_department_models(session['manager'])
+        if department_models is None:
+            page['bar'] = False
+            flash('Error communicating with database')
+            department_models = []
 
         return render_template('departmentmodels.html',
                                department_models=department_models,
@@ -445,7 +613,10 @@ def issue_device():
 
         # If it is a POST - they are sending an 'issue' request
         res = database.issue_device_to_employee(empid, device_id)
-        if res[0]:
+        if res is None:
+            page['bar'] = False
+            flash('Database Request Failed')
+        elif res[0]:
             page['bar'] = True
             flash('Device successfully issued')
         else:
@@ -456,16 +627,16 @@ def issue_device():
     elif(request.method == 'GET'):
         # Else they're looking at the page.
         # 1. Get the list of models (Other parts will be async through ajax)
-        models = database.get_department_models(session['manager'])
+        # 3. Get the employees in the department (once chosen)
+        models, employees = offload.gather(
+            (database.get_department_models, session['manager']),
+            (database.get_employees_in_department, session['manager']))
 
         if models is None:
             page['bar'] = False
             flash('Error communicating with database')
             models = []
 
-        # 3. Get the employees in the department (once chosen)
-        employees = database.get_employees_in_department(session['manager'])
-
         if employees is None:
             page['bar'] = False
             flash('Error communicating with database')
@@ -490,6 +661,10 @@ def add_model():
         return redirect(url_for('index'))
 
     if(request.method == 'POST'):
+        catalogue = request.files.get('catalogue')
+        if catalogue is not None and catalogue.filename:
+            return add_model_catalogue(catalogue)
+
         manufacturer = request.form.get('manufacturer')
         modelNumber = request.form.get('modelNumber')
         description = request.form.get('description')
@@ -501,14 +676,20 @@ def add_model():
             flash('Invalid request')
             return redirect(url_for('add_model'))
 
-        # If it is a POST - they are sending an 'issue' request
+        # If it is a POST - they are sending an 'add model' request
         res = database.add_model(session['manager'], manufacturer,modelNumber,description,weight,maxNumber)
-        if res == None:
+        if res is None:
+            page['bar'] = False
+            flash('Error communicating with database')
+        elif res[1] is not None:
+            page['bar'] = False
+            flash(res[1])
+        elif res[0]:
             page['bar'] = True
             flash('Model successfully added')
         else:
-            page['bar'] = False
-            flash("Manufacturer and model number have already existed.")
+            page['bar'] = True
+            flash("Model already existed, the department's max number was updated")
         return redirect(url_for('add_model'))
 
     elif(request.method == 'GET'):
@@ -517,6 +698,54 @@ def add_model():
                                        session=session,
                                        department=session['manager'])
 
+MODEL_CSV_COLUMNS = ('manufacturer', 'modelnumber', 'description', 'weight', 'maxnumber')
+
+
+def read_model_csv(upload) -> list:
+    """
+    Rows of an uploaded model catalogue, as add_models tuples. The CSV
+    needs a header row naming the columns (in any order and case):
+        manufacturer, modelNumber, description, weight, maxNumber
+    """
+    text = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+    header = [column.strip().lower() for column in next(reader, [])]
+    missing = [column for column in MODEL_CSV_COLUMNS if column != 'description' and column not in header]
+    if missing:
+        raise ValueError("CSV is missing the column(s) {}".format(', '.join(missing)))
+    positions = [header.index(column) if column in header else None for column in MODEL_CSV_COLUMNS]
+    return [tuple(row[index] if index is not None and index < len(row) else None for index in positions)
+            for row in reader if any(value.strip() for value in row)]
+
+
+def add_model_catalogue(upload):
+    """
+    Add every model in an uploaded CSV to the manager's department in
+    one transaction, then report how many were added.
+    """
+    try:
+        models = read_model_csv(upload)
+    except (ValueError, UnicodeDecodeError, csv.Error) as error:
+        page['bar'] = False
+        flash('Invalid CSV file: {}'.format(error))
+        return redirect(url_for('add_model'))
+
+    results = database.add_models(session['manager'], models)
+    if results is None:
+        page['bar'] = False
+        flash('Error communicating with database')
+        return redirect(url_for('add_model'))
+
+    created = sum(1 for result in results if result['created'])
+    updated = sum(1 for result in results if result['success'] and not result['created'])
+    failed = [(number, result) for number, result in enumerate(results, start=1) if not result['success']]
+    page['bar'] = not failed
+    flash('{} models added, {} already existed (max number updated), {} rejected'.format(
+        created, updated, len(failed)))
+    for number, result in failed[:10]:
+        flash('Model {} ({} {}): {}'.format(number, result['manufacturer'], result['modelNumber'], result['error']))
+    return redirect(url_for('add_model'))
+
 #####################################################
 #   Get device list for model
 #####################################################
@@ -543,7 +772,7 @@ def model_devices():
     if devices is None:
         return jsonify({'error': True})
 
-    return jsonify({'devices': devices})
+    return revalidated_json({'devices': devices})
 
 
 #####################################################
@@ -567,14 +796,14 @@ def departmentemployees():
     if employees is None:
         return jsonify({'error': True})
 
-    return jsonify({'employees': employees})
+    return revalidated_json({'employees': employees})
 
 
 #####################################################
 #   Remove Device (POST only, no page associated)
 #####################################################
 
-@app.route('/revokedevice', methods=['GET'])
+@app.route('/revokedevice', methods=['POST'])
 def revoke_device():
     if('logged_in' not in session or not session['logged_in']):
         return redirect(url_for('login'))
@@ -583,11 +812,11 @@ def revoke_device():
         return redirect(url_for('index'))
 
     # If they're sending the revoke
-    device_id = request.args.get('device_id')
-    employee_id = request.args.get('empid')
-    model = request.args.get('model')
-    department = request.args.get('department')
-    manufacturer = request.args.get('manufacturer')
+    device_id = request.form.get('device_id')
+    employee_id = request.form.get('empid')
+    model = request.form.get('model')
+    department = request.form.get('department')
+    manufacturer = request.form.get('manufacturer')
 
     if device_id is None or employee_id is None:
         page['bar'] = False
@@ -615,3 +844,218 @@ def revoke_device():
                                 manufacturer=manufacturer,
                                 empid=employee_id,
                                 department=department))
+
+
+#####################################################
+#   Internal Statistics Access
+#####################################################
+
+def may_see_internals(allow_token: bool = False) -> bool:
+    """
+    Pool, cache and query statistics are for managers; with allow_token a
+    scraper may also send the [METRICS] scrape_token as a bearer token.
+    """
+    if session.get('logged_in') and session.get('manager') is not None:
+        return True
+    token = get_settings().metrics.scrape_token
+    if allow_token and token:
+        sent = request.headers.get('Authorization', '')
+        return hmac.compare_digest(sent.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8'))
+    return False
+
+
+#####################################################
+#   Connection Pool Statistics
+#####################################################
+
+@app.route('/poolstats', methods=['GET'])
+def poolstats():
+    """
+    Return the database connection pool statistics, used to size
+    the [POOL] section of config.ini.
+    """
+    if not may_see_internals():
+        return jsonify({'error': True, 'message': 'Managers only'}), 403
+    return jsonify(database.get_pool_stats())
+
+
+#####################################################
+#   Cache Statistics
+#####################################################
+
+@app.route('/cachestats', methods=['GET'])
+def cachestats():
+    """
+    Return the hit/miss counters of the in-process caches.
+    """
+    if not may_see_internals():
+        return jsonify({'error': True, 'message': 'Managers only'}), 403
+    return jsonify(database.get_cache_stats())
+
+
+#####################################################
+#   Metrics (Prometheus)
+#####################################################
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Query timings, per-request query counts and the pool and cache
+    counters in Prometheus text format.
+    """
+    if not may_see_internals(allow_token=True):
+        return Response('Forbidden\n', status=403, mimetype='text/plain')
+    text = metrics.render_prometheus(database.get_pool_stats(), database.get_cache_stats())
+    return Response(text, mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+#####################################################
+#   Exports (streamed CSV / NDJSON)
+#####################################################
+
+def export_response(stream, filename):
+    """
+    Stream a database.RowStream back as ?format=csv (default) or ndjson.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in export.FORMATS:
+        stream.close()
+        return jsonify({'error': True, 'message': 'Unknown export format'}), 400
+
+    # The name comes from the URL: keep it to safe characters
+    filename = secure_filename(filename) or 'export'
+    response = Response(export.chunks(stream, export_format),
+                        mimetype=export.FORMATS[export_format],
+                        headers={'Content-Disposition':
+                                 'attachment; filename="{}.{}"'.format(filename, export_format)})
+    # The chunks only close the stream once they are read; a HEAD request
+    # or a client that hangs up first never reads them
+    response.call_on_close(stream.close)
+    return response
+
+
+@app.route('/export/devices/<string:department>', methods=['GET'])
+def export_department_devices(department):
+    """
+    Export every device of the models allocated to a department.
+    Only that department's manager may.
+    """
+    if('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+    if session['manager'] != department:
+        return jsonify({'error': True, 'message': "Only the department's manager can export it"}), 403
+
+    stream = database.stream_department_devices(department)
+    if stream is None:
+        return jsonify({'error': True}), 500
+    return export_response(stream, 'devices-' + department)
+
+
+@app.route('/export/repairs/<int:deviceid>', methods=['GET'])
+def export_device_repairs(deviceid):
+    """
+    Export the repair history of a device.
+    """
+    if('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+
+    stream = database.stream_device_repairs(deviceid)
+    if stream is None:
+        return jsonify({'error': True}), 500
+    return export_response(stream, 'repairs-{}'.format(deviceid))
+
+
+@app.route('/export/modelcost/<string:model>,<string:manufacturer>', methods=['GET'])
+def export_model_cost(model, manufacturer):
+    """
+    Export the per-month cost series of a model.
+    """
+    if('logged_in' not in session or not session['logged_in']):
+        return redirect(url_for('login'))
+
+    stream = database.stream_model_costs(manufacturer, model)
+    if stream is None:
+        return jsonify({'error': True}), 500
+    return export_response(stream, 'modelcost-{}-{}'.format(manufacturer, model))
+
+
+#####################################################
+#   Bulk Issue / Revoke Devices (JSON API)
+#####################################################
+
+BULK_LIMIT = 1000               # most pairs accepted in one request
+
+
+@app.route('/bulkdevices', methods=['POST'])
+def bulk_devices():
+    """
+    Issue or revoke many devices in one transaction.
+
+    Expects JSON:
+        {"action": "issue" | "revoke",
+         "items": [{"empid": 1, "deviceid": 2}, ...]}
+    Returns one result per item, in the same order.
+    """
+    if('logged_in' not in session or not session['logged_in']):
+        return jsonify({'error': True, 'message': 'Not logged in'}), 401
+    if session['manager'] is None:
+        return jsonify({'error': True, 'message': 'Managers only'}), 403
+
+    body = request.get_json(silent=True) or {}
+    action = body.get('action')
+    items = body.get('items')
+
+    if action not in ('issue', 'revoke') or not isinstance(items, list):
+        return jsonify({'error': True, 'message': 'Invalid request'}), 400
+    if len(items) > BULK_LIMIT:
+        return jsonify({'error': True,
+                        'message': 'At most {} items per request'.format(BULK_LIMIT)}), 400
+
+    pairs = [(item.get('empid'), item.get('deviceid')) if isinstance(item, dict) else (None, None)
+             for item in items]
+    if action == 'issue':
+        results = database.issue_devices_to_employees(pairs)
+    else:
+        results = database.revoke_devices_from_employees(pairs)
+
+    if results is None:
+        return jsonify({'error': True, 'message': 'Database Request Failed'}), 500
+
+    return jsonify({'error': False,
+                    'succeeded': sum(1 for result in results if result['success']),
+                    'results': results})
+
+
+#####################################################
+#   Bulk Import of Devices / Repairs (CSV)
+#####################################################
+
+@app.route('/import/<string:kind>', methods=['POST'])
+def import_rows(kind):
+    """
+    Import a CSV of devices or repairs (see importer.py) in one
+    transaction. The CSV is the uploaded 'file', or the request body.
+    ?strict=1 imports nothing if a row is rejected; ?dry_run=1 only
+    checks. Returns the import report.
+    """
+    if('logged_in' not in session or not session['logged_in']):
+        return jsonify({'error': True, 'message': 'Not logged in'}), 401
+    if session['manager'] is None:
+        return jsonify({'error': True, 'message': 'Managers only'}), 403
+    if kind not in importer.TABLES:
+        return jsonify({'error': True, 'message': 'Unknown import'}), 404
+
+    upload = request.files.get('file')
+    stream = upload.stream if upload is not None else request.stream
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    try:
+        report = importer.import_csv(kind, text,
+                                     strict=request.args.get('strict') == '1',
+                                     dry_run=request.args.get('dry_run') == '1')
+    except (ValueError, UnicodeDecodeError, csv.Error) as error:
+        return jsonify({'error': True, 'message': 'Invalid CSV file: {}'.format(error)}), 400
+
+    if report is None:
+        return jsonify({'error': True, 'message': 'Database Request Failed'}), 500
+
+    return jsonify(dict(report, error=False))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement row types.
+Compact records for the rows database.py hands to the routes, built by
+column name from the cursor description instead of by position.
+
+Each record keeps its values in __slots__ (no per-row dict) and can be
+read the ways the templates already do:
+    device.device_id        attribute
+    device['device_id']     by field name
+    repair[0]               by field position
+"""
+
+from typing import Callable
+
+
+class Record:
+    """
+    Base class: subclasses list their fields in __slots__ and map the
+    (lower-case) result column names onto them in _columns.
+    """
+
+    __slots__ = ()
+    _columns = {}
+
+    def __init__(self, *values, **named):
+        fields = self.__slots__
+        if len(values) > len(fields):
+            raise TypeError("{} takes at most {} values".format(type(self).__name__, len(fields)))
+        for field, value in zip(fields, values):
+            object.__setattr__(self, field, value)
+        for field in fields[len(values):]:
+            object.__setattr__(self, field, named.pop(field, None))
+        if named:
+            raise TypeError("{} has no field(s) {}".format(type(self).__name__, ', '.join(named)))
+
+    @classmethod
+    def mapper(cls, cursor) -> Callable:
+        """
+        Function turning one row of `cursor`'s current result into a
+        record. Columns are matched once, by name; fields with no column
+        in the result are None.
+        """
+        positions = {}
+        for index, column in enumerate(cursor.description):
+            name = column[0]
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            positions.setdefault(name.lower(), index)
+        pairs = [(field, positions[column]) for column, field in cls._columns.items() if column in positions]
+        missing = [field for field in cls.__slots__ if field not in dict(pairs)]
+
+        def to_record(row):
+            record = cls.__new__(cls)
+            for field, index in pairs:
+                object.__setattr__(record, field, row[index])
+            for field in missing:
+                object.__setattr__(record, field, None)
+            return record
+        return to_record
+
+    @classmethod
+    def from_cursor(cls, cursor, rows) -> list:
+        """
+        Records for `rows` fetched from `cursor`.
+        """
+        to_record = cls.mapper(cursor)
+        return [to_record(row) for row in rows]
+
+    def keys(self):
+        return self.__slots__
+
+    def _asdict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            values = tuple(self)
+            return values[key]
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        for field in self.__slots__:
+            yield getattr(self, field)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(field, getattr(self, field))
+                                         for field in self.__slots__))
+
+
+#####################################################
+#   Tables
+#####################################################
+
+class Employee(Record):
+    __slots__ = ('empid', 'name', 'homeAddress', 'dateOfBirth')
+    _columns = {
+        'empid': 'empid',
+        'name': 'name',
+        'homeaddress': 'homeAddress',
+        'dateofbirth': 'dateOfBirth',
+    }
+
+
+class Model(Record):
+    __slots__ = ('manufacturer', 'model_number', 'description', 'weight')
+    _columns = {
+        'manufacturer': 'manufacturer',
+        'modelnumber': 'model_number',
+        'description': 'description',
+        'weight': 'weight',
+    }
+
+
+class Device(Record):
+    __slots__ = ('device_id', 'serial_number', 'purchase_date', 'purchase_cost',
+                 'manufacturer', 'model_number', 'issued_to')
+    _columns = {
+        'deviceid': 'device_id',
+        'serialnumber': 'serial_number',
+        'purchasedate': 'purchase_date',
+        'purchasecost': 'purchase_cost',
+        'manufacturer': 'manufacturer',
+        'modelnumber': 'model_number',
+        'issuedto': 'issued_to',
+    }
+
+
+class Service(Record):
+    __slots__ = ('abn', 'service_name', 'email')
+    _columns = {
+        'abn': 'abn',
+        'servicename': 'service_name',
+        'email': 'email',
+    }
+
+
+class Repair(Record):
+    """
+    done_by is a Service when the query joined one in, otherwise None.
+    """
+    __slots__ = ('repair_id', 'fault_report', 'start_date', 'end_date', 'cost', 'done_by', 'done_to')
+    _columns = {
+        'repairid': 'repair_id',
+        'faultreport': 'fault_report',
+        'startdate': 'start_date',
+        'enddate': 'end_date',
+        'cost': 'cost',
+        'doneto': 'done_to',
+    }
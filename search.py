@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement search helpers.
+An in-memory prefix index over the cached model catalogue, so typing in
+the search box doesn't need a database round trip for the common case,
+plus the query normalisation the SQL searches in database.py share.
+"""
+
+import bisect
+import re
+
+_WORD = re.compile(r'[0-9a-z]+')
+
+
+def normalise(query: str) -> str:
+    """
+    Lower case, with runs of whitespace collapsed.
+    """
+    return ' '.join((query or '').lower().split())
+
+
+def words(text: str) -> list:
+    """
+    The lower case alphanumeric words of `text` ('XPS-13' -> ['xps', '13']).
+    """
+    return _WORD.findall((text or '').lower())
+
+
+def like_prefix(query: str) -> str:
+    """
+    A LIKE pattern matching values that start with `query`, with LIKE's
+    own wildcards escaped (use with ESCAPE '\\').
+    """
+    escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+class PrefixIndex:
+    """
+    Sorted (token, position) pairs for a list of records; a prefix lookup
+    is a binary search plus a walk over the matching run.
+
+    Each record is indexed under the words of the given fields and under
+    each whole field value, so 'xps-1' finds model 'XPS-13' as well as
+    'xps 13' does.
+    """
+
+    def __init__(self, records: list, fields: tuple):
+        self.records = records
+        entries = set()
+        for position, record in enumerate(records):
+            for field in fields:
+                value = getattr(record, field)
+                if value is None:
+                    continue
+                value = str(value)
+                entries.add((normalise(value), position))
+                for word in words(value):
+                    entries.add((word, position))
+        self._entries = sorted(entries)
+        self._tokens = [token for token, _ in self._entries]
+
+    def _positions(self, prefix: str) -> set:
+        found = set()
+        start = bisect.bisect_left(self._tokens, prefix)
+        for token, position in self._entries[start:]:
+            if not token.startswith(prefix):
+                break
+            found.add(position)
+        return found
+
+    def search(self, query: str, limit: int = None) -> list:
+        """
+        Records matching `query`: the whole query as a prefix of a field,
+        or every word of it as a prefix of some word of the record. Whole
+        field matches come first, then catalogue order.
+        """
+        query = normalise(query)
+        if not query:
+            return []
+        whole = self._positions(query)
+        matched = set(whole)
+        query_words = words(query)
+        if query_words:
+            by_words = set.intersection(*(self._positions(word) for word in query_words))
+            matched |= by_words
+        ordered = sorted(matched, key=lambda position: (position not in whole, position))
+        if limit is not None:
+            ordered = ordered[:limit]
+        return [self.records[position] for position in ordered]
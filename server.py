@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Production server for the webapp.
+
+Runs the Flask app under gunicorn with several worker processes, each
+with several threads. The app is imported once in the master (preload)
+and every worker opens its own database connection pool after the fork.
+SIGTERM lets in-flight requests finish for graceful_timeout seconds.
+
+On Windows, where gunicorn doesn't run, waitress is used instead (one
+process, `threads` threads).
+
+Start it through main.py:
+    python3 main.py --prod --workers 4 --threads 8
+"""
+
+import os
+import sys
+
+from settings import get_settings
+
+
+def _post_fork(server, worker):
+    import database
+    database.init_worker()
+
+
+def _worker_exit(server, worker):
+    import database
+    import offload
+    offload.shutdown()
+    database.close_pool()
+
+
+def serve_gunicorn(app, host: str, port: int, workers: int, threads: int):
+    from gunicorn.app.base import BaseApplication
+
+    config = get_settings().server
+    options = {
+        'bind': '{}:{}'.format(host, port),
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'timeout': config.timeout,
+        'graceful_timeout': config.graceful_timeout,
+        'post_fork': _post_fork,
+        'worker_exit': _worker_exit,
+        'accesslog': '-',
+    }
+
+    class DeviceManagementServer(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    DeviceManagementServer().run()
+
+
+def serve_waitress(app, host: str, port: int, threads: int):
+    import waitress
+    import database
+
+    try:
+        waitress.serve(app, host=host, port=port, threads=threads)
+    finally:
+        database.close_pool()
+
+
+def serve(app, host: str = None, port: int = None, workers: int = None, threads: int = None):
+    """
+    Run `app` under the best production server available here.
+    Anything not given comes from the [SERVER] settings.
+    """
+    config = get_settings().server
+    host = host or config.host
+    port = port or config.port
+    workers = workers or config.workers
+    threads = threads or config.threads
+
+    if os.name != 'nt':
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            pass
+        else:
+            return serve_gunicorn(app, host, port, workers, threads)
+
+    try:
+        import waitress  # noqa: F401
+    except ImportError:
+        sys.exit("The production server needs gunicorn (or waitress on Windows): "
+                 "pip install gunicorn waitress")
+    if workers > 1:
+        print("waitress runs a single process; using {} threads".format(threads))
+    return serve_waitress(app, host, port, threads)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement sessions.
+Per-user session state that works with many threads and worker processes.
+
+By default Flask's signed cookie session is used: the whole session lives
+in the browser cookie, signed with the app secret, so any worker can serve
+any request. [SESSION] backend = memory or sqlite keeps the data on the
+server instead and puts only a signed session id in the cookie:
+    - memory: a dict in this process (single process servers only)
+    - sqlite: a local SQLite file shared by every worker on the machine
+
+Cookies are signed with [SESSION] secret_key. Without one a random key is
+made at startup, so sessions don't survive a restart and every process
+serving the app has to be forked from the one that made it.
+"""
+
+import os
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+
+from flask import session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+from settings import get_settings
+
+
+#####################################################
+#   Page State
+#   (the old module level `page` dict, kept per user)
+#####################################################
+
+class PageState:
+    """
+    Dict-like view of the page information (page['bar'], page['title'])
+    stored in the current user's session, so templates can keep using
+    page.bar and routes page['bar'] = ...
+    """
+
+    _PREFIX = 'page_'
+
+    def __getitem__(self, key):
+        return session.get(self._PREFIX + key)
+
+    def __setitem__(self, key, value):
+        session[self._PREFIX + key] = value
+
+    def get(self, key, default=None):
+        return session.get(self._PREFIX + key, default)
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return self[key]
+
+
+#####################################################
+#   Server Side Stores
+#####################################################
+
+class MemoryStore:
+    """
+    Sessions in a dict, for single process servers and tests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}         # session id -> (expires, serialized data)
+
+    def load(self, session_id):
+        with self._lock:
+            entry = self._data.get(session_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._data[session_id]
+                return None
+            return entry[1]
+
+    def save(self, session_id, data, expires):
+        with self._lock:
+            self._data[session_id] = (expires, data)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._data.pop(session_id, None)
+
+    def cleanup(self):
+        now = time.time()
+        with self._lock:
+            for session_id in [key for key, (expires, _) in self._data.items() if expires <= now]:
+                del self._data[session_id]
+
+
+class SQLiteStore:
+    """
+    Sessions in a local SQLite file, shared by every worker process on the
+    machine. WAL mode lets readers and the writer work at the same time;
+    each thread keeps its own connection.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                                  id TEXT PRIMARY KEY,
+                                  data TEXT NOT NULL,
+                                  expires REAL NOT NULL)""")
+        connection.commit()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, session_id):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires > ?",
+            (session_id, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    def save(self, session_id, data, expires):
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                           (session_id, data, expires))
+        connection.commit()
+
+    def delete(self, session_id):
+        connection = self._connection()
+        connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        connection.commit()
+
+    def cleanup(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),))
+        connection.commit()
+
+
+#####################################################
+#   Flask Session Interface
+#####################################################
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, session_id=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.session_id = session_id
+        self.new = new
+        self.modified = False
+        self.replaced_id = None
+
+    def regenerate(self):
+        """
+        Move the data to a new session id; the old id stops working.
+        """
+        if self.replaced_id is None and not self.new:
+            self.replaced_id = self.session_id
+        self.session_id = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """
+    Keeps session data in `store`; the cookie only carries a signed id.
+    """
+
+    serializer = TaggedJSONSerializer()
+    cleanup_every = 500         # saves between purges of expired sessions
+
+    def __init__(self, store):
+        self.store = store
+        self._saves = 0
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='dm-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                session_id = self._signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                session_id = None
+            if session_id:
+                data = self.store.load(session_id)
+                if data is not None:
+                    return ServerSession(self.serializer.loads(data), session_id)
+        return ServerSession(session_id=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_id is not None:
+            self.store.delete(session.replaced_id)
+            session.replaced_id = None
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.session_id)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not (session.modified or session.new):
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        self.store.save(session.session_id, self.serializer.dumps(dict(session)), time.time() + lifetime)
+        self._saves += 1
+        if self._saves % self.cleanup_every == 0:
+            self.store.cleanup()
+
+        response.set_cookie(name, self._signer(app).sign(session.session_id).decode('ascii'),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
+
+
+def rotate():
+    """
+    Start a fresh session for a user who has just logged in: anything from
+    before is dropped and a server side session gets a new id, so an id
+    planted before login (session fixation) is worth nothing after it.
+    """
+    session.clear()
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+def init_app(app):
+    """
+    Configure `app` for the session backend chosen in the [SESSION] settings.
+    """
+    config = get_settings().sessions
+    if config.secret_key:
+        app.secret_key = config.secret_key
+    else:
+        print("Warning: no [SESSION] secret_key (DM_SESSION_SECRET_KEY) set, using a random one; "
+              "sessions end when the server restarts", file=sys.stderr)
+        app.secret_key = secrets.token_hex(32)
+    app.permanent_session_lifetime = config.lifetime
+
+    if config.backend == 'memory':
+        app.session_interface = ServerSideSessionInterface(MemoryStore())
+    elif config.backend == 'sqlite':
+        path = config.path
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        app.session_interface = ServerSideSessionInterface(SQLiteStore(path))
+    elif config.backend != 'cookie':
+        raise ValueError("Unknown session backend '{}'".format(config.backend))
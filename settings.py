@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement settings.
+Reads config.ini once at import time into a typed settings object, so the
+query functions never touch the disk or the config parser on a request.
+
+Any value can be overridden from the environment with
+    DM_<SECTION>_<KEY>
+e.g. DM_DATABASE_HOST=localhost or DM_POOL_MAX_SIZE=20.
+DM_CONFIG points at a different config file.
+"""
+
+import configparser
+import os
+import threading
+from typing import Callable, List, NamedTuple
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+ENV_PREFIX = 'DM_'
+
+
+class DatabaseSettings(NamedTuple):
+    host: str = ''
+    user: str = ''
+    password: str = ''
+    database: str = ''
+    port: int = 5432
+    backend: str = 'postgresql'         # postgresql or sqlite
+    path: str = 'devicemanagement.db'   # database file for the sqlite backend
+
+
+class ReplicaSettings(NamedTuple):
+    hosts: str = ''                     # host[:port], comma separated; empty = primary only
+    strategy: str = 'round_robin'       # round_robin or least_latency
+    read_your_writes: float = 5.0       # seconds a session reads from the primary after a write
+    retry_after: float = 30.0           # seconds before a failed replica is tried again
+    probe_interval: float = 5.0         # seconds between latency pings (least_latency)
+
+
+class PoolSettings(NamedTuple):
+    min_size: int = 1
+    max_size: int = 10
+    timeout: float = 5.0                # seconds to wait for a free connection
+    max_idle: float = 300.0             # seconds before an idle connection is closed
+    health_check_after: float = 30.0    # seconds idle before a SELECT 1 ping
+
+
+class CacheSettings(NamedTuple):
+    ttl: float = 60.0                   # seconds a cached lookup stays valid
+    max_entries: int = 1024             # LRU bound per cache
+    lookup_ttl: float = 10.0            # seconds for the issue page's dropdown lookups
+
+
+class TimeoutSettings(NamedTuple):
+    connect: float = 10.0               # socket timeout when connecting (seconds)
+    statement: int = 0                  # statement_timeout in ms (0 = no limit)
+
+
+class PageSettings(NamedTuple):
+    page_size: int = 50                 # rows per page when none is requested
+    max_page_size: int = 500            # upper bound on ?limit=
+
+
+class StreamSettings(NamedTuple):
+    fetch_size: int = 1000              # rows per FETCH from a server-side cursor
+
+
+class ConcurrencySettings(NamedTuple):
+    enabled: bool = True                # run a request's independent queries at once
+    workers: int = 8                    # threads shared by all requests for that
+
+
+class ServerSettings(NamedTuple):
+    host: str = '0.0.0.0'
+    port: int = 5000
+    workers: int = 4                    # processes (production server only)
+    threads: int = 8                    # threads per worker process
+    timeout: int = 60                   # seconds before a stuck worker is restarted
+    graceful_timeout: int = 30          # seconds to finish requests on shutdown
+
+
+class SessionSettings(NamedTuple):
+    backend: str = 'cookie'             # cookie, memory or sqlite
+    path: str = 'sessions.db'           # SQLite file for the sqlite backend
+    lifetime: int = 86400               # seconds a session stays valid
+    secret_key: str = ''                # signs the cookies; random per start when empty
+
+
+class MetricsSettings(NamedTuple):
+    enabled: bool = True                # time query functions, count per request
+    slow_query_ms: float = 0            # log statements slower than this (0 = off)
+    slow_query_log: str = ''            # file for the slow query log (default stderr)
+    scrape_token: str = ''              # bearer token that may read /metrics without logging in
+
+
+class Settings(NamedTuple):
+    database: DatabaseSettings
+    replicas: ReplicaSettings
+    pool: PoolSettings
+    cache: CacheSettings
+    timeouts: TimeoutSettings
+    pages: PageSettings
+    streaming: StreamSettings
+    concurrency: ConcurrencySettings
+    server: ServerSettings
+    sessions: SessionSettings
+    metrics: MetricsSettings
+
+
+#####################################################
+#   Loading
+#####################################################
+
+def _convert(value, field_type):
+    if field_type is bool and isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return field_type(value)
+
+
+def _section(config, name: str, kind, required=(), fallbacks=None):
+    """
+    Build one settings section: config.ini values, then environment
+    overrides, converted to the types declared on the NamedTuple.
+    fallbacks maps a missing field onto another field of the section.
+    """
+    raw = dict(config[name]) if name in config else {}
+    for field in kind._fields:
+        env_value = os.environ.get(ENV_PREFIX + name + '_' + field.upper())
+        if env_value is not None:
+            raw[field] = env_value
+    for field, other in (fallbacks or {}).items():
+        if field not in raw and other in raw:
+            raw[field] = raw[other]
+
+    values = {}
+    for field, field_type in kind.__annotations__.items():
+        if field in raw:
+            values[field] = _convert(raw[field], field_type)
+        elif field in required:
+            raise KeyError("Missing '{}' in [{}] of {}".format(field, name, CONFIG_FILE))
+    return kind(**values)
+
+
+def _database_section(config) -> DatabaseSettings:
+    # The server details are only needed when talking to Postgres
+    backend = os.environ.get(ENV_PREFIX + 'DATABASE_BACKEND')
+    if backend is None and 'DATABASE' in config:
+        backend = config['DATABASE'].get('backend')
+    required = () if backend == 'sqlite' else ('host', 'user', 'password', 'database')
+    # The database name defaults to the user name (that's how the uni
+    # server is set up)
+    return _section(config, 'DATABASE', DatabaseSettings, required=required,
+                    fallbacks={'database': 'user'})
+
+
+def load_settings(path: str = None) -> Settings:
+    """
+    Parse the config file (and environment overrides) into a Settings.
+    """
+    path = path or os.environ.get(ENV_PREFIX + 'CONFIG', CONFIG_FILE)
+    config = configparser.ConfigParser()
+    config.read(path)
+
+    return Settings(
+        database=_database_section(config),
+        replicas=_section(config, 'REPLICAS', ReplicaSettings),
+        pool=_section(config, 'POOL', PoolSettings),
+        cache=_section(config, 'CACHE', CacheSettings),
+        timeouts=_section(config, 'TIMEOUTS', TimeoutSettings),
+        pages=_section(config, 'PAGES', PageSettings),
+        streaming=_section(config, 'STREAMING', StreamSettings),
+        concurrency=_section(config, 'ASYNC', ConcurrencySettings),
+        server=_section(config, 'SERVER', ServerSettings),
+        sessions=_section(config, 'SESSION', SessionSettings),
+        metrics=_section(config, 'METRICS', MetricsSettings),
+    )
+
+
+_settings = load_settings()
+_reload_hooks = []                  # type: List[Callable[[Settings], None]]
+_reload_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    """
+    The settings loaded at startup (or at the last reload_settings()).
+    """
+    return _settings
+
+
+def on_reload(hook: Callable[[Settings], None]):
+    """
+    Register a function to be called with the new settings after a reload.
+    """
+    _reload_hooks.append(hook)
+    return hook
+
+
+def reload_settings(path: str = None) -> Settings:
+    """
+    Re-read the config file and environment, then tell everyone who
+    registered with on_reload().
+    """
+    global _settings
+    with _reload_lock:
+        _settings = load_settings(path)
+        for hook in _reload_hooks:
+            hook(_settings)
+    return _settings
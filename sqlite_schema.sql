@@ -0,0 +1,118 @@
+-- ISYS2120 Assignment 3 Schema, SQLite edition (for [DATABASE] backend = sqlite)
+
+-- Same tables and keys as isys2120-Asst3_company_database_v4.2.sql.
+-- SQLite has no MONEY type: MONEY columns hold integer cents, and the
+-- sqlite backend reads them back as Decimal dollars (see backends.py).
+-- DATE columns hold ISO 'YYYY-MM-DD' text.
+
+PRAGMA foreign_keys = ON;
+
+BEGIN TRANSACTION;
+
+CREATE TABLE Model (
+	manufacturer VARCHAR(20),
+	modelNumber VARCHAR(10),
+	description VARCHAR(80),
+	weight REAL,
+	PRIMARY KEY (manufacturer, modelNumber)
+);
+
+CREATE TABLE Employee (
+	empid INTEGER PRIMARY KEY,
+	name VARCHAR(30),
+	homeAddress VARCHAR(50),
+	dateOfBirth DATE,
+	password VARCHAR(30)
+);
+
+CREATE TABLE Department (
+	name VARCHAR(20) PRIMARY KEY,
+	budget MONEY,                   -- cents
+	manager INTEGER UNIQUE REFERENCES Employee(empid)
+);
+
+CREATE TABLE ModelAllocations (
+	manufacturer VARCHAR(20),
+	modelNumber VARCHAR(10),
+	department VARCHAR(20) REFERENCES Department(name),
+	maxNumber INTEGER NOT NULL,
+	PRIMARY KEY (manufacturer, modelNumber, department),
+	FOREIGN KEY (manufacturer, modelNumber) REFERENCES Model
+);
+
+CREATE TABLE Offices (
+	department VARCHAR(20) REFERENCES Department(name),
+	location VARCHAR(50),
+	PRIMARY KEY (department, location)
+);
+
+CREATE TABLE EmployeePhoneNumbers (
+	empID INTEGER REFERENCES Employee,
+	phoneNumber CHAR(10),
+	PRIMARY KEY (empID, phoneNumber)
+);
+
+CREATE TABLE EmployeeDepartments (
+	empID INTEGER REFERENCES Employee,
+	department VARCHAR(20) REFERENCES Department(name),
+	fraction NUMERIC NOT NULL,
+	PRIMARY KEY (empID, department)
+);
+
+CREATE TABLE Device (
+	deviceID INTEGER PRIMARY KEY,
+	serialNumber VARCHAR(10),
+	purchaseDate DATE,
+	purchaseCost MONEY,             -- cents
+	manufacturer VARCHAR(20) NOT NULL,
+	modelNumber VARCHAR(10) NOT NULL,
+	issuedTo INTEGER REFERENCES Employee(empID),
+	FOREIGN KEY (manufacturer, modelNumber) REFERENCES Model
+);
+
+CREATE TABLE DeviceUsedBy (
+	deviceID INTEGER REFERENCES Device(deviceID),
+	empID INTEGER REFERENCES Employee(empID),
+	PRIMARY KEY (deviceID, empID)
+);
+
+CREATE TABLE Service (
+	abn NUMERIC(11) PRIMARY KEY,
+	serviceName VARCHAR(20),
+	email VARCHAR(80),
+	owed MONEY                      -- cents
+);
+
+CREATE TABLE Repair (
+	repairID INTEGER PRIMARY KEY,
+	faultReport VARCHAR(60),
+	startDate DATE,
+	endDate DATE,
+	cost MONEY,                     -- cents
+	doneBy NUMERIC(11) NOT NULL REFERENCES Service(abn),
+	doneTo INTEGER NOT NULL REFERENCES Device(deviceID)
+);
+
+-- The indexes of migrations/0001_query_indexes.sql
+CREATE INDEX device_issued_to_idx ON Device (issuedTo, deviceID) WHERE issuedTo IS NOT NULL;
+CREATE INDEX device_model_idx ON Device (manufacturer, modelNumber);
+CREATE INDEX device_unassigned_idx ON Device (manufacturer, modelNumber, deviceID) WHERE issuedTo IS NULL;
+CREATE INDEX repair_done_to_idx ON Repair (doneTo);
+CREATE INDEX device_used_by_emp_idx ON DeviceUsedBy (empID, deviceID);
+CREATE INDEX employee_departments_department_idx ON EmployeeDepartments (department, empID);
+CREATE INDEX model_allocations_department_idx ON ModelAllocations (department, manufacturer, modelNumber);
+
+-- Postgres keeps this as a trigger-maintained table
+-- (migrations/0002_model_monthly_cost.sql); a local database is small
+-- enough to add it up on read. total_cost is in dollars, like Postgres.
+CREATE VIEW ModelMonthlyCost AS
+SELECT manufacturer, modelNumber,
+       CAST(strftime('%Y', purchaseDate) AS INTEGER) AS year,
+       CAST(strftime('%m', purchaseDate) AS INTEGER) AS month,
+       COALESCE(sum(purchaseCost), 0) / 100.0 AS total_cost,
+       count(purchaseCost) AS cost_count,
+       count(*) AS device_count
+  FROM Device
+ GROUP BY manufacturer, modelNumber, year, month;
+
+COMMIT;
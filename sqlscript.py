@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+DeviceManagement SQL scripts.
+pg8000 runs one statement per execute(), so schema files, seed scripts and
+migrations are split into statements here first. The splitter understands
+'quoted strings', "quoted identifiers", -- comments and $tag$ dollar
+quoting (used by function bodies), so semicolons inside those are kept.
+"""
+
+import re
+from typing import List
+
+_DOLLAR_TAG = re.compile(r'\$[A-Za-z_0-9]*\$')
+
+
+def split_statements(script: str) -> List[str]:
+    """
+    Split a SQL script into individual statements (without the trailing ;).
+    Comment-only and empty statements are dropped.
+    """
+    statements = []
+    current = []
+    i = 0
+    length = len(script)
+    while i < length:
+        char = script[i]
+        if char == '-' and script.startswith('--', i):
+            end = script.find('\n', i)
+            i = length if end == -1 else end
+            continue
+        if char == '/' and script.startswith('/*', i):
+            end = script.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+            continue
+        if char in ("'", '"'):
+            end = i + 1
+            while end < length:
+                if script[end] == char:
+                    # doubled quote is an escaped quote
+                    if end + 1 < length and script[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            current.append(script[i:end + 1])
+            i = end + 1
+            continue
+        if char == '$':
+            tag = _DOLLAR_TAG.match(script, i)
+            if tag:
+                end = script.find(tag.group(0), tag.end())
+                end = length if end == -1 else end + len(tag.group(0))
+                current.append(script[i:end])
+                i = end
+                continue
+        if char == ';':
+            statements.append(''.join(current))
+            current = []
+            i += 1
+            continue
+        current.append(char)
+        i += 1
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def run_script(connection, script: str, commit: bool = True):
+    """
+    Execute every statement of `script` on `connection`, in order.
+    BEGIN/COMMIT in the script are skipped; the whole script runs in the
+    connection's transaction, committed at the end unless commit=False.
+    """
+    cursor = connection.cursor()
+    try:
+        for statement in split_statements(script):
+            if statement.upper() in ('BEGIN', 'BEGIN TRANSACTION', 'COMMIT', 'END'):
+                continue
+            cursor.execute(statement)
+        if commit:
+            connection.commit()
+    finally:
+        cursor.close()
+
+
+def run_file(connection, path: str, commit: bool = True):
+    """
+    run_script() on the contents of a file.
+    """
+    with open(path, encoding='utf-8') as script:
+        run_script(connection, script.read(), commit=commit)